@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+##########################################################################
+#    benchmark_optimize_mkv.py
+#    Copyright (C) 2016  Andreas Wenzel (https://github.com/awenny)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+# Measure how the phases of optimize_mkv.py scale with the size of the
+# library. A synthetic watch tree of sparse files is generated, ffmpeg is
+# replaced by a stub which only writes a small file, and every phase is
+# run in this process with the profiling of optimize_mkv.py (--profile) to
+# count its SQL statements and stat calls.
+#
+# Phases:
+# config        add the watch folder (Configuration)
+# scan_initial  first scan of the whole tree (IdentifyNewFiles)
+# scan_again    scan without any change
+# scan_churn    scan after files were added, changed and deleted
+# cleanup       sync repository and files (Cleanup)
+# execute       encode --encode-files files with the stub (Execution)
+# statistics    show statistics (Statistics)
+#
+# Results are written as JSON. With --thresholds, every metric above its
+# threshold is reported as regression and the exit code is 1. A scan
+# without any change must not list a directory.
+
+
+import os
+import sys
+import time
+import json
+import random
+import sqlite3
+import argparse
+import contextlib
+import importlib.util
+import io
+import shutil
+
+# The stub encoder writes this many bytes into its output file
+stub_output_size = 4096
+
+stub_encoder = """#!/bin/sh
+# Stub of ffmpeg for benchmarks: write a small output file, nothing else
+for out in "$@"; do :; done
+[ "$out" = "-" ] || head -c {} /dev/zero > "$out"
+""".format(stub_output_size)
+
+parser = argparse.ArgumentParser(description='Benchmark optimize_mkv.py '
+                                 'on a synthetic library')
+parser.add_argument('-w', '--work-folder', metavar='folder', action='store',
+                    default='/tmp/optimize_mkv_benchmark',
+                    help='Folder for library, repository and stub, it is '
+                    'deleted first (default /tmp/optimize_mkv_benchmark)')
+parser.add_argument('-f', '--folders', metavar='count', type=int,
+                    default=100, help='Number of real folders (default 100)')
+parser.add_argument('-n', '--files-per-folder', metavar='count', type=int,
+                    default=100, help='Files per real folder (default 100)')
+parser.add_argument('-g', '--group-size', metavar='count', type=int,
+                    default=50, help='Real folders per parent folder '
+                    '(default 50)')
+parser.add_argument('-c', '--churn', metavar='percent', type=float,
+                    default=5.0, help='Percent of the files added, changed '
+                    'and deleted before scan_churn (default 5)')
+parser.add_argument('-e', '--encode-files', metavar='count', type=int,
+                    default=20, help='Files left to encode in the execute '
+                    'phase, all others count as done (default 20)')
+parser.add_argument('-s', '--seed', metavar='number', type=int, default=1,
+                    help='Seed of the random library (default 1)')
+parser.add_argument('-o', '--output', metavar='file', action='store',
+                    default='benchmark_results.json',
+                    help='Write results to this file '
+                    '(default benchmark_results.json)')
+parser.add_argument('-t', '--thresholds', metavar='file', action='store',
+                    help='Check results against thresholds '
+                    '{"phase": {"metric": maximum}}')
+parser.add_argument('-T', '--save-thresholds', metavar='file',
+                    action='store', help='Save the results times --margin '
+                    'as new thresholds')
+parser.add_argument('-m', '--margin', metavar='factor', type=float,
+                    default=1.5, help='Factor for --save-thresholds '
+                    '(default 1.5)')
+args = parser.parse_args()
+
+
+def loadOptimizeMkv(workFolder):
+    """
+    Import optimize_mkv.py next to this script without running a command.
+    Its repository goes into the work folder.
+    """
+
+    sys.argv = [sys.argv[0]]
+    os.environ["HOME"] = workFolder
+
+    spec = importlib.util.spec_from_file_location(
+        "optimize_mkv", os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "optimize_mkv.py"))
+    optimizeMkv = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(optimizeMkv)
+    optimizeMkv.enableProfiling()
+
+    return(optimizeMkv)
+
+
+def libraryFolder(libraryRoot, number):
+    """
+    Path of real folder number in the synthetic library
+    """
+
+    return(os.path.join(libraryRoot, "group{:04d}".format(
+        number // max(1, args.group_size)), "folder{:06d}".format(number)))
+
+
+def createFile(fileName, size):
+    """
+    Create a sparse file of this size, so a large library needs no space
+    """
+
+    with open(fileName, "wb") as f:
+        f.truncate(size)
+
+
+def randomSize(randomizer):
+    """
+    Random file size of up to 4 GB. Sizes are hardly ever equal, like in a
+    real library, otherwise deduplication would hash every file in full.
+    """
+
+    return(randomizer.randint(1, 4096 * 1024 ** 2))
+
+
+def generateLibrary(libraryRoot, randomizer):
+    """
+    Generate the synthetic watch tree and return the list of its files.
+    The directories are dated back an hour: a scan doesn't remember folders
+    modified within the last seconds, like a library which just settled.
+    """
+
+    files = []
+
+    for number in range(args.folders):
+        thisFolder = libraryFolder(libraryRoot, number)
+        os.makedirs(thisFolder)
+        for fileNumber in range(args.files_per_folder):
+            fileName = os.path.join(thisFolder, "video{:06d}.{}".format(
+                fileNumber, randomizer.choice(("mkv", "avi", "mp4"))))
+            createFile(fileName, randomSize(randomizer))
+            files.append(fileName)
+
+    settledTime = time.time() - 3600
+    for thisFolder, _, _ in os.walk(libraryRoot):
+        os.utime(thisFolder, (settledTime, settledTime))
+
+    return(files)
+
+
+def churnLibrary(files, randomizer):
+    """
+    Delete, change and add a third of --churn percent of the files each
+    """
+
+    churnCount = max(1, int(len(files) * args.churn / 100 / 3))
+    randomizer.shuffle(files)
+
+    for fileName in files[:churnCount]:
+        os.remove(fileName)
+    for fileName in files[churnCount:2 * churnCount]:
+        createFile(fileName, randomSize(randomizer))
+    for fileName in files[2 * churnCount:3 * churnCount]:
+        createFile(os.path.splitext(fileName)[0] + "_new.mkv",
+                   randomSize(randomizer))
+
+    return(churnCount)
+
+
+def limitPendingFiles(databaseName, encodeFiles):
+    """
+    Leave encodeFiles files to encode, the others count as skipped
+    """
+
+    conn = sqlite3.connect(databaseName)
+    conn.execute("UPDATE folder_optimize_file "
+                 "SET file_status = 3, skip_reason = 'benchmark' "
+                 "WHERE file_status = 0 AND rowid NOT IN ("
+                 "SELECT rowid FROM folder_optimize_file "
+                 "WHERE file_status = 0 ORDER BY rowid LIMIT ?)",
+                 [encodeFiles])
+    conn.commit()
+    conn.close()
+
+
+def runPhase(optimizeMkv, results, phase, function, *arguments):
+    """
+    Run one phase and record its wall time and counters
+    """
+
+    print("Phase {} ...".format(phase))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        optimizeMkv.runPhase(phase, function, *arguments)
+
+    results[phase] = dict((metric, optimizeMkv.profileCounters[phase][metric])
+                          for metric in ("wall_seconds", "sql_statements",
+                                         "stat_calls", "directory_listings"))
+    print("   {wall_seconds:.3f}s, {sql_statements} SQL statements, "
+          "{stat_calls} stat calls, {directory_listings} directory listings"
+          .format(**results[phase]))
+
+
+def checkThresholds(phases, thresholds):
+    """
+    Compare the results with the thresholds and return the regressions
+    """
+
+    regressions = []
+
+    for phase, metrics in sorted(thresholds.items()):
+        for metric, maximum in sorted(metrics.items()):
+            value = phases.get(phase, {}).get(metric)
+            if value is not None and value > maximum:
+                regressions.append({"phase": phase, "metric": metric,
+                                    "value": value, "threshold": maximum})
+
+    return(regressions)
+
+
+def Benchmark():
+    """
+    Generate the library, run all phases and write the results
+    """
+
+    workFolder = os.path.abspath(args.work_folder)
+    libraryRoot = os.path.join(workFolder, "library")
+    stubFile = os.path.join(workFolder, "bin", "ffmpeg")
+    randomizer = random.Random(args.seed)
+
+    if os.path.exists(workFolder):
+        shutil.rmtree(workFolder)
+    os.makedirs(os.path.dirname(stubFile))
+    with open(stubFile, "w") as f:
+        f.write(stub_encoder)
+    os.chmod(stubFile, 0o755)
+
+    print("Generating {} files in {} folders ...".format(
+        args.folders * args.files_per_folder, args.folders))
+    start = time.time()
+    files = generateLibrary(libraryRoot, randomizer)
+    generateSeconds = time.time() - start
+
+    optimizeMkv = loadOptimizeMkv(workFolder)
+    databaseName = optimizeMkv.databasename
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        optimizeMkv.InitializeDatabase(databaseName)
+
+    phases = {}
+
+    # Probing would start a process per file, the stub encoder runs with
+    # the priority of the benchmark
+    optimizeMkv.args = optimizeMkv.parser.parse_args([
+        "config", "-f", "-r", "-l", libraryRoot,
+        "-d", "0:" + stubFile,
+        "-s", "probe_program:benchmark-no-probe", "encode_nice:0",
+        "encode_ionice_class:0", "max_parallel_jobs:4"])
+    runPhase(optimizeMkv, phases, "config", optimizeMkv.Configuration,
+             databaseName)
+    runPhase(optimizeMkv, phases, "scan_initial",
+             optimizeMkv.IdentifyNewFiles, databaseName)
+    runPhase(optimizeMkv, phases, "scan_again", optimizeMkv.IdentifyNewFiles,
+             databaseName)
+
+    churnCount = churnLibrary(files, randomizer)
+    runPhase(optimizeMkv, phases, "scan_churn", optimizeMkv.IdentifyNewFiles,
+             databaseName)
+    runPhase(optimizeMkv, phases, "cleanup", optimizeMkv.Cleanup,
+             databaseName)
+
+    limitPendingFiles(databaseName, args.encode_files)
+    optimizeMkv.args = optimizeMkv.parser.parse_args(["execute"])
+    runPhase(optimizeMkv, phases, "execute", optimizeMkv.Execution,
+             databaseName)
+    runPhase(optimizeMkv, phases, "statistics", optimizeMkv.Statistics,
+             databaseName)
+
+    results = {"parameters": {"folders": args.folders,
+                              "files_per_folder": args.files_per_folder,
+                              "group_size": args.group_size,
+                              "churn_percent": args.churn,
+                              "churn_files": churnCount * 3,
+                              "encode_files": args.encode_files,
+                              "seed": args.seed},
+               "python": sys.version.split()[0],
+               "sqlite": sqlite3.sqlite_version,
+               "generate_seconds": round(generateSeconds, 3),
+               "phases": phases,
+               "regressions": []}
+
+    # Nothing changed, every folder must have been skipped
+    if phases["scan_again"]["directory_listings"]:
+        results["regressions"].append({
+            "phase": "scan_again", "metric": "directory_listings",
+            "value": phases["scan_again"]["directory_listings"],
+            "threshold": 0})
+
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            results["regressions"].extend(checkThresholds(phases,
+                                                          json.load(f)))
+
+    for regression in results["regressions"]:
+        print("Regression in {phase}: {metric} {value} above {threshold}"
+              .format(**regression))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(args.output))
+
+    if args.save_thresholds:
+        with open(args.save_thresholds, "w") as f:
+            json.dump(dict((phase, dict(
+                (metric, round(value * args.margin, 3))
+                for metric, value in metrics.items()))
+                for phase, metrics in phases.items()), f, indent=2,
+                sort_keys=True)
+        print("Thresholds written to {}".format(args.save_thresholds))
+
+    return(1 if results["regressions"] else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(Benchmark())
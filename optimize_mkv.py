@@ -40,7 +40,7 @@
 
 # set current repository version to be able to migrate tables from
 # older repositories
-current_repository_version = 3
+current_repository_version = 16
 
 # Define initial default values for process command with options
 # Use unique number to indicate the specific options
@@ -62,7 +62,127 @@ default_options = [
 ]
 
 # Define initial default values for application
-default_application_options = {"target_extension": "mkv"}
+# These can be overwritten per watch folder (folder_application_option)
+default_application_options = {
+    "target_extension": "mkv",
+    "max_parallel_jobs": "1",    # number of encodes running at the same time
+    "threads_per_job": "0",      # 0 = share all cpus between running jobs
+    "watch_settle_seconds": "15", # file must be unchanged this long (watch)
+    "queue_priority": "0",       # folders with higher priority go first
+    "queue_weight": "1",         # share of encode time between folders
+    "queue_age_days": "7",       # waiting this long doubles queue score
+    "probe_program": "ffprobe",  # probe new files, empty = don't probe
+    "skip_video_codecs": "",     # skip files already in these codecs, e.g.
+                                 # "hevc,av1", empty = never
+    "skip_video_kbps": "10000",  # ... if video bitrate is at most this
+    "segment_min_size_mb": "0",  # encode larger files in segments, 0 = never
+    "segment_seconds": "300",    # length of a segment, cut at keyframes
+    "segment_parallel_jobs": "2", # segments encoded at the same time per file
+    "lease_seconds": "300",      # claimed files of a silent node are freed
+    "journal_mode": "delete",    # wal: readers don't block, local disk only
+    "deduplicate": "link",       # reuse result of identical file: link, copy
+    "quality_target": "0",       # search crf reaching this score, 0 = fixed
+    "quality_metric": "ssim",    # score of the crf search: ssim, psnr, vmaf
+    "quality_crf_min": "18",     # crf values tried by the search
+    "quality_crf_max": "30",
+    "quality_sample_count": "3", # sample clips spread over the file, used
+    "quality_sample_seconds": "10", # ... by crf search and prediction
+    "savings_min_percent": "0",  # skip if samples predict less, 0 = off
+    "encode_nice": "10",         # niceness of the encoders
+    "encode_ionice_class": "3",  # 3 = idle, 2 = best effort, 0 = unchanged
+    "max_load_average": "0",     # pause encodes above this load, 0 = never
+    "encode_hours": "",          # e.g. "22-7,12-14", empty = any time
+    "scratch_folder": "",        # encode there (e.g. local SSD), move back
+    "min_free_mb": "1024",       # keep free besides the expected output
+    "profile": "0",              # 1 = profile every run, same as --profile
+    "metrics_listen": "",        # serve metrics, e.g. "127.0.0.1:9188"
+    "metrics_textfile": "",      # write metrics for node exporter (.prom)
+    "renditions": "",            # more outputs of the same decode, e.g.
+                                 # "mobile:libx264:28:720:mp4" (name:video
+                                 # codec:crf:height:extension[:audio codec])
+    "stream_rules": "",          # per stream copy, drop or transcode, e.g.
+                                 # "audio codec=truehd:libopus 256k"
+    "io_parallel_jobs": "2"      # file checks and moves beside the encodes
+}
+
+# Meaning of file_status in folder_optimize_file
+file_status_names = {
+    0: "new",
+    1: "optimized",
+    2: "processing",
+    3: "skipped",
+    99: "failed"
+}
+
+# Stream types of stream_rules and the options disabling them in ffmpeg
+stream_rule_types = ("video", "audio", "subtitle", "data", "attachment",
+                     "any")
+stream_type_disable_options = {"-vn": "video", "-an": "audio",
+                               "-sn": "subtitle", "-dn": "data"}
+stream_rule_comparisons = {"<": lambda a, b: a < b, "<=": lambda a, b: a <= b,
+                           ">": lambda a, b: a > b, ">=": lambda a, b: a >= b,
+                           "=": lambda a, b: a == b, "!=": lambda a, b: a != b}
+
+# Properties of the source usable in conditions ("[if height>1080]...")
+# and as variables ("{height}") of default and folder options
+option_template_variables = ("width", "height", "duration", "kbps",
+                             "video_kbps", "size_mb", "video_codec")
+
+# Codecs which are efficient already, re-encoding saves little
+efficient_video_codecs = ("hevc", "av1", "vp9")
+
+# Columns of file_probe filled out of ffprobe
+file_probe_columns = ["format_name", "duration_seconds", "bit_rate",
+                      "video_codec", "video_bitrate", "width", "height",
+                      "frame_count", "stream_info", "probe_error"]
+
+# Identical source files are found by size, then by a hash of sampled
+# blocks and only if these collide by a hash of the whole file
+fingerprint_sample_blocks = 16
+fingerprint_block_size = 65536
+
+# Segments of a file are kept in the hidden folder .<file name><suffix>
+# next to it until the file is finished
+segment_folder_suffix = ".segments"
+
+# Filter comparing an encoded sample clip (first input) with its source
+# (second input) and the pattern of the mean score in the ffmpeg output
+quality_metric_filters = {
+    "ssim": ("ssim", r"SSIM .*All:([0-9.]+)"),
+    "psnr": ("psnr", r"PSNR .*average:([0-9.]+|inf)"),
+    "vmaf": ("libvmaf", r"VMAF score[:=] *([0-9.]+)")
+}
+
+# Activity log entries are collected in memory and written in batches,
+# when one of these limits is reached, at the end of every phase and on exit
+activity_log_batch_size = 500
+activity_log_flush_seconds = 10
+
+# Settings for every connection to the repository database
+database_busy_timeout_ms = 60000     # wait for a lock instead of failing
+database_mmap_size = 268435456       # read the database file memory mapped
+database_journal_modes = ("delete", "truncate", "persist", "wal")
+
+# Progress of running encodes (ffmpeg -progress) is written to running_job
+# at most this often
+progress_update_seconds = 5
+
+# Files of another node are only taken over, when its lease has expired
+# since this many renewal intervals (a third of lease_seconds)
+lease_grace_renewals = 4
+
+# Paused encodes are resumed, when the load average has dropped below
+# max_load_average times this ratio
+load_resume_ratio = 0.8
+
+# Counters of every phase of a profiled run (--profile)
+profile_counter_names = ["sql_statements", "sql_commits", "stat_calls",
+                         "directory_listings", "process_spawns"]
+
+# Columns of running_job filled out of the progress of the encoder
+running_job_progress_columns = ["frame", "fps", "speed", "bitrate_kbps",
+                                "output_size", "out_time_seconds",
+                                "eta_seconds", "progress_at"]
 
 
 import os
@@ -72,9 +192,35 @@ import time
 import sqlite3
 import argparse
 import subprocess
+import concurrent.futures
+import threading
+import signal
+import atexit
+import select
+import struct
+import ctypes
+import ctypes.util
+import stat
+import heapq
+import json
+import shutil
+import csv
+import socket
+import hashlib
+import re
+import http.server
 
 parser = argparse.ArgumentParser(description='Reencode video files with '
                                  'certain options')
+parser.add_argument('--database', metavar='file', action='store',
+                    help='Repository to use, share it between several '
+                    'nodes (default ~/.optimize_mkv.db)')
+parser.add_argument('--node', metavar='name', action='store',
+                    help='Name of this node in a shared repository '
+                    '(default host name)')
+parser.add_argument('--profile', action='store_true',
+                    help='Record time, SQL statements, file system calls '
+                    'and processes of every phase in run_history')
 subparsers = parser.add_subparsers(help='sub-command help', dest='command')
 parser_conf = subparsers.add_parser('config', aliases=['c', 'conf',
                                                        'configure'],
@@ -124,6 +270,25 @@ parser_conf.add_argument('-p', '--add-file-as-done', metavar='videofile',
                          'extension(s) as processed')
 parser_conf.add_argument('-r', '--folder-recursive', action='store_true',
                          help='If new folder, define the as recursive')
+parser_conf.add_argument('-s', '--add-application-option',
+                         metavar='application_option', action='store',
+                         nargs="+",
+                         help='Add or change application option(s). '
+                         'Use "key:value"')
+parser_conf.add_argument('-S', '--delete-application-option',
+                         metavar='application_option', action='store',
+                         nargs="+",
+                         help='Delete application option(s) by key')
+parser_conf.add_argument('-w', '--add-application-option-folder',
+                         metavar='application_option', action='store',
+                         nargs="+",
+                         help='Overwrite application option(s) for the '
+                         'provided folder(s). Use "key:value"')
+parser_conf.add_argument('-W', '--delete-application-option-folder',
+                         metavar='application_option', action='store',
+                         nargs="+",
+                         help='Delete application option(s) by key from the '
+                         'provided folder(s)')
 parser_exec = subparsers.add_parser('execute', aliases=['execute', 'exec', 'e',
                                                         'run', 'r'],
                                     help='Run optimization process')
@@ -133,6 +298,10 @@ parser_stat = subparsers.add_parser('statistics', aliases=['stats', 'stat',
                                                            's'],
                                     help='Show statistics and analyse '
                                     'repository')
+parser_watch = subparsers.add_parser('watch', aliases=['daemon', 'd'],
+                                     help='Keep running, watch folders and '
+                                     'optimize new files as soon as they are '
+                                     'complete')
 parser_clean = subparsers.add_parser('cleanup', aliases=['cleanup', 'clean',
                                                         'u'],
                                     help='Cleanup and sync database with files')
@@ -145,6 +314,45 @@ if MyName.endswith(".py"):
 
 homepath = os.getenv('HOME')
 databasename = os.path.join(homepath, "." + MyName + ".db")
+if args.database:
+    databasename = args.database
+
+# Several nodes can process the files of one repository, each claims
+# files with a lease renewed while encoding
+nodeName = args.node or socket.gethostname()
+
+activityLogBuffer = []
+activityLogLastFlush = time.time()
+activityLogLock = threading.Lock()
+
+# Set once ffprobe was not found, so it is reported only once per run
+probeProgramMissing = False
+
+# Duration of the last scan of this process for the metrics
+lastScanInfo = None
+metricsWrittenAt = 0
+
+# Counters per phase while profiling, None if not profiling
+profileCounters = None
+profilePhase = None
+profileLock = threading.Lock()
+
+# inotify events (see inotify(7)) used by the watch command
+inotify_modify = 0x00000002
+inotify_attrib = 0x00000004
+inotify_close_write = 0x00000008
+inotify_moved_to = 0x00000080
+inotify_create = 0x00000100
+inotify_delete_self = 0x00000400
+inotify_q_overflow = 0x00004000
+inotify_ignored = 0x00008000
+inotify_onlydir = 0x01000000
+inotify_isdir = 0x40000000
+inotify_file_mask = (inotify_modify | inotify_attrib | inotify_close_write |
+                     inotify_moved_to | inotify_create)
+inotify_folder_mask = (inotify_file_mask | inotify_delete_self |
+                       inotify_onlydir)
+libc = None
 
 
 def InitializeDatabase(databasename):
@@ -177,7 +385,8 @@ def InitializeDatabase(databasename):
               "real_folder_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "
               "watch_folder_id INTEGER NOT NULL REFERENCES watch_folder "
               "(watch_folder_id) ON DELETE CASCADE ON UPDATE CASCADE, "
-              "real_folder_name TEXT NOT NULL UNIQUE)")
+              "real_folder_name TEXT NOT NULL UNIQUE, "
+              "folder_mtime_ns INTEGER, folder_inode INTEGER)")
     c.execute("CREATE TABLE folder_ignore_extension ("
               "watch_folder_id INTEGER NOT NULL REFERENCES watch_folder "
               "(watch_folder_id) ON DELETE CASCADE ON UPDATE CASCADE, "
@@ -193,6 +402,9 @@ def InitializeDatabase(databasename):
               "optimization_started_at TEXT, optimized_extension TEXT, "
               "optimized_size UNSIGNED BIGINT, optimized_file_date TEXT, "
               "runtime_seconds INTEGER, file_status TINYINT NOT NULL, "
+              "encode_options TEXT, skip_reason TEXT, "
+              "lease_node TEXT, lease_expires_at REAL, encode_node TEXT, "
+              "predicted_size UNSIGNED BIGINT, "
               "PRIMARY KEY (real_folder_id, file_name))")
     c.execute("CREATE TABLE folder_option ("
               "watch_folder_id INTEGER NOT NULL REFERENCES watch_folder "
@@ -205,7 +417,21 @@ def InitializeDatabase(databasename):
               "default_option TEXT NOT NULL)")
     c.execute("CREATE TABLE current_running ("
               "started_at TEXT NOT NULL PRIMARY KEY, "
-              "pid UNSIGNED INTEGER NOT NULL)")
+              "pid UNSIGNED INTEGER NOT NULL, "
+              "worker_count UNSIGNED INTEGER NOT NULL DEFAULT 1, "
+              "node_name TEXT NOT NULL DEFAULT '', heartbeat_at REAL)")
+    c.execute("CREATE TABLE running_job ("
+              "real_folder_id INTEGER NOT NULL REFERENCES real_folder "
+              "(real_folder_id) ON DELETE CASCADE ON UPDATE CASCADE, "
+              "file_name TEXT NOT NULL, "
+              "worker_slot UNSIGNED INTEGER NOT NULL, "
+              "pid UNSIGNED INTEGER NOT NULL, "
+              "started_at TEXT NOT NULL, "
+              "frame UNSIGNED BIGINT, fps REAL, speed REAL, "
+              "bitrate_kbps REAL, output_size UNSIGNED BIGINT, "
+              "out_time_seconds REAL, eta_seconds REAL, progress_at TEXT, "
+              "node_name TEXT, "
+              "PRIMARY KEY (real_folder_id, file_name))")
     c.execute("CREATE TABLE activity_log ("
               "log_ts TEXT NOT NULL, "
               "activity_text TEXT NOT NULL)")
@@ -216,6 +442,21 @@ def InitializeDatabase(databasename):
     c.execute("CREATE TABLE application_option ("
               "option_key TEXT NOT NULL PRIMARY KEY, "
               "option_value TEXT NOT NULL)")
+    c.execute("CREATE TABLE folder_application_option ("
+              "watch_folder_id INTEGER NOT NULL REFERENCES watch_folder "
+              "(watch_folder_id) ON DELETE CASCADE ON UPDATE CASCADE, "
+              "option_key TEXT NOT NULL, "
+              "option_value TEXT NOT NULL, "
+              "PRIMARY KEY (watch_folder_id, option_key))")
+    createRepositoryIndexes(c)
+    createFileStatistics(c)
+    createFileProbe(c)
+    createEncodeHistory(c)
+    createFileSegment(c)
+    createFileFingerprint(c)
+    createFileQuality(c)
+    createRunHistory(c)
+    createFileRendition(c)
     c.execute("INSERT INTO repository_version (version_number) "
               "VALUES (?)", [current_repository_version, ])
     c.executemany("INSERT INTO default_option VALUES (?, ?)",
@@ -228,9 +469,262 @@ def InitializeDatabase(databasename):
         print("Added application option \"{}\" = \"{}\"".format(key, value))
 
     conn.commit()
+
     conn.close()
 
 
+def createRepositoryIndexes(c):
+    """
+    Secondary indexes of the repository tables (repository version 6)
+    """
+
+    # Queue per real folder, cleanup per status
+    c.execute("CREATE INDEX folder_optimize_file_status "
+              "ON folder_optimize_file (file_status, real_folder_id, "
+              "file_name)")
+    c.execute("CREATE INDEX real_folder_watch_folder "
+              "ON real_folder (watch_folder_id)")
+    c.execute("CREATE INDEX activity_log_ts ON activity_log (log_ts)")
+
+
+def createEncodeHistory(c):
+    """
+    History of finished encodes with their speed, per file and option set
+    (repository version 9). It outlives the files, so no foreign key.
+    """
+
+    c.execute("CREATE TABLE encode_history ("
+              "real_folder_id INTEGER NOT NULL, "
+              "file_name TEXT NOT NULL, "
+              "encode_options TEXT NOT NULL, "
+              "started_at TEXT NOT NULL, "
+              "finished_at TEXT NOT NULL, "
+              "return_code INTEGER NOT NULL, "
+              "runtime_seconds REAL NOT NULL, "
+              "original_size UNSIGNED BIGINT, "
+              "output_size UNSIGNED BIGINT, "
+              "media_seconds REAL, "
+              "frame_count UNSIGNED BIGINT, "
+              "average_fps REAL, "
+              "average_speed REAL, "
+              "node_name TEXT)")
+    c.execute("CREATE INDEX encode_history_options "
+              "ON encode_history (encode_options)")
+    c.execute("CREATE INDEX encode_history_file "
+              "ON encode_history (real_folder_id, file_name)")
+
+
+def createFileSegment(c):
+    """
+    Segments of files encoded in segmented mode, finished segments are not
+    encoded again after a restart (repository version 10)
+    """
+
+    c.execute("CREATE TABLE file_segment ("
+              "real_folder_id INTEGER NOT NULL, "
+              "file_name TEXT NOT NULL, "
+              "segment_number UNSIGNED INTEGER NOT NULL, "
+              "segment_file TEXT NOT NULL, "
+              "start_seconds REAL NOT NULL, "
+              "end_seconds REAL NOT NULL, "
+              "segment_size UNSIGNED BIGINT NOT NULL, "
+              "encoded_size UNSIGNED BIGINT, "
+              "runtime_seconds REAL, "
+              "segment_status TINYINT NOT NULL, "
+              "PRIMARY KEY (real_folder_id, file_name, segment_number), "
+              "FOREIGN KEY (real_folder_id, file_name) "
+              "REFERENCES folder_optimize_file (real_folder_id, file_name) "
+              "ON DELETE CASCADE ON UPDATE CASCADE)")
+
+
+def createFileFingerprint(c):
+    """
+    Fingerprints of source files to encode identical files only once
+    (repository version 12). A fingerprint is valid as long as size and
+    date of the file are unchanged, it is kept after optimization.
+    """
+
+    c.execute("CREATE TABLE file_fingerprint ("
+              "real_folder_id INTEGER NOT NULL, "
+              "file_name TEXT NOT NULL, "
+              "file_size UNSIGNED BIGINT NOT NULL, "
+              "file_date TEXT NOT NULL, "
+              "sample_hash TEXT NOT NULL, "
+              "full_hash TEXT, "
+              "PRIMARY KEY (real_folder_id, file_name), "
+              "FOREIGN KEY (real_folder_id, file_name) "
+              "REFERENCES folder_optimize_file (real_folder_id, file_name) "
+              "ON DELETE CASCADE ON UPDATE CASCADE)")
+    c.execute("CREATE INDEX file_fingerprint_sample "
+              "ON file_fingerprint (file_size, sample_hash)")
+    c.execute("CREATE INDEX folder_optimize_file_size "
+              "ON folder_optimize_file (original_size)")
+
+
+def createFileQuality(c):
+    """
+    Crf chosen by the quality search of a file (repository version 13).
+    Valid as long as size and date of the file and the search options are
+    unchanged, it is kept after optimization.
+    """
+
+    c.execute("CREATE TABLE file_quality ("
+              "real_folder_id INTEGER NOT NULL, "
+              "file_name TEXT NOT NULL, "
+              "file_size UNSIGNED BIGINT NOT NULL, "
+              "file_date TEXT NOT NULL, "
+              "search_options TEXT NOT NULL, "
+              "quality_metric TEXT NOT NULL, "
+              "crf TEXT NOT NULL, "
+              "quality_score REAL, "
+              "search_seconds REAL, "
+              "searched_at TEXT NOT NULL, "
+              "PRIMARY KEY (real_folder_id, file_name), "
+              "FOREIGN KEY (real_folder_id, file_name) "
+              "REFERENCES folder_optimize_file (real_folder_id, file_name) "
+              "ON DELETE CASCADE ON UPDATE CASCADE)")
+
+
+def createRunHistory(c):
+    """
+    Profile of runs with --profile (repository version 15), the counters
+    of every phase are kept as JSON
+    """
+
+    c.execute("CREATE TABLE run_history ("
+              "run_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "
+              "node_name TEXT NOT NULL, "
+              "command TEXT, "
+              "started_at TEXT NOT NULL, "
+              "finished_at TEXT NOT NULL, "
+              "wall_seconds REAL NOT NULL, "
+              "cpu_seconds REAL NOT NULL, "
+              "child_cpu_seconds REAL NOT NULL, "
+              "phase_info TEXT NOT NULL)")
+    c.execute("CREATE INDEX run_history_started "
+              "ON run_history (started_at)")
+
+
+def createFileRendition(c):
+    """
+    Additional outputs (renditions) encoded together with the optimized
+    file of a source (repository version 16). The output files are known
+    by the scan, so they are not optimized themselves.
+    """
+
+    c.execute("CREATE TABLE file_rendition ("
+              "real_folder_id INTEGER NOT NULL, "
+              "file_name TEXT NOT NULL, "
+              "rendition_name TEXT NOT NULL, "
+              "rendition_file_name TEXT NOT NULL, "
+              "rendition_extension TEXT NOT NULL, "
+              "encode_options TEXT NOT NULL, "
+              "rendition_size UNSIGNED BIGINT, "
+              "rendition_status TINYINT NOT NULL, "
+              "finished_at TEXT NOT NULL, "
+              "PRIMARY KEY (real_folder_id, file_name, rendition_name), "
+              "FOREIGN KEY (real_folder_id, file_name) "
+              "REFERENCES folder_optimize_file (real_folder_id, file_name) "
+              "ON DELETE CASCADE ON UPDATE CASCADE)")
+    c.execute("CREATE INDEX file_rendition_file "
+              "ON file_rendition (real_folder_id, rendition_file_name)")
+
+
+def createFileProbe(c):
+    """
+    Cache of ffprobe results of source files (repository version 8).
+    A probe is valid as long as size and date of the file are unchanged.
+    """
+
+    c.execute("CREATE TABLE file_probe ("
+              "real_folder_id INTEGER NOT NULL, "
+              "file_name TEXT NOT NULL, "
+              "file_size UNSIGNED BIGINT NOT NULL, "
+              "file_date TEXT NOT NULL, "
+              "probed_at TEXT NOT NULL, "
+              "format_name TEXT, duration_seconds REAL, bit_rate INTEGER, "
+              "video_codec TEXT, video_bitrate INTEGER, "
+              "width INTEGER, height INTEGER, frame_count INTEGER, "
+              "stream_info TEXT, probe_error TEXT, "
+              "PRIMARY KEY (real_folder_id, file_name), "
+              "FOREIGN KEY (real_folder_id, file_name) "
+              "REFERENCES folder_optimize_file (real_folder_id, file_name) "
+              "ON DELETE CASCADE ON UPDATE CASCADE)")
+
+
+def fileStatisticsTriggerSql(row, sign):
+    """
+    Statements of a trigger to add (sign "+") or remove (sign "-") one row
+    of folder_optimize_file (row "NEW" or "OLD") to/from file_statistics
+    """
+
+    key = ("real_folder_id = {0}.real_folder_id "
+           "AND original_extension = {0}.original_extension "
+           "AND encode_options = COALESCE({0}.encode_options, '') "
+           "AND file_status = {0}.file_status".format(row))
+
+    return("INSERT OR IGNORE INTO file_statistics (real_folder_id, "
+           "original_extension, encode_options, file_status) "
+           "VALUES ({0}.real_folder_id, {0}.original_extension, "
+           "COALESCE({0}.encode_options, ''), {0}.file_status); "
+           "UPDATE file_statistics SET "
+           "file_count = file_count {1} 1, "
+           "original_size = original_size {1} {0}.original_size, "
+           "optimized_size = optimized_size {1} "
+           "COALESCE({0}.optimized_size, 0), "
+           "timed_size = timed_size {1} CASE WHEN {0}.runtime_seconds > 0 "
+           "THEN {0}.original_size ELSE 0 END, "
+           "runtime_seconds = runtime_seconds {1} "
+           "MAX(COALESCE({0}.runtime_seconds, 0), 0) "
+           "WHERE {2}; ".format(row, sign, key))
+
+
+def createFileStatistics(c):
+    """
+    Summary of folder_optimize_file per real folder, source extension,
+    encoder options and status (repository version 7).
+    Kept up to date by triggers, so statistics never read the whole
+    folder_optimize_file table. Rows of deleted real folders are ignored
+    by joining with real_folder.
+    """
+
+    c.execute("CREATE TABLE file_statistics ("
+              "real_folder_id INTEGER NOT NULL, "
+              "original_extension TEXT NOT NULL, "
+              "encode_options TEXT NOT NULL, "
+              "file_status TINYINT NOT NULL, "
+              "file_count INTEGER NOT NULL DEFAULT 0, "
+              "original_size INTEGER NOT NULL DEFAULT 0, "
+              "optimized_size INTEGER NOT NULL DEFAULT 0, "
+              "timed_size INTEGER NOT NULL DEFAULT 0, "
+              "runtime_seconds REAL NOT NULL DEFAULT 0, "
+              "PRIMARY KEY (real_folder_id, original_extension, "
+              "encode_options, file_status))")
+    c.execute("CREATE TRIGGER file_statistics_insert AFTER INSERT "
+              "ON folder_optimize_file BEGIN " +
+              fileStatisticsTriggerSql("NEW", "+") + "END")
+    c.execute("CREATE TRIGGER file_statistics_delete AFTER DELETE "
+              "ON folder_optimize_file BEGIN " +
+              fileStatisticsTriggerSql("OLD", "-") + "END")
+    c.execute("CREATE TRIGGER file_statistics_update AFTER UPDATE OF "
+              "real_folder_id, original_extension, encode_options, "
+              "file_status, original_size, optimized_size, runtime_seconds "
+              "ON folder_optimize_file BEGIN " +
+              fileStatisticsTriggerSql("OLD", "-") +
+              fileStatisticsTriggerSql("NEW", "+") + "END")
+    c.execute("INSERT INTO file_statistics (real_folder_id, "
+              "original_extension, encode_options, file_status, file_count, "
+              "original_size, optimized_size, timed_size, runtime_seconds) "
+              "SELECT real_folder_id, original_extension, "
+              "COALESCE(encode_options, ''), file_status, COUNT(*), "
+              "SUM(original_size), SUM(COALESCE(optimized_size, 0)), "
+              "SUM(CASE WHEN runtime_seconds > 0 THEN original_size "
+              "ELSE 0 END), SUM(MAX(COALESCE(runtime_seconds, 0), 0)) "
+              "FROM folder_optimize_file "
+              "GROUP BY real_folder_id, original_extension, "
+              "COALESCE(encode_options, ''), file_status")
+
+
 def checkWatchFolderExists(conn, checkFolder):
     """
     Check if watch folder or subtree already exists as watch folder or
@@ -349,6 +843,8 @@ def deleteIgnoreExtension(conn, thisFolder, Ext):
                   "SELECT watch_folder_id "
                   "FROM watch_folder WHERE watch_folder_name = ?) "
                   "and ignore_extension = ?", [thisFolder, Ext])
+        # Files ignored so far have to be found by the next scan
+        resetFolderScanState(conn, thisFolder)
         print("Deleted ignore extension \"{}\" from "
               "folder \"{}\"".format(Ext, thisFolder))
         writeActivityLog(conn, "Deleted ignore extension \"{}\" from "
@@ -398,7 +894,7 @@ def deleteDefaultOption(conn, Option):
     c = conn.cursor()
 
     if ":" in Option:
-        thisOptionId, thisOption = Option.split(":")
+        thisOptionId, thisOption = Option.split(":", 1)
     else:
         thisOptionId = Option
         thisOption = ""
@@ -427,7 +923,7 @@ def insertNewDefaultOption(conn, Option):
     thisOptionId = False
 
     if ":" in Option:
-        thisOptionId, thisOption = Option.split(":")
+        thisOptionId, thisOption = Option.split(":", 1)
         if not thisOption:
             unset(thisOptionId)
             print("Error, default option \"{}\" must have a value"
@@ -470,7 +966,7 @@ def deleteFolderOption(conn, thisFolder, Option):
     thisFolderId = GetWatchFolderId(conn, thisFolder)
 
     if ":" in Option:
-        thisOptionId, thisOption = Option.split(":")
+        thisOptionId, thisOption = Option.split(":", 1)
     else:
         thisOptionId = Option
         thisOption = ""
@@ -504,7 +1000,7 @@ def insertNewFolderOption(conn, thisFolder, Option):
     thisFolderId = GetWatchFolderId(conn, thisFolder)
 
     if ":" in Option:
-        thisOptionId, thisOption = Option.split(":")
+        thisOptionId, thisOption = Option.split(":", 1)
     else:
         thisOptionId = Option
         thisOption = ""
@@ -559,6 +1055,141 @@ def insertNewFolderOption(conn, thisFolder, Option):
     c.close()
 
 
+def deleteApplicationOption(conn, Option):
+    """
+    Check if application option exists and delete
+    """
+
+    c = conn.cursor()
+
+    thisOptionKey = Option.split(":", 1)[0]
+
+    c.execute("SELECT 1 FROM application_option "
+              "WHERE option_key = ? ", [thisOptionKey])
+    if c.fetchone():
+        c.execute("DELETE FROM application_option "
+                  "WHERE option_key = ?", [thisOptionKey])
+        print("Deleted application option \"{}\"".format(thisOptionKey))
+        writeActivityLog(conn, "Deleted application option \"{}\""
+                         .format(thisOptionKey))
+    else:
+        print("Application option \"{}\" does not exist"
+              .format(thisOptionKey))
+
+    c.close()
+
+
+def insertNewApplicationOption(conn, Option):
+    """
+    Check if application option already exists and insert or update it
+    """
+
+    c = conn.cursor()
+
+    if ":" not in Option or not Option.split(":", 1)[1]:
+        print("Error, application option \"{}\" must have a value"
+              .format(Option))
+        c.close()
+        return
+
+    thisOptionKey, thisOption = Option.split(":", 1)
+
+    c.execute("SELECT 1 FROM application_option "
+              "WHERE option_key = ? ", [thisOptionKey])
+    if not c.fetchone():
+        c.execute("INSERT INTO application_option (option_key, option_value) "
+                  "VALUES (?, ?)", [thisOptionKey, thisOption])
+        print("Added application option \"{}\" = \"{}\""
+              .format(thisOptionKey, thisOption))
+        writeActivityLog(conn, "Added application option \"{}\" = \"{}\""
+                         .format(thisOptionKey, thisOption))
+    else:
+        c.execute("UPDATE application_option "
+                  "SET option_value = ? "
+                  "WHERE option_key = ?", [thisOption, thisOptionKey])
+        print("Application option \"{}\" changed to value \"{}\""
+              .format(thisOptionKey, thisOption))
+        writeActivityLog(conn, "Application option \"{}\" changed to value "
+                         "\"{}\"".format(thisOptionKey, thisOption))
+
+    c.close()
+
+
+def deleteFolderApplicationOption(conn, thisFolder, Option):
+    """
+    Check if application option exists for given folder and delete
+    """
+
+    c = conn.cursor()
+
+    thisFolderId = GetWatchFolderId(conn, thisFolder)
+    thisOptionKey = Option.split(":", 1)[0]
+
+    c.execute("SELECT 1 FROM folder_application_option "
+              "WHERE watch_folder_id = ? "
+              "AND option_key = ? ", [thisFolderId, thisOptionKey])
+    if c.fetchone():
+        c.execute("DELETE FROM folder_application_option "
+                  "WHERE watch_folder_id = ? "
+                  "AND option_key = ?", [thisFolderId, thisOptionKey])
+        print("Deleted application option \"{}\" from "
+              "folder \"{}\"".format(thisOptionKey, thisFolder))
+        writeActivityLog(conn, "Deleted application option \"{}\" from "
+                         "folder \"{}\"".format(thisOptionKey, thisFolder))
+    else:
+        print("Application option \"{}\" does not exist for "
+              "folder \"{}\"".format(thisOptionKey, thisFolder))
+
+    c.close()
+
+
+def insertNewFolderApplicationOption(conn, thisFolder, Option):
+    """
+    Check if given application option in watch folder already exists and
+    insert or update it
+    """
+
+    c = conn.cursor()
+
+    thisFolderId = GetWatchFolderId(conn, thisFolder)
+
+    if not thisFolderId:
+        print("Folder \"{}\" is not in watch list".format(thisFolder))
+    elif ":" not in Option or not Option.split(":", 1)[1]:
+        print("Error, application option \"{}\" must have a value"
+              .format(Option))
+    else:
+        thisOptionKey, thisOption = Option.split(":", 1)
+
+        c.execute("SELECT 1 FROM folder_application_option "
+                  "WHERE watch_folder_id = ? "
+                  "AND option_key = ? ", [thisFolderId, thisOptionKey])
+        if not c.fetchone():
+            c.execute("INSERT INTO folder_application_option ("
+                      "watch_folder_id, option_key, option_value) "
+                      "VALUES (?, ?, ?)",
+                      [thisFolderId, thisOptionKey, thisOption])
+            print("Added application option \"{}\" with value \"{}\" to "
+                  "folder \"{}\"".format(thisOptionKey, thisOption,
+                                         thisFolder))
+            writeActivityLog(conn, "Added application option \"{}\" with "
+                             "value \"{}\" to folder \"{}\""
+                             .format(thisOptionKey, thisOption, thisFolder))
+        else:
+            c.execute("UPDATE folder_application_option "
+                      "SET option_value = ? "
+                      "WHERE watch_folder_id = ? AND option_key = ?",
+                      [thisOption, thisFolderId, thisOptionKey])
+            print("Application option \"{}\" replaced with value \"{}\" for "
+                  "folder \"{}\"".format(thisOptionKey, thisOption,
+                                         thisFolder))
+            writeActivityLog(conn, "Application option \"{}\" replaced with "
+                             "value \"{}\" for folder \"{}\""
+                             .format(thisOptionKey, thisOption, thisFolder))
+
+    c.close()
+
+
 def markFileAsDone(conn, real_folder_id, thisFolder, File):
     """
     Check if file already exists, then update to done else
@@ -572,6 +1203,7 @@ def markFileAsDone(conn, real_folder_id, thisFolder, File):
         absolutFile = os.path.join(thisFolder, File)
         fileName = os.path.splitext(File)[0]
         fileExt  = os.path.splitext(File)[1][1:]
+        countProfile("stat_calls", 2)
         fileSize = os.path.getsize(absolutFile)
         fileDate = datetime.fromtimestamp(os.path.getmtime(absolutFile)).strftime("%Y-%m-%d %H:%M:%S")
 
@@ -680,6 +1312,30 @@ def Configuration(databasename):
             for Option in args.add_option_folder:
                 insertNewFolderOption(conn, thisFolder, Option)
 
+    # Delete application option(s)
+    if args.delete_application_option:
+        for Option in args.delete_application_option:
+            deleteApplicationOption(conn, Option)
+
+    # insert application option(s)
+    if args.add_application_option:
+        for Option in args.add_application_option:
+            insertNewApplicationOption(conn, Option)
+
+    # Delete application option(s) from watch folder
+    if (folderlist and args.delete_application_option_folder
+            and args.delete_folder == False):
+        for thisFolder in folderlist:
+            for Option in args.delete_application_option_folder:
+                deleteFolderApplicationOption(conn, thisFolder, Option)
+
+    # insert application option(s) to watch folder
+    if (folderlist and args.add_application_option_folder
+            and args.delete_folder == False):
+        for thisFolder in folderlist:
+            for Option in args.add_application_option_folder:
+                insertNewFolderApplicationOption(conn, thisFolder, Option)
+
     # Find files and mark them based on extension as done
     if args.add_extension_as_done:
         c = conn.cursor()
@@ -695,9 +1351,11 @@ def Configuration(databasename):
                 foli[row[1]] = row[0]
 
         for thisFolder in foli.keys():
+            countProfile("directory_listings")
             for File in os.listdir(thisFolder):
                 markFileAsDone(conn, foli[thisFolder], thisFolder, File)
 
+    flushActivityLog(conn)
     conn.close()
 
 
@@ -711,10 +1369,61 @@ def GetWatchFolderId(conn, folderName):
     c.execute("SELECT watch_folder_id FROM watch_folder "
               "WHERE watch_folder_name = ?",
               [folderName])
+    row = c.fetchone()
+
+    c.close()
+
+    if row:
+        return(row[0])
+    return(None)
+
+
+def folderUnchanged(folderStat, folderMtimeNs, folderInode):
+    """
+    Compare directory mtime and inode with the state of the last scan
+    """
+
+    return(folderMtimeNs is not None
+           and folderStat.st_mtime_ns == folderMtimeNs
+           and folderStat.st_ino == folderInode)
+
+
+def updateFolderScanState(conn, thisRealFolderId, folderStat):
+    """
+    Remember directory mtime and inode after a complete scan of a folder.
+    A directory modified within the last seconds can still change within
+    the same timestamp, so it is not remembered and scanned again next time.
+    """
+
+    c = conn.cursor()
+
+    if time.time() - folderStat.st_mtime < 2:
+        folderMtimeNs, folderInode = None, None
+    else:
+        folderMtimeNs, folderInode = folderStat.st_mtime_ns, folderStat.st_ino
+
+    c.execute("UPDATE real_folder "
+              "SET folder_mtime_ns = ?, folder_inode = ? "
+              "WHERE real_folder_id = ?",
+              [folderMtimeNs, folderInode, thisRealFolderId])
 
     c.close()
 
-    return(c.fetchone()[0])
+
+def resetFolderScanState(conn, thisFolder):
+    """
+    Force a full scan of all real folders of a watch folder next time
+    """
+
+    c = conn.cursor()
+
+    c.execute("UPDATE real_folder "
+              "SET folder_mtime_ns = NULL, folder_inode = NULL "
+              "WHERE watch_folder_id = ("
+              "SELECT watch_folder_id "
+              "FROM watch_folder WHERE watch_folder_name = ?)", [thisFolder])
+
+    c.close()
 
 
 def InsertNewRealFolder(conn, watchFolderId, folderName):
@@ -737,6 +1446,63 @@ def InsertNewRealFolder(conn, watchFolderId, folderName):
     c.close()
 
 
+def isSegmentFolder(folderName):
+    """
+    Folders holding the segments of a file are no real folders
+    """
+
+    return(folderName.startswith(".") and
+           folderName.endswith(segment_folder_suffix))
+
+
+def walkRealFolders(conn, watchFolderId, watchFolderName):
+    """
+    Walk the tree of a recursive watch folder and register new subfolders.
+    Folders unchanged since their last scan are not listed again, their
+    subfolders are taken from the repository instead.
+    """
+
+    c = conn.cursor()
+
+    knownFolders = {}
+    subFolders = {}
+
+    c.execute("SELECT real_folder_name, folder_mtime_ns, folder_inode "
+              "FROM real_folder WHERE watch_folder_id = ?", [watchFolderId])
+    for thisFolder, folderMtimeNs, folderInode in c.fetchall():
+        knownFolders[thisFolder] = (folderMtimeNs, folderInode)
+        subFolders.setdefault(os.path.normpath(os.path.dirname(thisFolder)),
+                              []).append(thisFolder)
+
+    c.close()
+
+    stack = [watchFolderName]
+    while stack:
+        thisFolder = stack.pop()
+        try:
+            countProfile("stat_calls")
+            folderStat = os.stat(thisFolder)
+        except OSError:
+            continue
+
+        if thisFolder not in knownFolders:
+            InsertNewRealFolder(conn, watchFolderId, thisFolder)
+        elif folderUnchanged(folderStat, *knownFolders[thisFolder]):
+            stack.extend(subFolders.get(os.path.normpath(thisFolder), []))
+            continue
+
+        try:
+            countProfile("directory_listings")
+            with os.scandir(thisFolder) as entries:
+                for entry in entries:
+                    # same as os.walk, don't follow symbolic links
+                    if (entry.is_dir(follow_symlinks=False) and
+                            not isSegmentFolder(entry.name)):
+                        stack.append(os.path.join(thisFolder, entry.name))
+        except OSError:
+            continue
+
+
 def IdentifyNewRealFolders(conn):
     """
     Based on watch folders generate list of real folders
@@ -748,28 +1514,53 @@ def IdentifyNewRealFolders(conn):
               "recursive_yn FROM watch_folder")
     watchFolders = c.fetchall()
     for row in watchFolders:
+        countProfile("stat_calls")
         if not os.path.exists(row[1]):
             continue
 
         if row[2] == 0:
             InsertNewRealFolder(conn, row[0], row[1])
         elif row[2] == 1:
-            for root, dirs, files in os.walk(row[1]):
-                InsertNewRealFolder(conn, row[0], root)
+            walkRealFolders(conn, row[0], row[1])
+
+    c.close()
+
+
+def loadFolderIgnoreExtensions(conn):
+    """
+    Load the extensions to ignore of all watch folders
+    """
+
+    c = conn.cursor()
+
+    folderIgnoreExtensions = {}
+
+    c.execute("SELECT watch_folder_id, ignore_extension "
+              "FROM folder_ignore_extension")
+    for thisWatchFolderId, thisExtension in c.fetchall():
+        folderIgnoreExtensions.setdefault(thisWatchFolderId,
+                                          set()).add(thisExtension)
 
     c.close()
 
+    return(folderIgnoreExtensions)
+
 
 def IdentifyNewFiles(databasename):
     """
     Check in registered folders for new arrived files and add them to
     repository database.
+    Folders whose directory has not changed since the last scan can't
+    contain new files and are skipped.
     """
 
+    global lastScanInfo
+
     conn = openDatabase(databasename)
     c = conn.cursor()
     c.execute("PRAGMA FOREIGN_KEYS = ON")
 
+    scanStart = time.time()
     writeActivityLog(conn, "Started IdentifyNewFiles")
 
     conn.commit()
@@ -777,584 +1568,4790 @@ def IdentifyNewFiles(databasename):
     # First, check if new folders have been created below our watch folders
     IdentifyNewRealFolders(conn)
 
-    c.execute("SELECT real_folder_id, watch_folder_id, real_folder_name "
+    c.execute("SELECT real_folder_id, watch_folder_id, real_folder_name, "
+              "folder_mtime_ns, folder_inode "
               "FROM real_folder")
 
     watchFolders = c.fetchall()
 
-    for thisRealFolderId, thisWatchFolderId, thisRealFolderName in watchFolders:
-        ignoreExtensions = []
+    folderIgnoreExtensions = loadFolderIgnoreExtensions(conn)
 
-        if not os.path.exists(thisRealFolderName):
+    skippedFolders = 0
+
+    for (thisRealFolderId, thisWatchFolderId, thisRealFolderName,
+            thisFolderMtimeNs, thisFolderInode) in watchFolders:
+        try:
+            countProfile("stat_calls")
+            folderStat = os.stat(thisRealFolderName)
+        except OSError:
+            continue
+
+        if folderUnchanged(folderStat, thisFolderMtimeNs, thisFolderInode):
+            skippedFolders += 1
             continue
 
-        for row2 in c.execute("SELECT ignore_extension "
-                              "FROM folder_ignore_extension "
-                              "WHERE watch_folder_id = ?",
-                              [thisWatchFolderId, ]):
-            ignoreExtensions.append(row2[0])
-
-        for File in os.listdir(thisRealFolderName):
-            absolutFile = os.path.join(thisRealFolderName, File)
-
-            if (os.path.splitext(File)[1][1:] not in ignoreExtensions
-                    and not File.startswith(".")
-                    and os.path.isfile(absolutFile)):
-                c.execute("SELECT 1 FROM folder_optimize_file "
-                          "WHERE real_folder_id = ? AND file_name = ?",
-                          [thisRealFolderId, os.path.splitext(File)[0]])
-                if not c.fetchone():
-                    fileSize = os.path.getsize(absolutFile)
-                    fileDate = datetime.fromtimestamp(os.path.getmtime(absolutFile)).strftime("%Y-%m-%d %H:%M:%S")
+        ignoreExtensions = folderIgnoreExtensions.get(thisWatchFolderId, ())
+
+        # Reconcile the whole folder at once: known names in one query,
+        # the difference to the directory listing in one transaction
+        c.execute("SELECT file_name FROM folder_optimize_file "
+                  "WHERE real_folder_id = ? "
+                  "UNION ALL SELECT rendition_file_name FROM file_rendition "
+                  "WHERE real_folder_id = ?",
+                  [thisRealFolderId, thisRealFolderId])
+        knownFiles = set(row[0] for row in c.fetchall())
+
+        newFiles = []
+        logMessages = []
+
+        try:
+            countProfile("directory_listings")
+            with os.scandir(thisRealFolderName) as entries:
+                for entry in entries:
+                    fileName, fileExt = os.path.splitext(entry.name)
+                    if (fileExt[1:] in ignoreExtensions
+                            or entry.name.startswith(".")
+                            or fileName in knownFiles):
+                        continue
                     try:
-                        c.execute("INSERT INTO folder_optimize_file ("
-                                  "real_folder_id, file_name, "
-                                  "original_extension, "
-                                  "original_first_seen_at, original_size, "
-                                  "original_file_date, file_status) "
-                                  "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                  [thisRealFolderId, os.path.splitext(File)[0],
-                                    os.path.splitext(File)[1][1:],
-                                    datetime.now(),
-                                    fileSize, fileDate, 0])
-                    except sqlite3.IntegrityError as e:
-                        writeActivityLog(conn, "Ho, foreign key to real "
-                                  "folder {} violated! Deleted in the "
-                                  "meantime?".format(thisRealFolderName))
-                    else:
-                        writeActivityLog(conn, "Added file {} to optimize list"
-                                  .format(os.path.join(thisRealFolderName,
-                                                       File)))
-
-    writeActivityLog(conn, "Finished IdentifyNewFiles")
+                        if not entry.is_file():
+                            continue
+                        countProfile("stat_calls")
+                        fileStat = entry.stat()
+                    except OSError:
+                        continue
+                    fileDate = datetime.fromtimestamp(fileStat.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+                    knownFiles.add(fileName)
+                    newFiles.append([thisRealFolderId, fileName, fileExt[1:],
+                                     datetime.now(), fileStat.st_size,
+                                     fileDate, 0])
+                    logMessages.append("Added file {} to optimize list"
+                                       .format(entry.path))
+        except OSError:
+            continue
 
-    conn.commit()
+        if newFiles:
+            try:
+                # Other nodes might have added the same file meanwhile
+                c.executemany("INSERT OR IGNORE INTO folder_optimize_file ("
+                              "real_folder_id, file_name, "
+                              "original_extension, "
+                              "original_first_seen_at, original_size, "
+                              "original_file_date, file_status) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?)", newFiles)
+            except sqlite3.IntegrityError as e:
+                conn.rollback()
+                writeActivityLog(conn, "Ho, foreign key to real "
+                                 "folder {} violated! Deleted in the "
+                                 "meantime?".format(thisRealFolderName))
+                continue
+            writeActivityLogs(conn, logMessages)
+
+        updateFolderScanState(conn, thisRealFolderId, folderStat)
+        conn.commit()
+
+    writeActivityLog(conn, "Finished IdentifyNewFiles, skipped {} unchanged "
+                     "folders".format(skippedFolders))
+    lastScanInfo = {"seconds": time.time() - scanStart,
+                    "finishedAt": time.time(), "folders": len(watchFolders),
+                    "skippedFolders": skippedFolders}
+
+    flushActivityLog(conn)
     conn.close()
 
 
-def databaseMigration(conn, oldVersion):
+def probeNumber(value, convert=int):
     """
-    We have identified, the database version is old.
-    Start with doing the migration.
+    Convert a number out of ffprobe output, None if not available
     """
 
-    c = conn.cursor()
+    try:
+        return(convert(value))
+    except (TypeError, ValueError):
+        return(None)
 
-    if oldVersion < 2:
-        try:
-            c.execute("CREATE TABLE activity_log ("
-                      "log_ts TEXT NOT NULL, "
-                      "activity_text TEXT NOT NULL)")
-        except:
-            print("Error migrating to repository version 2")
-            sys.exit(1)
-        else:
-            c.execute("UPDATE repository_version SET version_number = 2")
 
-    if oldVersion < 3:
-        try:
-            c.execute("UPDATE folder_optimize_file "
-                      "SET optimized_file_date = SUBSTR(optimized_file_date, 1,"
-                      "19), original_file_date = SUBSTR(original_file_date, 1,"
-                      "19) "
-                      "WHERE length(optimized_file_date) > 19 "
-                      "OR length(original_file_date) > 19")
-        except:
-            print("Error migrating to repository version 3")
-            sys.exit(1)
-        else:
-            c.execute("UPDATE repository_version SET version_number = 3")
+def probeTag(stream, name):
+    """
+    Get a tag of a stream, also in its language specific variant
+    (mkvmerge writes e.g. "BPS-eng")
+    """
 
-    writeActivityLog(conn, "Successfully migrated database version from {} "
-                           "to {}".format(oldVersion,
-                                          current_repository_version))
+    for key, value in stream.get("tags", {}).items():
+        if key.upper() == name or key.upper().startswith(name + "-"):
+            return(value)
 
-    conn.commit()
-    c.close()
+    return(None)
 
 
-def openDatabase(databasename):
+def runProbe(probeProgram, inpfile):
     """
-    Every time we open the database, we check if a migration needs to
-    be done on it
+    Runs in a worker thread: probe one file with ffprobe and return the
+    interesting properties as dictionary, or the error as string
     """
 
-    conn = sqlite3.connect(databasename)
-    c = conn.cursor()
-    c.execute("PRAGMA FOREIGN_KEYS = ON")
+    try:
+        countProfile("process_spawns")
+        result = subprocess.run([probeProgram, "-v", "error",
+                                 "-print_format", "json", "-show_format",
+                                 "-show_streams", inpfile],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, timeout=300)
+    except FileNotFoundError:
+        raise
+    except (OSError, subprocess.SubprocessError) as e:
+        return(str(e))
+
+    if result.returncode:
+        return(result.stderr.decode(errors="replace").strip()[-500:] or
+               "{} ended with {}".format(probeProgram, result.returncode))
+
+    try:
+        probe = json.loads(result.stdout.decode(errors="replace"))
+    except ValueError as e:
+        return(str(e))
+
+    probeFormat = probe.get("format", {})
+    probeInfo = {"format_name": probeFormat.get("format_name"),
+                 "duration_seconds": probeNumber(probeFormat.get("duration"),
+                                                 float),
+                 "bit_rate": probeNumber(probeFormat.get("bit_rate")),
+                 "video_codec": None, "video_bitrate": None, "width": None,
+                 "height": None, "frame_count": None}
+
+    streams = []
+    for stream in probe.get("streams", []):
+        bitRate = probeNumber(stream.get("bit_rate") or
+                              probeTag(stream, "BPS"))
+        streams.append({"index": stream.get("index"),
+                        "codec_type": stream.get("codec_type"),
+                        "codec_name": stream.get("codec_name"),
+                        "bit_rate": bitRate,
+                        "channels": stream.get("channels"),
+                        "width": stream.get("width"),
+                        "height": stream.get("height"),
+                        "language": probeTag(stream, "LANGUAGE"),
+                        "title": probeTag(stream, "TITLE"),
+                        "default": stream.get("disposition", {})
+                                         .get("default", 0),
+                        "comment": stream.get("disposition", {})
+                                         .get("comment", 0)})
+
+        # first real video stream, no cover pictures
+        if (stream.get("codec_type") == "video" and
+                not stream.get("disposition", {}).get("attached_pic") and
+                probeInfo["video_codec"] is None):
+            probeInfo["video_codec"] = stream.get("codec_name")
+            probeInfo["video_bitrate"] = bitRate or probeInfo["bit_rate"]
+            probeInfo["width"] = stream.get("width")
+            probeInfo["height"] = stream.get("height")
+            frameCount = probeNumber(stream.get("nb_frames") or
+                                     probeTag(stream, "NUMBER_OF_FRAMES"))
+            if not frameCount and probeInfo["duration_seconds"]:
+                try:
+                    numerator, denominator = stream.get(
+                        "avg_frame_rate", "0/0").split("/")
+                    frameCount = int(probeInfo["duration_seconds"] *
+                                     int(numerator) / int(denominator))
+                except (ValueError, ZeroDivisionError):
+                    frameCount = None
+            probeInfo["frame_count"] = frameCount
 
-    c.execute("SELECT version_number FROM repository_version")
-    oldVersion = c.fetchone()[0]
-    if oldVersion < current_repository_version:
-        # Database version is old, need to migrate to newest version
-        databaseMigration(conn, oldVersion)
+    probeInfo["stream_info"] = json.dumps(streams)
 
-    c.close()
+    return(probeInfo)
 
-    return(conn)
 
+def probeResult(probeInfo):
+    """
+    The probe of a file as dictionary out of the result of runProbe, with
+    the streams out of stream_info
+    """
 
-def loadApplicationOption(conn):
+    if isinstance(probeInfo, str):
+        probeInfo = {"probe_error": probeInfo}
+
+    fileProbe = dict((column, probeInfo.get(column))
+                     for column in file_probe_columns)
+    fileProbe["streams"] = json.loads(fileProbe["stream_info"] or "[]")
+
+    return(fileProbe)
+
+
+def saveFileProbe(conn, job, fileProbe):
     """
-    For processing, we need some default options stored in table
+    Keep the probe of the file of a job in file_probe, for the size and
+    date of the file known to the repository
     """
 
     c = conn.cursor()
 
-    applicationOption = {}
-
-    c.execute("select option_key, option_value from application_option")
-    for key, value in c.fetchall():
-        applicationOption[key] = value
+    # Delete probes of older versions of the file first
+    c.execute("DELETE FROM file_probe "
+              "WHERE real_folder_id = ? AND file_name = ?",
+              [job["realFolderId"], job["fileName"]])
+    c.execute("INSERT INTO file_probe (real_folder_id, file_name, "
+              "file_size, file_date, probed_at, " +
+              ", ".join(file_probe_columns) + ") "
+              "SELECT real_folder_id, file_name, original_size, "
+              "original_file_date, ?, " +
+              ", ".join(["?"] * len(file_probe_columns)) + " "
+              "FROM folder_optimize_file "
+              "WHERE real_folder_id = ? AND file_name = ?",
+              [datetime.now()] + [fileProbe[column]
+                                  for column in file_probe_columns] +
+              [job["realFolderId"], job["fileName"]])
 
     c.close()
 
-    return(applicationOption)
-
 
-def checkExecution(conn):
+def hashFile(inpfile, fileSize, full=False):
     """
-    We can only have one process at a time, so check if one is already
-    running, and end gracefully if.
-    Mark as running if possible.
+    Runs in a worker thread: hash sampled blocks spread over the file
+    (including start and end) or the whole file.
+    Returns the hex digest or None if the file can't be read.
     """
 
-    c = conn.cursor()
-
-    c.execute("SELECT started_at, pid FROM current_running")
-    if c.fetchone():
-        print("Process already running. Exit gracefully!")
-        sys.exit(0)
+    digest = hashlib.sha256()
 
-    c.execute("INSERT INTO current_running (started_at, pid) VALUES"
-              "(?, ?)", [datetime.now(), os.getpid()])
+    try:
+        with open(inpfile, "rb") as f:
+            if full:
+                for block in iter(lambda: f.read(1024 ** 2), b""):
+                    digest.update(block)
+            else:
+                lastOffset = max(0, fileSize - fingerprint_block_size)
+                for number in range(fingerprint_sample_blocks):
+                    f.seek(lastOffset * number //
+                           (fingerprint_sample_blocks - 1))
+                    digest.update(f.read(fingerprint_block_size))
+    except OSError:
+        return(None)
 
-    conn.commit()
-    c.close()
+    return(digest.hexdigest())
 
 
-def loadDefaultOption(conn):
+def saveFileFingerprint(conn, job, sampleHash):
     """
-    Load default processing options to apply to every folder
+    Keep the hash of sampled blocks of the file of a job in
+    file_fingerprint, for the size and date of the file known to the
+    repository
     """
 
     c = conn.cursor()
 
-    defaultOption = {}
+    c.execute("INSERT OR REPLACE INTO file_fingerprint (real_folder_id, "
+              "file_name, file_size, file_date, sample_hash) "
+              "SELECT real_folder_id, file_name, original_size, "
+              "original_file_date, ? "
+              "FROM folder_optimize_file "
+              "WHERE real_folder_id = ? AND file_name = ?",
+              [sampleHash, job["realFolderId"], job["fileName"]])
+
+    c.close()
+
+
+def claimIdenticalFile(conn, job):
+    """
+    Look for source files with the same size and samples as the file of a
+    job, which are encoded with the same options, being encoded or still
+    waiting. If there are any, claim the file for reuseIdenticalFile in
+    the I/O pool. Returns True, if the file has been claimed.
+    """
+
+    c = conn.cursor()
+
+    thisRealFolderId = job["realFolderId"]
+    thisFileName = job["fileName"]
+    applicationOption = job["applicationOption"]
+
+    if applicationOption.get("deduplicate") not in ("link", "copy"):
+        c.close()
+        return(False)
+
+    c.execute("SELECT ff.sample_hash, ff.full_hash "
+              "FROM file_fingerprint AS ff "
+              "JOIN folder_optimize_file AS fof "
+              "ON fof.real_folder_id = ff.real_folder_id "
+              "AND fof.file_name = ff.file_name "
+              "AND fof.original_size = ff.file_size "
+              "AND fof.original_file_date = ff.file_date "
+              "WHERE ff.real_folder_id = ? AND ff.file_name = ?",
+              [thisRealFolderId, thisFileName])
+    row = c.fetchone()
+    if not row or not row[0]:
+        c.close()
+        return(False)
+    sampleHash, fullHash = row
+
+    c.execute("SELECT ff.real_folder_id, rf.real_folder_name, fof.file_name, "
+              "fof.file_status, fof.optimized_size, fof.optimized_file_date, "
+              "fof.encode_options, fof.original_extension, ff.full_hash "
+              "FROM file_fingerprint AS ff "
+              "JOIN folder_optimize_file AS fof "
+              "ON fof.real_folder_id = ff.real_folder_id "
+              "AND fof.file_name = ff.file_name "
+              "AND fof.original_size = ff.file_size "
+              "JOIN real_folder AS rf "
+              "ON rf.real_folder_id = ff.real_folder_id "
+              "WHERE ff.file_size = ? AND ff.sample_hash = ? "
+              "AND (ff.real_folder_id <> ? OR ff.file_name <> ?) "
+              "AND (fof.file_status = 0 OR (fof.file_status IN (1, 2) "
+              "AND fof.encode_options = ? "
+              "AND fof.optimized_extension = ?)) "
+              "ORDER BY fof.file_status",
+              [job["originalSize"], sampleHash, thisRealFolderId,
+               thisFileName, encodeOptionsText(job["options"]),
+               applicationOption["target_extension"]])
+    candidateFiles = c.fetchall()
+    if not candidateFiles:
+        c.close()
+        return(False)
+
+    leaseSeconds = getIntOption(applicationOption, "lease_seconds", 300)
+    c.execute("UPDATE folder_optimize_file "
+              "SET file_status = 2, lease_node = ?, lease_expires_at = ?, "
+              "    encode_node = ? "
+              "WHERE real_folder_id = ? AND file_name = ? "
+              "AND file_status = 0",
+              [nodeName, time.time() + leaseSeconds, nodeName,
+               thisRealFolderId, thisFileName])
+    if c.rowcount != 1:
+        conn.rollback()
+        c.close()
+        return(False)
+    conn.commit()
+    c.close()
+
+    logfile, inpfile, tgtfile, outfile = jobFiles(job)
+    job.update({"inpfile": inpfile, "tgtfile": tgtfile, "outfile": outfile,
+                "fullHash": fullHash, "candidateFiles": candidateFiles,
+                "leaseSeconds": leaseSeconds,
+                "leaseExpiresAt": time.time() + leaseSeconds})
+
+    return(True)
+
+
+def reuseIdenticalFile(job):
+    """
+    Runs in an I/O thread for a file claimed by claimIdenticalFile: reuse
+    the result of an identical source by hard link or copy, or tell to wait
+    while it is being encoded. Equal samples only point to candidates, a
+    file is identical only if the full hashes of both sources are equal.
+    Returns a dictionary with the outcome (reused, wait, encode or error)
+    and the full hashes computed on the way.
+    """
+
+    inpfile = job["inpfile"]
+    outfile = job["outfile"]
+    applicationOption = job["applicationOption"]
+    reuse = {"outcome": "encode", "identicalFile": None, "candidate": None,
+             "fullHashes": [], "messages": []}
+
+    # The samples match, only the whole file can tell
+    fullHash = job["fullHash"]
+    if fullHash is None:
+        fullHash = hashFile(inpfile, job["originalSize"], True)
+        if not fullHash:
+            return(reuse)
+        reuse["fullHashes"].append([fullHash, job["realFolderId"],
+                                    job["fileName"]])
+
+    for candidate in job["candidateFiles"]:
+        (thisIdenticalFolderId, thisIdenticalFolder, thisIdenticalName,
+         thisStatus, optimizedSize, optimizedFileDate, encodeOptions,
+         thisIdenticalExtension, identicalFullHash) = candidate
+        # A waiting copy only needs the full hash of this file, to match
+        # its result later
+        if thisStatus == 0:
+            continue
+        # The source of a file being encoded still exists, hash it now so
+        # its result can be reused later
+        identicalFile = os.path.join(thisIdenticalFolder, thisIdenticalName +
+                                     "." +
+                                     applicationOption["target_extension"])
+        if identicalFullHash is None and thisStatus == 2:
+            identicalFullHash = hashFile(os.path.join(
+                thisIdenticalFolder, thisIdenticalName + "." +
+                thisIdenticalExtension), job["originalSize"], True)
+            if not identicalFullHash:
+                # Finished meanwhile, its full hash is known next time
+                reuse.update({"outcome": "wait",
+                              "identicalFile": identicalFile})
+                return(reuse)
+            reuse["fullHashes"].append([identicalFullHash,
+                                        thisIdenticalFolderId,
+                                        thisIdenticalName])
+        if identicalFullHash is None or identicalFullHash != fullHash:
+            continue
+
+        reuse.update({"identicalFile": identicalFile,
+                      "candidate": candidate})
+        if thisStatus == 2:
+            reuse["outcome"] = "wait"
+            return(reuse)
+        try:
+            if os.path.getsize(identicalFile) != optimizedSize:
+                continue
+        except OSError:
+            continue
+
+        try:
+            if applicationOption["deduplicate"] == "link":
+                try:
+                    os.link(identicalFile, outfile)
+                except OSError:
+                    # e.g. on another file system
+                    shutil.copy2(identicalFile, outfile)
+            else:
+                shutil.copy2(identicalFile, outfile)
+            # The original is only removed once the result is in place
+            os.rename(outfile, job["tgtfile"])
+        except OSError as e:
+            try:
+                os.remove(outfile)
+            except OSError:
+                pass
+            reuse["outcome"] = "error"
+            reuse["messages"].append("Error reusing {} for file {}: {}"
+                                     .format(identicalFile, inpfile, e))
+            return(reuse)
+
+        reuse["outcome"] = "reused"
+        if inpfile != job["tgtfile"]:
+            try:
+                os.remove(inpfile)
+            except OSError:
+                reuse["messages"].append("Error, cannot remove ori file {}!"
+                                         .format(inpfile))
+        return(reuse)
+
+    return(reuse)
+
+
+def recordIdenticalFile(conn, job, reuse):
+    """
+    Record the outcome of reuseIdenticalFile. The file is set back to be
+    encoded, unless the result has been reused or an identical file is
+    being encoded.
+    Returns True, if the file must not be encoded now.
+    """
+
+    c = conn.cursor()
+
+    inpfile = job["inpfile"]
+    applicationOption = job["applicationOption"]
+
+    c.executemany("UPDATE file_fingerprint SET full_hash = ? "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  reuse["fullHashes"])
+    writeActivityLogs(conn, reuse["messages"])
+
+    if reuse["outcome"] == "reused":
+        (thisIdenticalFolderId, thisIdenticalFolder, thisIdenticalName,
+         thisStatus, optimizedSize, optimizedFileDate, encodeOptions,
+         thisIdenticalExtension, identicalFullHash) = reuse["candidate"]
+        c.execute("UPDATE folder_optimize_file "
+                  "SET file_status = 1, optimization_started_at = ?, "
+                  "optimized_extension = ?, optimized_size = ?, "
+                  "optimized_file_date = ?, runtime_seconds = 0, "
+                  "encode_options = ?, lease_node = NULL, "
+                  "lease_expires_at = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [datetime.now(), applicationOption["target_extension"],
+                   optimizedSize, optimizedFileDate, encodeOptions,
+                   job["realFolderId"], job["fileName"]])
+        writeActivityLog(conn, "File {} is identical to {}, reused its "
+                         "result".format(inpfile, reuse["identicalFile"]))
+    else:
+        c.execute("UPDATE folder_optimize_file "
+                  "SET file_status = 0, lease_node = NULL, "
+                  "lease_expires_at = NULL, encode_node = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ? "
+                  "AND lease_node = ?",
+                  [job["realFolderId"], job["fileName"], nodeName])
+        if reuse["outcome"] == "wait":
+            writeActivityLog(conn, "File {} is identical to {}, wait until "
+                             "it is encoded".format(inpfile,
+                                                    reuse["identicalFile"]))
+
+    conn.commit()
+    c.close()
+
+    return(reuse["outcome"] in ("reused", "wait"))
+
+
+def checkSkipFile(job, streamActions=None):
+    """
+    Check the probe of a job against the skip rules and return the reason
+    to skip it, or None. Video already in one of skip_video_codecs with a
+    bitrate of at most skip_video_kbps doesn't get smaller anymore.
+    Stream rules dropping or transcoding a stream are worth a run anyway,
+    and there's nothing to do if they copy all streams.
+    """
+
+    if streamActions:
+        if all(action in ("copy", "disabled") for action in streamActions):
+            return("stream rules copy all streams")
+        if any(action not in (None, "copy", "disabled")
+               for action in streamActions):
+            return(None)
+
+    fileProbe = job.get("probe")
+    if not fileProbe or not fileProbe["video_codec"]:
+        return(None)
+
+    skipCodecs = [codec.strip() for codec in job["applicationOption"].get(
+        "skip_video_codecs", "").split(",") if codec.strip()]
+    skipKbps = getIntOption(job["applicationOption"], "skip_video_kbps")
+
+    if (fileProbe["video_codec"] in skipCodecs and fileProbe["video_bitrate"]
+            and fileProbe["video_bitrate"] <= skipKbps * 1000):
+        return("video is already {} at {} kbps"
+               .format(fileProbe["video_codec"],
+                       fileProbe["video_bitrate"] // 1000))
+
+    return(None)
+
+
+def skipFile(conn, job, reason):
+    """
+    Mark the file of a job as skipped
+    """
+
+    c = conn.cursor()
+
+    c.execute("UPDATE folder_optimize_file "
+              "SET file_status = ?, skip_reason = ? "
+              "WHERE real_folder_id = ? AND file_name = ?",
+              [3, reason, job["realFolderId"], job["fileName"]])
+    writeActivityLog(conn, "Skipped file {} in folder {}: {}"
+                     .format(job["fileName"], job["realFolderName"], reason))
+
+    conn.commit()
+    c.close()
+
+
+def crfOptionKey(Options):
+    """
+    Key of the value following -crf in the options, or None
+    """
+
+    keys = sorted(Options)
+    for index, key in enumerate(keys[:-1]):
+        if Options[key] == "-crf":
+            return(keys[index + 1])
+
+    return(None)
+
+
+def qualitySearchOptions(job):
+    """
+    Settings of the crf search of a job as text, or None if the job keeps
+    its configured crf. A cached crf is only used for the same settings.
+    """
+
+    applicationOption = job["applicationOption"]
+    crfKey = crfOptionKey(job["options"])
+
+    if (getFloatOption(applicationOption, "quality_target") <= 0 or
+            crfKey is None or not isFfmpeg(job["options"]) or
+            not job.get("probe") or not job["probe"]["duration_seconds"] or
+            applicationOption.get("quality_metric") not in
+            quality_metric_filters):
+        return(None)
+
+    # Without the crf itself, it is replaced by the result
+    Options = dict(job["options"])
+    del Options[crfKey]
+
+    return("{} {} crf {}-{} samples {}x{}s {}".format(
+        applicationOption["quality_metric"],
+        getFloatOption(applicationOption, "quality_target"),
+        getIntOption(applicationOption, "quality_crf_min", 18),
+        getIntOption(applicationOption, "quality_crf_max", 30),
+        getIntOption(applicationOption, "quality_sample_count", 3),
+        getIntOption(applicationOption, "quality_sample_seconds", 10),
+        encodeOptionsText(Options)))
+
+
+def loadFileQuality(conn, job, searchOptions):
+    """
+    Return the crf found by an earlier quality search of a file with the
+    same settings, or None if the file has changed since
+    """
+
+    c = conn.cursor()
+
+    c.execute("SELECT fq.crf FROM file_quality AS fq "
+              "JOIN folder_optimize_file AS fof "
+              "ON fof.real_folder_id = fq.real_folder_id "
+              "AND fof.file_name = fq.file_name "
+              "AND fof.original_size = fq.file_size "
+              "AND fof.original_file_date = fq.file_date "
+              "WHERE fq.real_folder_id = ? AND fq.file_name = ? "
+              "AND fq.search_options = ?",
+              [job["realFolderId"], job["fileName"], searchOptions])
+    row = c.fetchone()
+
+    c.close()
+
+    return(row[0] if row else None)
+
+
+def applyCrf(job, crf):
+    """
+    Replace the crf in the options of a job. The options are shared
+    between the jobs of a watch folder, so the job gets its own copy.
+    """
+
+    Options = dict(job["options"])
+    Options[crfOptionKey(Options)] = str(crf)
+    job["options"] = Options
+
+
+def parseRenditions(renditionsText):
+    """
+    Parse the renditions option, a comma separated list of
+    "name:video codec:crf:height:extension[:audio codec]". Empty crf and
+    height keep the encoder default and the source height, the extension
+    defaults to target_extension and the audio codec to aac.
+    Returns the renditions and the invalid entries.
+    """
+
+    renditions = []
+    invalid = []
+
+    for entry in renditionsText.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        fields = entry.split(":")
+        name, codec, crf, height, extension, audioCodec = (
+            fields + [""] * 6)[:6]
+        if (len(fields) > 6 or not name or name.startswith(".") or
+                os.sep in name or not codec or
+                (crf and not crf.isdigit()) or
+                (height and not height.isdigit())):
+            invalid.append(entry)
+            continue
+
+        # Video and all audio of the source, subtitles rarely fit
+        Options = ["-map", "0:v:0", "-map", "0:a?", "-c:v", codec]
+        if crf:
+            Options.extend(["-crf", crf])
+        if height:
+            Options.extend(["-vf", "scale=-2:{}".format(height)])
+        Options.extend(["-c:a", audioCodec or "aac"])
+
+        renditions.append({"name": name, "options": Options,
+                           "extension": extension})
+
+    return(renditions, invalid)
+
+
+def parseStreamRules(rulesText):
+    """
+    Parse the stream_rules option, rules separated by ";" of
+    "type [condition ...]:action". The type is one of stream_rule_types,
+    conditions are codec=a,b lang=eng,ger (also !=), kbps, channels, width
+    and height compared with a number (e.g. kbps<=8000), title~text,
+    comment and default. The action is copy, drop or an encoder with an
+    optional bitrate (e.g. "libopus 256k").
+    Returns the rules and the invalid entries.
+    """
+
+    rules = []
+    invalid = []
+
+    for entry in rulesText.split(";"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        conditionText, separator, action = entry.partition(":")
+        words = conditionText.split()
+        action = action.split()
+        if (not separator or not words or words[0] not in stream_rule_types
+                or not action or len(action) > 2 or
+                (action[0] in ("copy", "drop") and len(action) > 1)):
+            invalid.append(entry)
+            continue
+
+        conditions = []
+        for word in words[1:]:
+            match = (re.match(r"(kbps|channels|width|height)(<=|>=|!=|<|>|=)"
+                              r"(\d+)$", word) or
+                     re.match(r"(codec|lang)(!=|=)(.+)$", word) or
+                     re.match(r"(title)(~)(.+)$", word) or
+                     re.match(r"(comment|default)()()$", word))
+            if not match:
+                break
+            conditions.append(match.groups())
+        else:
+            rules.append({"type": words[0], "conditions": conditions,
+                          "action": action})
+            continue
+        invalid.append(entry)
+
+    return(rules, invalid)
+
+
+def streamMatches(rule, stream):
+    """
+    Check if a probed stream fulfills the type and all conditions of a rule
+    """
+
+    if rule["type"] != "any" and stream["codec_type"] != rule["type"]:
+        return(False)
+
+    for key, operator, value in rule["conditions"]:
+        if key in ("codec", "lang"):
+            actual = stream["codec_name" if key == "codec" else "language"]
+            if (actual in value.split(",")) != (operator == "="):
+                return(False)
+        elif key == "title":
+            if value.lower() not in (stream["title"] or "").lower():
+                return(False)
+        elif key in ("comment", "default"):
+            if not stream[key]:
+                return(False)
+        else:
+            actual = stream["bit_rate"] if key == "kbps" else stream[key]
+            if actual is None:
+                return(False)
+            if key == "kbps":
+                actual = actual // 1000
+            if not stream_rule_comparisons[operator](actual, int(value)):
+                return(False)
+
+    return(True)
+
+
+def resolveStreamRules(rules, streams, Options):
+    """
+    Apply the first matching rule to every stream. Returns the ffmpeg
+    arguments mapping the kept streams with their codecs, and the action
+    per stream: None keeps the configured codec, "disabled" for streams
+    left out by the options (e.g. -dn).
+    """
+
+    disabledTypes = set(stream_type_disable_options[value]
+                        for value in Options.values()
+                        if value in stream_type_disable_options)
+
+    mapOptions = []
+    codecOptions = []
+    actions = []
+
+    for position, stream in enumerate(streams):
+        if stream["codec_type"] in disabledTypes:
+            actions.append("disabled")
+            continue
+        action = next((rule["action"] for rule in rules
+                       if streamMatches(rule, stream)), None)
+        actions.append(" ".join(action) if action else None)
+        if action and action[0] == "drop":
+            continue
+        outputIndex = len(mapOptions) // 2
+        mapOptions.extend(["-map", "0:{}".format(position)])
+        if action:
+            codecOptions.extend(["-c:{}".format(outputIndex), action[0]])
+            if len(action) > 1:
+                codecOptions.extend(["-b:{}".format(outputIndex),
+                                     action[1]])
+
+    return(mapOptions + codecOptions, actions)
+
+
+def databaseMigration(conn, oldVersion):
+    """
+    We have identified, the database version is old.
+    Start with doing the migration.
+    """
+
+    c = conn.cursor()
+
+    if oldVersion < 2:
+        try:
+            c.execute("CREATE TABLE activity_log ("
+                      "log_ts TEXT NOT NULL, "
+                      "activity_text TEXT NOT NULL)")
+        except:
+            print("Error migrating to repository version 2")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 2")
+
+    if oldVersion < 3:
+        try:
+            c.execute("UPDATE folder_optimize_file "
+                      "SET optimized_file_date = SUBSTR(optimized_file_date, 1,"
+                      "19), original_file_date = SUBSTR(original_file_date, 1,"
+                      "19) "
+                      "WHERE length(optimized_file_date) > 19 "
+                      "OR length(original_file_date) > 19")
+        except:
+            print("Error migrating to repository version 3")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 3")
+
+    if oldVersion < 4:
+        try:
+            c.execute("ALTER TABLE current_running ADD COLUMN "
+                      "worker_count UNSIGNED INTEGER NOT NULL DEFAULT 1")
+            c.execute("CREATE TABLE running_job ("
+                      "real_folder_id INTEGER NOT NULL REFERENCES "
+                      "real_folder (real_folder_id) "
+                      "ON DELETE CASCADE ON UPDATE CASCADE, "
+                      "file_name TEXT NOT NULL, "
+                      "worker_slot UNSIGNED INTEGER NOT NULL, "
+                      "pid UNSIGNED INTEGER NOT NULL, "
+                      "started_at TEXT NOT NULL, "
+                      "PRIMARY KEY (real_folder_id, file_name))")
+            c.execute("CREATE TABLE folder_application_option ("
+                      "watch_folder_id INTEGER NOT NULL REFERENCES "
+                      "watch_folder (watch_folder_id) "
+                      "ON DELETE CASCADE ON UPDATE CASCADE, "
+                      "option_key TEXT NOT NULL, "
+                      "option_value TEXT NOT NULL, "
+                      "PRIMARY KEY (watch_folder_id, option_key))")
+        except:
+            print("Error migrating to repository version 4")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 4")
+
+    if oldVersion < 5:
+        try:
+            c.execute("ALTER TABLE real_folder ADD COLUMN "
+                      "folder_mtime_ns INTEGER")
+            c.execute("ALTER TABLE real_folder ADD COLUMN "
+                      "folder_inode INTEGER")
+        except:
+            print("Error migrating to repository version 5")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 5")
+
+    if oldVersion < 6:
+        try:
+            createRepositoryIndexes(c)
+        except:
+            print("Error migrating to repository version 6")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 6")
+
+    if oldVersion < 7:
+        try:
+            c.execute("ALTER TABLE folder_optimize_file ADD COLUMN "
+                      "encode_options TEXT")
+            createFileStatistics(c)
+        except:
+            print("Error migrating to repository version 7")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 7")
+
+    if oldVersion < 8:
+        try:
+            c.execute("ALTER TABLE folder_optimize_file ADD COLUMN "
+                      "skip_reason TEXT")
+            createFileProbe(c)
+        except:
+            print("Error migrating to repository version 8")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 8")
+
+    if oldVersion < 9:
+        try:
+            c.execute("ALTER TABLE running_job ADD COLUMN "
+                      "frame UNSIGNED BIGINT")
+            c.execute("ALTER TABLE running_job ADD COLUMN fps REAL")
+            c.execute("ALTER TABLE running_job ADD COLUMN speed REAL")
+            c.execute("ALTER TABLE running_job ADD COLUMN bitrate_kbps REAL")
+            c.execute("ALTER TABLE running_job ADD COLUMN "
+                      "output_size UNSIGNED BIGINT")
+            c.execute("ALTER TABLE running_job ADD COLUMN "
+                      "out_time_seconds REAL")
+            c.execute("ALTER TABLE running_job ADD COLUMN eta_seconds REAL")
+            c.execute("ALTER TABLE running_job ADD COLUMN progress_at TEXT")
+            createEncodeHistory(c)
+        except:
+            print("Error migrating to repository version 9")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 9")
+
+    if oldVersion < 10:
+        try:
+            createFileSegment(c)
+        except:
+            print("Error migrating to repository version 10")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 10")
+
+    if oldVersion < 11:
+        try:
+            c.execute("ALTER TABLE current_running ADD COLUMN "
+                      "node_name TEXT NOT NULL DEFAULT ''")
+            c.execute("ALTER TABLE current_running ADD COLUMN "
+                      "heartbeat_at REAL")
+            c.execute("ALTER TABLE running_job ADD COLUMN node_name TEXT")
+            c.execute("ALTER TABLE folder_optimize_file ADD COLUMN "
+                      "lease_node TEXT")
+            c.execute("ALTER TABLE folder_optimize_file ADD COLUMN "
+                      "lease_expires_at REAL")
+            c.execute("ALTER TABLE folder_optimize_file ADD COLUMN "
+                      "encode_node TEXT")
+            # created with node_name, if migrated from before version 9
+            if oldVersion >= 9:
+                c.execute("ALTER TABLE encode_history ADD COLUMN "
+                          "node_name TEXT")
+        except:
+            print("Error migrating to repository version 11")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 11")
+
+    if oldVersion < 12:
+        try:
+            createFileFingerprint(c)
+        except:
+            print("Error migrating to repository version 12")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 12")
+
+    if oldVersion < 13:
+        try:
+            createFileQuality(c)
+        except:
+            print("Error migrating to repository version 13")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 13")
+
+    if oldVersion < 14:
+        try:
+            c.execute("ALTER TABLE folder_optimize_file ADD COLUMN "
+                      "predicted_size UNSIGNED BIGINT")
+        except:
+            print("Error migrating to repository version 14")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 14")
+
+    if oldVersion < 15:
+        try:
+            createRunHistory(c)
+        except:
+            print("Error migrating to repository version 15")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 15")
+
+    if oldVersion < 16:
+        try:
+            createFileRendition(c)
+        except:
+            print("Error migrating to repository version 16")
+            sys.exit(1)
+        else:
+            c.execute("UPDATE repository_version SET version_number = 16")
+
+    writeActivityLog(conn, "Successfully migrated database version from {} "
+                           "to {}".format(oldVersion,
+                                          current_repository_version))
+
+    conn.commit()
+    c.close()
+
+
+def setJournalMode(conn):
+    """
+    Switch the repository to the configured journal_mode. WAL lets readers
+    (config, stats) not block a running execute, but needs shared memory,
+    which a repository on a network share doesn't have. A repository in
+    use by other processes keeps its mode until it is opened alone.
+    """
+
+    c = conn.cursor()
+
+    c.execute("SELECT option_value FROM application_option "
+              "WHERE option_key = 'journal_mode'")
+    row = c.fetchone()
+    journalMode = (row[0] if row else
+                   default_application_options["journal_mode"]).lower()
+
+    c.execute("PRAGMA journal_mode")
+    if (journalMode in database_journal_modes and
+            c.fetchone()[0] != journalMode):
+        c.execute("PRAGMA busy_timeout = 0")
+        try:
+            c.execute("PRAGMA journal_mode = {}".format(journalMode))
+        except sqlite3.OperationalError:
+            pass
+        c.execute("PRAGMA busy_timeout = {}"
+                  .format(database_busy_timeout_ms))
+
+    # In WAL mode, a commit doesn't need to wait for the disk
+    c.execute("PRAGMA journal_mode")
+    if c.fetchone()[0] == "wal":
+        c.execute("PRAGMA synchronous = NORMAL")
+
+    c.close()
+
+
+def openDatabase(databasename):
+    """
+    Every time we open the database, we check if a migration needs to
+    be done on it
+    """
+
+    conn = sqlite3.connect(databasename)
+    if profileCounters is not None:
+        conn.set_trace_callback(profileStatement)
+    c = conn.cursor()
+    c.execute("PRAGMA FOREIGN_KEYS = ON")
+    c.execute("PRAGMA busy_timeout = {}".format(database_busy_timeout_ms))
+    c.execute("PRAGMA mmap_size = {}".format(database_mmap_size))
+
+    c.execute("SELECT version_number FROM repository_version")
+    oldVersion = c.fetchone()[0]
+    if oldVersion < current_repository_version:
+        # Database version is old, need to migrate to newest version
+        databaseMigration(conn, oldVersion)
+
+    setJournalMode(conn)
+
+    c.close()
+
+    return(conn)
+
+
+def loadApplicationOption(conn):
+    """
+    For processing, we need some default options stored in table
+    """
+
+    c = conn.cursor()
+
+    applicationOption = {}
+
+    c.execute("select option_key, option_value from application_option")
+    for key, value in c.fetchall():
+        applicationOption[key] = value
+
+    c.close()
+
+    # Options added in newer versions might not be in older repositories
+    for key, value in default_application_options.items():
+        if key != "target_extension" and key not in applicationOption:
+            applicationOption[key] = value
+
+    return(applicationOption)
+
+
+def loadFolderApplicationOption(conn, thisWatchFolderId, applicationOption):
+    """
+    Merge folder specific application options over the global ones and
+    return the result as new dictionary
+    """
+
+    c = conn.cursor()
+
+    folderApplicationOption = dict(applicationOption)
+
+    c.execute("SELECT option_key, option_value "
+              "FROM folder_application_option "
+              "WHERE watch_folder_id = ?", [thisWatchFolderId])
+    for key, value in c.fetchall():
+        folderApplicationOption[key] = value
+
+    c.close()
+
+    return(folderApplicationOption)
+
+
+def getIntOption(Options, key, default=0):
+    """
+    Return an application option as integer, or default if not convertible
+    """
+
+    try:
+        return(int(Options.get(key, default)))
+    except (TypeError, ValueError):
+        return(default)
+
+
+def getFloatOption(Options, key, default=0.0):
+    """
+    Return an application option as float, or default if not convertible
+    """
+
+    try:
+        return(float(Options.get(key, default)))
+    except (TypeError, ValueError):
+        return(default)
+
+
+def encodePriorityCommand(applicationOption):
+    """
+    Command prefix to run an encoder with lower cpu (encode_nice) and disk
+    (encode_ionice_class) priority, so playback on the same host goes
+    first. Only the encoders get it, not this process. Tools which are not
+    installed are left out.
+    """
+
+    command = []
+
+    ioniceClass = getIntOption(applicationOption, "encode_ionice_class")
+    if ioniceClass in (2, 3) and shutil.which("ionice"):
+        # lowest level of the class
+        command.extend(["ionice", "-c", str(ioniceClass)] +
+                       (["-n", "7"] if ioniceClass == 2 else []))
+
+    niceness = getIntOption(applicationOption, "encode_nice")
+    if niceness > 0 and shutil.which("nice"):
+        command.extend(["nice", "-n", str(niceness)])
+
+    return(command)
+
+
+def encodeWindowOpen(encodeHours, now):
+    """
+    Check if now is within one of the hour ranges of encode_hours like
+    "22-7,12-14" (end exclusive, ranges may wrap around midnight).
+    Empty or unreadable ranges allow any time.
+    """
+
+    hour = now.hour + now.minute / 60
+    windows = []
+
+    for window in encodeHours.split(","):
+        try:
+            start, end = (float(value) for value in window.split("-"))
+        except ValueError:
+            continue
+        windows.append((start, end))
+
+    if not windows:
+        return(True)
+
+    for start, end in windows:
+        if start <= end and start <= hour < end:
+            return(True)
+        if start > end and (hour >= start or hour < end):
+            return(True)
+
+    return(False)
+
+
+def throttleReason(applicationOption, throttled):
+    """
+    Return why encodes must not run now (system load or outside of
+    encode_hours), or None. While throttled, the load has to drop clearly
+    below max_load_average before encodes continue.
+    """
+
+    maxLoad = getFloatOption(applicationOption, "max_load_average")
+    if maxLoad > 0:
+        load = os.getloadavg()[0]
+        if throttled:
+            maxLoad *= load_resume_ratio
+        if load > maxLoad:
+            return("load average {:.2f} above {:.2f}".format(load, maxLoad))
+
+    if not encodeWindowOpen(applicationOption.get("encode_hours", ""),
+                            datetime.now()):
+        return("outside of encode hours {}"
+               .format(applicationOption["encode_hours"]))
+
+    return(None)
+
+
+def freeSpaceFor(folder, neededBytes):
+    """
+    Check if the file system of a folder has at least neededBytes free
+    """
+
+    try:
+        return(shutil.disk_usage(folder).free >= neededBytes)
+    except OSError:
+        return(False)
+
+
+def processAlive(pid):
+    """
+    Check if a process with this pid exists
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return(False)
+    except PermissionError:
+        pass
+
+    return(True)
+
+
+def recoverRunningJobs(conn, leaseSeconds, ownJobs=False):
+    """
+    Files claimed by a killed process are still marked as processing.
+    With ownJobs, free the files of an earlier process of this node and
+    remove their temporary files. Files of other nodes are freed once their
+    lease is well past expiry; their temporary files are left alone, that
+    node may still be writing them. Finished segments are kept, so
+    segmented files continue where they stopped.
+    """
+
+    c = conn.cursor()
+
+    # Claims of versions without leases count as expired
+    condition = ("fof.file_status = 2 AND (fof.lease_expires_at IS NULL "
+                 "OR fof.lease_expires_at < ?) "
+                 "AND (fof.lease_node IS NULL OR fof.lease_node <> ?)")
+    parameters = [time.time() - leaseSeconds * lease_grace_renewals / 3,
+                  nodeName]
+    if ownJobs:
+        condition = ("fof.file_status = 2 AND fof.lease_node = ? OR " +
+                     condition)
+        parameters = [nodeName] + parameters
+
+    c.execute("SELECT fof.real_folder_id, rf.real_folder_name, "
+              "fof.file_name, fof.optimized_extension, fof.lease_node "
+              "FROM folder_optimize_file AS fof "
+              "JOIN real_folder AS rf "
+              "ON rf.real_folder_id = fof.real_folder_id "
+              "WHERE " + condition, parameters)
+    rows = c.fetchall()
+    for (thisRealFolderId, thisRealFolderName, thisFileName, thisExtension,
+            thisLeaseNode) in rows:
+        if thisLeaseNode == nodeName:
+            for thisFile in (thisFileName + ".log", "." + thisFileName +
+                             ".tmp." + str(thisExtension)):
+                try:
+                    os.remove(os.path.join(thisRealFolderName, thisFile))
+                except OSError:
+                    pass
+        writeActivityLog(conn, "Recovered file {} of killed process on "
+                         "node {}".format(os.path.join(thisRealFolderName,
+                                                       thisFileName),
+                                          thisLeaseNode))
+
+    c.executemany("DELETE FROM running_job "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [row[0:3:2] for row in rows])
+    c.executemany("UPDATE folder_optimize_file "
+                  "SET file_status = 0, optimization_started_at = NULL, "
+                  "optimized_extension = NULL, encode_options = NULL, "
+                  "lease_node = NULL, lease_expires_at = NULL, "
+                  "encode_node = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ? "
+                  "AND file_status = 2", [row[0:3:2] for row in rows])
+
+    c.close()
+
+
+def checkExecution(conn, workerCount=1):
+    """
+    We can only have one process per node at a time, so check if one is
+    already running on this node, and end gracefully if.
+    Mark as running if possible. The process runs a pool of workerCount
+    encoder workers, the jobs of the workers are kept in running_job.
+    Processes on other nodes share the files by leases.
+    """
+
+    c = conn.cursor()
+
+    c.execute("SELECT started_at, pid FROM current_running "
+              "WHERE node_name = ?", [nodeName])
+    row = c.fetchone()
+    if row and processAlive(row[1]):
+        print("Process already running. Exit gracefully!")
+        sys.exit(0)
+    elif row:
+        writeActivityLog(conn, "Process {} started at {} was killed, "
+                               "recover its files".format(row[1], row[0]))
+        c.execute("DELETE FROM current_running WHERE node_name = ?",
+                  [nodeName])
+
+    c.execute("INSERT INTO current_running (started_at, pid, worker_count, "
+              "node_name, heartbeat_at) VALUES (?, ?, ?, ?, ?)",
+              [datetime.now(), os.getpid(), workerCount, nodeName,
+               time.time()])
+    # Leftovers of a killed process
+    c.execute("DELETE FROM running_job WHERE node_name = ? "
+              "OR node_name IS NULL", [nodeName])
+    recoverRunningJobs(conn, getIntOption(loadApplicationOption(conn),
+                                          "lease_seconds", 300),
+                       ownJobs=True)
+
+    conn.commit()
+    c.close()
+
+
+def endExecution(conn):
+    """
+    Remove the mark of this process
+    """
+
+    c = conn.cursor()
+
+    c.execute("DELETE FROM current_running WHERE node_name = ? AND pid = ?",
+              [nodeName, os.getpid()])
+    conn.commit()
+
+    c.close()
+
+
+def loadDefaultOption(conn):
+    """
+    Load default processing options to apply to every folder
+    """
+
+    c = conn.cursor()
+
+    defaultOption = {}
+
+    c.execute("SELECT default_option, default_option_id "
+              "FROM default_option")
+    for thisOption, id in c.fetchall():
+        if thisOption:
+            defaultOption[id] = thisOption
+
+    c.close()
+
+    return(defaultOption)
+
+
+def loadFolderOption(conn, thisWatchFolderId):
+    """
+    Load folder specific folder option to (probably) overwrite defaults
+    """
+
+    c = conn.cursor()
+
+    folderOption = {}
+
+    c.execute("SELECT folder_option, folder_option_id FROM folder_option "
+              "WHERE watch_folder_id = ?", [thisWatchFolderId])
+
+    for thisOption, id in c.fetchall():
+        folderOption[id] = thisOption
+
+    c.close()
+
+    return(folderOption)
+
+
+def writeActivityLog(conn, message):
+    "Write activity log (buffered, see flushActivityLog)"
+
+    writeActivityLogs(conn, [message])
+
+
+def writeActivityLogs(conn, messages):
+    "Write several activity log entries (buffered, see flushActivityLog)"
+
+    with activityLogLock:
+        activityLogBuffer.extend([datetime.now(), message]
+                                 for message in messages)
+        flushNow = (len(activityLogBuffer) >= activity_log_batch_size or
+                    time.time() - activityLogLastFlush >=
+                    activity_log_flush_seconds)
+
+    # Never commit a transaction the caller has still open, the entries
+    # wait for the next write outside of it
+    if flushNow and not conn.in_transaction:
+        flushActivityLog(conn)
+
+
+def flushActivityLog(conn):
+    """
+    Write all buffered activity log entries with the timestamps they were
+    queued with in one go and commit the current transaction; called where
+    the work of the caller is complete
+    """
+
+    global activityLogLastFlush
+
+    with activityLogLock:
+        entries = activityLogBuffer[:]
+        del activityLogBuffer[:]
+        activityLogLastFlush = time.time()
+
+    if entries:
+        c = conn.cursor()
+        c.executemany("INSERT into activity_log (log_ts, activity_text) "
+                      "values (?, ?)", entries)
+        c.close()
+
+    conn.commit()
+
+
+def flushActivityLogAtExit():
+    """
+    Called on exit: write activity log entries which are still buffered,
+    e.g. after an error or a signal in the middle of a phase
+    """
+
+    if not activityLogBuffer or not os.path.exists(databasename):
+        return
+
+    try:
+        conn = sqlite3.connect(databasename,
+                               timeout=database_busy_timeout_ms / 1000)
+        flushActivityLog(conn)
+        conn.close()
+    except sqlite3.Error as e:
+        print("Error writing activity log: {}".format(e), file=sys.stderr)
+
+
+def terminateHandler(signum, frame):
+    """
+    Leave through sys.exit on SIGTERM/SIGHUP, so the exit handlers are run
+    """
+
+    sys.exit(128 + signum)
+
+
+def countProfile(counter, count=1):
+    """
+    Count file system calls and processes started by the scan and spawn
+    functions for the current phase, if profiling
+    """
+
+    if profileCounters is None:
+        return
+
+    with profileLock:
+        if profilePhase in profileCounters:
+            profileCounters[profilePhase][counter] += count
+
+
+def profileStatement(statement):
+    """
+    Trace callback of the repository connections while profiling
+    """
+
+    countProfile("sql_statements")
+    if statement.lstrip().upper().startswith("COMMIT"):
+        countProfile("sql_commits")
+
+
+def enableProfiling():
+    """
+    Start counting the statements of the repository connections (see
+    openDatabase), file system calls and processes started of the phases
+    """
+
+    global profileCounters
+
+    profileCounters = {}
+
+
+def runPhase(phase, function, *arguments):
+    """
+    Run one phase of a command. While profiling, record its wall time, cpu
+    time of this process and of its finished child processes (encoders)
+    and its counters.
+    """
+
+    global profilePhase
+
+    if profileCounters is None:
+        return(function(*arguments))
+
+    counters = dict.fromkeys(profile_counter_names, 0)
+    with profileLock:
+        profileCounters[phase] = counters
+        profilePhase = phase
+    start = time.time()
+    startTimes = os.times()
+
+    try:
+        return(function(*arguments))
+    finally:
+        endTimes = os.times()
+        with profileLock:
+            profilePhase = None
+        counters.update({
+            "wall_seconds": round(time.time() - start, 3),
+            "cpu_seconds": round(max(0.0, endTimes.user + endTimes.system -
+                                     startTimes.user - startTimes.system),
+                                 3),
+            "child_cpu_seconds": round(max(0.0, endTimes.children_user +
+                                           endTimes.children_system -
+                                           startTimes.children_user -
+                                           startTimes.children_system), 3)})
+
+
+def profileRequested(databasename):
+    """
+    Check if this run shall be profiled, by --profile or the application
+    option profile
+    """
+
+    if args.profile:
+        return(True)
+
+    conn = openDatabase(databasename)
+    applicationOption = loadApplicationOption(conn)
+    conn.close()
+
+    return(getIntOption(applicationOption, "profile") == 1)
+
+
+def saveRunHistory(databasename, command, startedAt):
+    """
+    Write the profile of this run to run_history and as JSON to stderr
+    """
+
+    phases = dict(profileCounters)
+    runInfo = {"node": nodeName, "command": command,
+               "started_at": str(startedAt), "finished_at": str(datetime.now()),
+               "phases": phases}
+    for key in ("wall_seconds", "cpu_seconds", "child_cpu_seconds"):
+        runInfo[key] = round(sum(phase.get(key, 0)
+                                 for phase in phases.values()), 3)
+
+    print(json.dumps(runInfo, sort_keys=True), file=sys.stderr)
+
+    conn = openDatabase(databasename)
+    c = conn.cursor()
+    c.execute("INSERT INTO run_history (node_name, command, started_at, "
+              "finished_at, wall_seconds, cpu_seconds, child_cpu_seconds, "
+              "phase_info) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+              [nodeName, command, startedAt, runInfo["finished_at"],
+               runInfo["wall_seconds"], runInfo["cpu_seconds"],
+               runInfo["child_cpu_seconds"], json.dumps(phases)])
+    conn.commit()
+    c.close()
+    conn.close()
+
+
+def buildExecOptions(Options, inpfile, outfile, threadCount, progress=True,
+                     renditions=(), streamOptions=()):
+    """
+    Build the command line out of the merged options. Replace the implicit
+    terms and limit the encoder to its thread budget if requested.
+    Renditions are further outputs of the same command, so the source is
+    read and decoded once for all of them. Stream options of the stream
+    rules replace the -map of the options.
+    """
+
+    execOptions = []
+    skipValue = False
+
+    for key in sorted(Options):
+        if skipValue:
+            skipValue = False
+        elif streamOptions and Options[key] == "-map":
+            skipValue = True
+        elif not execOptions:
+            execOptions.append(Options[key])
+            # ffmpeg reports its progress as key=value lines to stdout
+            if (progress and isFfmpeg(Options)
+                    and "-progress" not in Options.values()):
+                execOptions.extend(["-progress", "pipe:1", "-nostats"])
+        elif Options[key] == "INPUTFILE":
+            execOptions.append(inpfile)
+        elif Options[key] == "OUTPUTFILE":
+            execOptions.extend(streamOptions)
+            if threadCount > 0:
+                execOptions.extend(["-threads", str(threadCount)])
+                if ("libx265" in Options.values()
+                        and "-x265-params" not in Options.values()):
+                    execOptions.extend(["-x265-params",
+                                        "pools={}".format(threadCount)])
+            execOptions.append(outfile)
+            for rendition in renditions:
+                execOptions.extend(rendition["options"])
+                if threadCount > 0:
+                    execOptions.extend(["-threads", str(threadCount)])
+                execOptions.append(rendition["outfile"])
+        else:
+            execOptions.append(Options[key])
+
+    return(execOptions)
+
+
+def isFfmpeg(Options):
+    """
+    Check if the program of the options is ffmpeg
+    """
+
+    return(os.path.basename(Options[min(Options)]).startswith("ffmpeg"))
+
+
+def encodeOptionsText(Options):
+    """
+    The options of an encode as text for statistics and history, without
+    program and files
+    """
+
+    return(" ".join(Options[key] for key in sorted(Options)[1:]
+                    if Options[key] not in ("-i", "INPUTFILE",
+                                            "OUTPUTFILE")))
+
+
+def jobFiles(job):
+    """
+    Logfile, input, target and temporary output file of a job next to its
+    source
+    """
+
+    thisRealFolderName = job["realFolderName"]
+    thisFileName = job["fileName"]
+    targetExtension = job["applicationOption"]["target_extension"]
+
+    return(os.path.join(thisRealFolderName, thisFileName + ".log"),
+           os.path.join(thisRealFolderName, thisFileName + "." +
+                        job["originalExtension"]),
+           os.path.join(thisRealFolderName, thisFileName + "." +
+                        targetExtension),
+           os.path.join(thisRealFolderName, "." + thisFileName + ".tmp." +
+                        targetExtension))
+
+
+def prepareJob(job):
+    """
+    Check the files and the free space of a job, resolve its stream rules
+    and renditions and decide if it is skipped. Runs in an I/O thread for
+    the next jobs of the queue, so starting one doesn't wait for a slow
+    share. Files not probed yet are probed here. Doesn't touch the
+    repository, the result is handed over to the job by
+    collectPreparedJobs.
+    """
+
+    applicationOption = job["applicationOption"]
+    thisRealFolderName = job["realFolderName"]
+    thisFileName = job["fileName"]
+
+    logfile, inpfile, tgtfile, outfile = jobFiles(job)
+
+    prepared = {"checkedAt": time.time(), "error": None, "messages": [],
+                "streamRules": None, "streamOptions": [],
+                "streamActions": None, "skipReason": None,
+                "renditions": [], "existingRenditions": set(),
+                "segmented": False, "outfile": outfile}
+
+    if os.path.isfile(logfile):
+        prepared["error"] = "Logfile {} already exists!".format(logfile)
+    elif os.path.isfile(outfile):
+        prepared["error"] = ("Temporary file {} already exists!"
+                             .format(outfile))
+    elif inpfile != tgtfile and os.path.isfile(tgtfile):
+        prepared["error"] = "Target file {} already exists!".format(tgtfile)
+    elif not os.path.isfile(inpfile):
+        prepared["error"] = "File not found: {}!".format(inpfile)
+    if prepared["error"]:
+        return(prepared)
+
+    # Files are probed once, when they are next in the queue. The options
+    # are filled in again with the properties of the file.
+    probeProgram = applicationOption.get("probe_program", "ffprobe")
+    if job["probe"] is None and probeProgram and not probeProgramMissing:
+        try:
+            fileProbe = probeResult(runProbe(probeProgram, inpfile))
+        except FileNotFoundError:
+            prepared["probeMissing"] = probeProgram
+        else:
+            job = dict(job, probe=fileProbe, options=fillOptionTemplate(
+                job["optionTemplate"], fileProbe, job["originalSize"]))
+            prepared["probe"] = fileProbe
+            prepared["options"] = job["options"]
+
+    # Stream rules decide per stream to copy, drop or transcode it
+    if (applicationOption.get("stream_rules") and isFfmpeg(job["options"])
+            and job.get("probe") and job["probe"]["streams"]):
+        streamRules, invalid = parseStreamRules(
+            applicationOption["stream_rules"])
+        prepared["messages"].extend("Error, invalid stream rule \"{}\""
+                                    .format(entry) for entry in invalid)
+        prepared["streamRules"] = streamRules
+        prepared["streamOptions"], prepared["streamActions"] = \
+            resolveStreamRules(streamRules, job["probe"]["streams"],
+                               job["options"])
+
+    prepared["skipReason"] = checkSkipFile(job, prepared["streamActions"])
+    if prepared["skipReason"]:
+        return(prepared)
+
+    # Renditions are encoded from the same decode as the optimized file
+    renditions = []
+    if applicationOption.get("renditions") and isFfmpeg(job["options"]):
+        renditions, invalid = parseRenditions(applicationOption["renditions"])
+        prepared["messages"].extend("Error, invalid rendition \"{}\""
+                                    .format(entry) for entry in invalid)
+        for rendition in renditions:
+            extension = (rendition["extension"] or
+                         applicationOption["target_extension"])
+            rendition.update({
+                "extension": extension,
+                "fileName": thisFileName + "." + rendition["name"],
+                "outfile": os.path.join(thisRealFolderName, "." +
+                                        thisFileName + "." +
+                                        rendition["name"] + ".tmp." +
+                                        extension),
+                "tgtfile": os.path.join(thisRealFolderName, thisFileName +
+                                        "." + rendition["name"] + "." +
+                                        extension)})
+            rendition["localOutfile"] = rendition["outfile"]
+            if os.path.isfile(rendition["tgtfile"]):
+                prepared["existingRenditions"].add(rendition["name"])
+    prepared["renditions"] = renditions
+
+    # Large files are split at keyframes and encoded in segments
+    segmentMinSize = getIntOption(applicationOption,
+                                  "segment_min_size_mb") * 1024 ** 2
+    segmented = (segmentMinSize > 0 and isFfmpeg(job["options"]) and
+                 job["originalSize"] >= segmentMinSize and not renditions)
+    prepared["segmented"] = segmented
+
+    # The result is at most as large as the original, segments need the
+    # original and the encoded segments next to the source
+    neededSpace = (job["originalSize"] +
+                   getIntOption(applicationOption, "min_free_mb", 1024) *
+                   1024 ** 2)
+    if not freeSpaceFor(thisRealFolderName, neededSpace + (
+            2 * job["originalSize"] if segmented else 0)):
+        prepared["error"] = ("Not enough free space in {} for file {}"
+                             .format(thisRealFolderName, inpfile))
+        return(prepared)
+
+    # Encode on the scratch folder, the result is moved next to the source
+    # when finished
+    scratchFolder = applicationOption.get("scratch_folder")
+    if scratchFolder:
+        if freeSpaceFor(scratchFolder, neededSpace):
+            prepared["outfile"] = os.path.join(
+                scratchFolder, "{}-{}.tmp.{}".format(
+                    job["realFolderId"], thisFileName,
+                    applicationOption["target_extension"]))
+            for rendition in renditions:
+                rendition["outfile"] = os.path.join(
+                    scratchFolder, "{}-{}.tmp.{}".format(
+                        job["realFolderId"], rendition["fileName"],
+                        rendition["extension"]))
+        else:
+            prepared["messages"].append(
+                "Not enough free space in {}, encode file {} in place"
+                .format(scratchFolder, inpfile))
+
+    # Left over by an interrupted run, ffmpeg would ask to overwrite
+    for leftover in ([prepared["outfile"]] if scratchFolder else []) + [
+            rendition["outfile"] for rendition in renditions]:
+        if os.path.isfile(leftover):
+            os.remove(leftover)
+
+    # Files encoded are always sampled, later copies may match them
+    if (applicationOption.get("deduplicate") in ("link", "copy") and
+            not job.get("sampleHash")):
+        prepared["sampleHash"] = hashFile(inpfile, job["originalSize"])
+
+    return(prepared)
+
+
+def preparedFresh(job):
+    """
+    Check if the job has been prepared recently enough to start it
+    """
+
+    prepared = job.get("prepared")
+
+    return(prepared is not None and time.time() - prepared["checkedAt"] <=
+           2 * progress_update_seconds)
+
+
+def startProcessFile(conn, job, workerSlot, workerCount):
+    """
+    Prepare one file and start the encoder for it without waiting.
+    Returns the job extended by the running process or None, if the file
+    can't be processed now. A job claimed to reuse the result of an
+    identical file is returned with its candidateFiles instead.
+    """
+
+    c = conn.cursor()
+
+    thisRealFolderId = job["realFolderId"]
+    thisRealFolderName = job["realFolderName"]
+    thisFileName = job["fileName"]
+    applicationOption = job["applicationOption"]
+
+    logfile, inpfile, tgtfile, outfile = jobFiles(job)
+
+    # Claimed by another node meanwhile
+    c.execute("SELECT file_status FROM folder_optimize_file "
+              "WHERE real_folder_id = ? AND file_name = ?",
+              [thisRealFolderId, thisFileName])
+    row = c.fetchone()
+    if not row or row[0] != 0:
+        c.close()
+        return(None)
+
+    # Prepared ahead by the I/O pool
+    prepared = job["prepared"]
+    writeActivityLogs(conn, prepared["messages"])
+    if prepared["error"]:
+        writeActivityLog(conn, prepared["error"])
+        conn.commit()
+        c.close()
+        return(None)
+
+    streamRules = prepared["streamRules"]
+    streamOptions = prepared["streamOptions"]
+    streamActions = prepared["streamActions"]
+
+    if prepared["skipReason"]:
+        skipFile(conn, job, prepared["skipReason"])
+        c.close()
+        return(None)
+
+    # Video copied by a stream rule needs neither crf nor prediction
+    videoCopied = bool(streamActions) and next(
+        (action for stream, action in zip(job["probe"]["streams"],
+                                          streamActions)
+         if stream["codec_type"] == "video"), None) == "copy"
+
+    # A crf found by an earlier quality search replaces the configured one,
+    # otherwise the worker searches it before encoding
+    qualitySearch = None if videoCopied else qualitySearchOptions(job)
+    if qualitySearch:
+        crf = loadFileQuality(conn, job, qualitySearch)
+        if crf is not None:
+            applyCrf(job, crf)
+            qualitySearch = None
+
+    # Outputs of an earlier encode of this file are replaced
+    renditions = prepared["renditions"]
+    if prepared["existingRenditions"]:
+        c.execute("SELECT rendition_name FROM file_rendition "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [thisRealFolderId, thisFileName])
+        ownRenditions = set(row[0] for row in c.fetchall())
+        for rendition in renditions:
+            if (rendition["name"] in prepared["existingRenditions"] and
+                    rendition["name"] not in ownRenditions):
+                writeActivityLog(conn, "Target file {} already exists!"
+                                 .format(rendition["tgtfile"]))
+                conn.commit()
+                c.close()
+                return(None)
+
+    # An identical file only gives the optimized file, not the renditions,
+    # its result is reused in the I/O pool
+    if (not renditions and not job.get("reuseChecked") and
+            claimIdenticalFile(conn, job)):
+        c.close()
+        return(job)
+
+    # Sample encodes predict, if the file is worth the full encode
+    predictSavings = (not videoCopied and
+                      getFloatOption(applicationOption,
+                                     "savings_min_percent") > 0 and
+                      isFfmpeg(job["options"]) and
+                      job.get("probe") is not None and
+                      bool(job["probe"]["duration_seconds"]))
+
+    # With several workers, share the cpus if no budget is configured
+    threadCount = getIntOption(applicationOption, "threads_per_job")
+    if threadCount <= 0 and workerCount > 1:
+        threadCount = max(1, (os.cpu_count() or 1) // workerCount)
+
+    # Video copied by a stream rule isn't worth splitting
+    segmented = prepared["segmented"] and not videoCopied
+    localOutfile = outfile
+    outfile = prepared["outfile"]
+
+    execOptions = buildExecOptions(job["options"], inpfile, outfile,
+                                   threadCount, renditions=renditions,
+                                   streamOptions=streamOptions)
+
+    # Claim the file, only one node wins
+    leaseSeconds = getIntOption(applicationOption, "lease_seconds", 300)
+    c.execute("UPDATE folder_optimize_file "
+              "SET file_status = 2, lease_node = ?, lease_expires_at = ?, "
+              "    encode_node = ? "
+              "WHERE real_folder_id = ? AND file_name = ? "
+              "AND file_status = 0",
+              [nodeName, time.time() + leaseSeconds, nodeName,
+               thisRealFolderId, thisFileName])
+    if c.rowcount != 1:
+        conn.rollback()
+        c.close()
+        return(None)
+    conn.commit()
+
+    try:
+        log = open(logfile, 'w')
+    except IOError:
+        c.execute("UPDATE folder_optimize_file "
+                  "SET file_status = 0, lease_node = NULL, "
+                  "lease_expires_at = NULL, encode_node = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [thisRealFolderId, thisFileName])
+        writeActivityLog(conn, "Error, cannot create logfile {}"
+                         .format(logfile))
+        conn.commit()
+        c.close()
+        return(None)
+
+    encodeOptions = encodeOptionsText(job["options"])
+
+    c.execute("UPDATE folder_optimize_file "
+              "SET optimization_started_at = ?, "
+              "    optimized_extension = ?, "
+              "    file_status = ?, encode_options = ? "
+              "WHERE real_folder_id = ? AND file_name = ?",
+              [datetime.now(), applicationOption["target_extension"], 2,
+              encodeOptions, thisRealFolderId, thisFileName])
+
+    start = time.time()
+
+    # Progress goes through a pipe, everything else into the logfile
+    stdout = log
+    if execOptions[1:3] == ["-progress", "pipe:1"]:
+        stdout = subprocess.PIPE
+    priorityCommand = encodePriorityCommand(applicationOption)
+
+    try:
+        if segmented or qualitySearch or predictSavings:
+            # The worker starts the processes itself
+            process = None
+        else:
+            countProfile("process_spawns")
+            process = subprocess.Popen(priorityCommand + execOptions,
+                                       stdout=stdout,
+                                       stderr=subprocess.STDOUT if
+                                       stdout is log else log)
+    except OSError as e:
+        log.close()
+        c.execute("UPDATE folder_optimize_file "
+                  "SET file_status = ?, runtime_seconds = ?, "
+                  "    lease_node = NULL, lease_expires_at = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [99, 0, thisRealFolderId, thisFileName])
+        writeActivityLog(conn, "Error starting {} for file {}: {}"
+                         .format(execOptions[0], inpfile, e))
+        conn.commit()
+        c.close()
+        return(None)
+
+    c.execute("INSERT INTO running_job (real_folder_id, file_name, "
+              "worker_slot, pid, started_at, node_name) "
+              "VALUES (?, ?, ?, ?, ?, ?)",
+              [thisRealFolderId, thisFileName, workerSlot,
+               process.pid if process else os.getpid(), datetime.now(),
+               nodeName])
+    writeActivityLog(conn, "Start processing file {} in folder {} "
+                     "(worker {})".format(thisFileName, thisRealFolderName,
+                                          workerSlot))
+
+    segments = None
+    if segmented:
+        segments = loadFileSegments(conn, thisRealFolderId, thisFileName)
+        writeActivityLog(conn, "Encode file {} in segments, {} finished "
+                         "before".format(inpfile,
+                                         sum(segment["status"] == 1
+                                             for segment in segments)))
+    if qualitySearch:
+        writeActivityLog(conn, "Search crf of file {}: {}"
+                         .format(inpfile, qualitySearch))
+    if streamOptions:
+        writeActivityLog(conn, "Stream rules for file {}: {}"
+                         .format(inpfile, " ".join(streamOptions)))
+
+    conn.commit()
+    c.close()
+
+    job.update({"workerSlot": workerSlot, "process": process, "log": log,
+                "start": start, "startedAt": datetime.now(),
+                "logfile": logfile, "inpfile": inpfile, "tgtfile": tgtfile,
+                "outfile": outfile, "localOutfile": localOutfile,
+                "renditions": renditions, "streamRules": streamRules,
+                "streamOptions": streamOptions,
+                "encodeOptions": encodeOptions,
+                "progress": None, "progressWritten": None,
+                "processes": [process] if process else [],
+                "processLock": threading.Lock(), "aborted": False,
+                "priorityCommand": priorityCommand,
+                "paused": False,
+                "threadCount": threadCount, "segments": segments,
+                "segmentFolder": os.path.join(thisRealFolderName, "." +
+                                              thisFileName +
+                                              segment_folder_suffix),
+                "qualitySearch": qualitySearch,
+                "predictSavings": predictSavings, "skipReason": None,
+                "events": [], "messages": [], "leaseSeconds": leaseSeconds,
+                "leaseExpiresAt": time.time() + leaseSeconds})
+
+    return(job)
+
+
+def waitProcessFile(job):
+    """
+    Runs in a worker thread and waits for the encoder of one job.
+    Don't touch the repository here, the connection belongs to the
+    main thread.
+    """
+
+    if job["qualitySearch"] or job["predictSavings"]:
+        job["skipReason"] = checkSampleClips(job)
+
+    if job["skipReason"]:
+        returnCode = 0
+    elif job["segments"] is not None:
+        returnCode = encodeSegments(job)
+    elif not job["process"] and not startEncodeProcess(job):
+        returnCode = 1
+    else:
+        if job["process"].stdout:
+            readProgress(job)
+        returnCode = job["process"].wait()
+
+    job["runtime"] = time.time() - job["start"]
+    job["log"].close()
+
+    return(returnCode)
+
+
+def readProgress(job):
+    """
+    Runs in the worker thread. Read the key=value blocks of ffmpeg -progress
+    until the encoder ends; every complete block replaces job["progress"].
+    """
+
+    progress = {}
+
+    for line in job["process"].stdout:
+        line = line.decode(errors="replace").strip()
+        key, separator, value = line.partition("=")
+        if not separator:
+            continue
+        progress[key] = value
+        if key == "progress":
+            job["progress"] = progress
+            progress = dict(progress)
+
+    job["process"].stdout.close()
+
+
+def progressNumber(value, suffix=""):
+    """
+    A number out of ffmpeg progress like "1.5x" or "1234.5kbits/s"
+    or None for "N/A"
+    """
+
+    if value is None:
+        return(None)
+    value = value.strip()
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return(float(value))
+    except ValueError:
+        return(None)
+
+
+def parseProgress(job):
+    """
+    Turn the last progress block of a job into the running_job columns
+    """
+
+    progress = job["progress"]
+
+    frame = progressNumber(progress.get("frame"))
+    outTimeUs = progressNumber(progress.get("out_time_us",
+                                            progress.get("out_time_ms")))
+    outTime = outTimeUs / 1000000 if outTimeUs is not None else None
+    speed = progressNumber(progress.get("speed"), "x")
+    etaSeconds = None
+    duration = job["probe"]["duration_seconds"] if job.get("probe") else None
+    if duration and outTime is not None and speed:
+        etaSeconds = max(0.0, (duration - outTime) / speed)
+
+    return({"frame": int(frame) if frame is not None else None,
+            "fps": progressNumber(progress.get("fps")),
+            "speed": speed,
+            "bitrate_kbps": progressNumber(progress.get("bitrate"),
+                                           "kbits/s"),
+            "output_size": progressNumber(progress.get("total_size")),
+            "out_time_seconds": outTime,
+            "eta_seconds": etaSeconds,
+            "progress_at": datetime.now()})
+
+
+def updateJobProgress(conn, jobPool):
+    """
+    Write the latest progress of the running jobs to running_job, so
+    others can watch the live state
+    """
+
+    c = conn.cursor()
+
+    rows = []
+    for job in jobPool["running"].values():
+        saveJobEvents(conn, job)
+        progress = job["progress"]
+        if progress is None or progress is job["progressWritten"]:
+            continue
+        job["progressWritten"] = progress
+        values = parseProgress(job)
+        rows.append([values[column] for column in running_job_progress_columns]
+                    + [job["realFolderId"], job["fileName"]])
+
+    c.executemany("UPDATE running_job SET " +
+                  ", ".join(column + " = ?" for column in
+                            running_job_progress_columns) +
+                  " WHERE real_folder_id = ? AND file_name = ?", rows)
+    renewLeases(conn, jobPool)
+    conn.commit()
+
+    jobPool["progressUpdatedAt"] = time.time()
+    c.close()
+
+
+def renewLeases(conn, jobPool):
+    """
+    Heartbeat of this node. Extend the leases of the running, finalizing
+    and reusing jobs, when a third of their time has passed, so other nodes
+    don't take them over.
+    """
+
+    c = conn.cursor()
+
+    now = time.time()
+    rows = []
+    for job in (list(jobPool["running"].values()) +
+                list(jobPool["finalizing"].values()) +
+                list(jobPool["reusing"].values())):
+        if job["leaseExpiresAt"] - now < job["leaseSeconds"] * 2 / 3:
+            job["leaseExpiresAt"] = now + job["leaseSeconds"]
+            rows.append([job["leaseExpiresAt"], job["realFolderId"],
+                         job["fileName"], nodeName])
+
+    c.executemany("UPDATE folder_optimize_file SET lease_expires_at = ? "
+                  "WHERE real_folder_id = ? AND file_name = ? "
+                  "AND lease_node = ? AND file_status = 2", rows)
+    c.execute("UPDATE current_running SET heartbeat_at = ? "
+              "WHERE node_name = ? AND pid = ?",
+              [now, nodeName, os.getpid()])
+
+    c.close()
+
+
+def recordEncodeHistory(conn, job, returnCode, outputSize):
+    """
+    Keep speed and result of a finished encode for later estimates
+    """
+
+    c = conn.cursor()
+
+    values = parseProgress(job) if job["progress"] else {}
+    mediaSeconds = values.get("out_time_seconds")
+    frameCount = values.get("frame")
+    runtime = job["runtime"]
+
+    c.execute("INSERT INTO encode_history (real_folder_id, file_name, "
+              "encode_options, started_at, finished_at, return_code, "
+              "runtime_seconds, original_size, output_size, media_seconds, "
+              "frame_count, average_fps, average_speed, node_name) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+              [job["realFolderId"], job["fileName"], job["encodeOptions"],
+               job["startedAt"], datetime.now(), returnCode, runtime,
+               job["originalSize"], outputSize, mediaSeconds, frameCount,
+               frameCount / runtime if frameCount and runtime else None,
+               mediaSeconds / runtime if mediaSeconds and runtime else None,
+               nodeName])
+
+    c.close()
+
+
+def loadFileSegments(conn, thisRealFolderId, thisFileName):
+    """
+    Load the segments of a file recorded by an earlier run
+    """
+
+    c = conn.cursor()
+
+    c.execute("SELECT segment_number, segment_file, start_seconds, "
+              "end_seconds, segment_size, encoded_size, runtime_seconds, "
+              "segment_status "
+              "FROM file_segment "
+              "WHERE real_folder_id = ? AND file_name = ? "
+              "ORDER BY segment_number", [thisRealFolderId, thisFileName])
+    segments = [dict(zip(("number", "file", "start", "end", "size",
+                          "encodedSize", "runtime", "status"), row))
+                for row in c.fetchall()]
+
+    c.close()
+
+    return(segments)
+
+
+def saveJobEvents(conn, job):
+    """
+    Record the events reported by the worker of a job: split and finished
+    segments, the crf chosen by the quality search and the predicted size
+    """
+
+    c = conn.cursor()
+
+    while job["events"]:
+        event, value = job["events"].pop(0)
+        if event == "split":
+            c.execute("DELETE FROM file_segment "
+                      "WHERE real_folder_id = ? AND file_name = ?",
+                      [job["realFolderId"], job["fileName"]])
+            c.executemany("INSERT INTO file_segment (real_folder_id, "
+                          "file_name, segment_number, segment_file, "
+                          "start_seconds, end_seconds, segment_size, "
+                          "segment_status) VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                          [[job["realFolderId"], job["fileName"],
+                            segment["number"], segment["file"],
+                            segment["start"], segment["end"],
+                            segment["size"]] for segment in value])
+        elif event == "done":
+            c.execute("UPDATE file_segment "
+                      "SET segment_status = 1, encoded_size = ?, "
+                      "runtime_seconds = ? "
+                      "WHERE real_folder_id = ? AND file_name = ? "
+                      "AND segment_number = ?",
+                      [value["encodedSize"], value["runtime"],
+                       job["realFolderId"], job["fileName"],
+                       value["number"]])
+        elif event == "prediction":
+            c.execute("UPDATE folder_optimize_file SET predicted_size = ? "
+                      "WHERE real_folder_id = ? AND file_name = ?",
+                      [value["size"], job["realFolderId"], job["fileName"]])
+        else:
+            c.execute("INSERT OR REPLACE INTO file_quality (real_folder_id, "
+                      "file_name, file_size, file_date, search_options, "
+                      "quality_metric, crf, quality_score, search_seconds, "
+                      "searched_at) "
+                      "SELECT real_folder_id, file_name, original_size, "
+                      "original_file_date, ?, ?, ?, ?, ?, ? "
+                      "FROM folder_optimize_file "
+                      "WHERE real_folder_id = ? AND file_name = ?",
+                      [job["qualitySearch"], value["metric"],
+                       str(value["crf"]), value["score"], value["seconds"],
+                       datetime.now(), job["realFolderId"], job["fileName"]])
+            job["encodeOptions"] = encodeOptionsText(value["options"])
+            c.execute("UPDATE folder_optimize_file SET encode_options = ? "
+                      "WHERE real_folder_id = ? AND file_name = ?",
+                      [job["encodeOptions"], job["realFolderId"],
+                       job["fileName"]])
+            writeActivityLog(conn, "Chose crf {} for file {}, {} {:.4f} "
+                             "in {:.0f}s".format(value["crf"], job["inpfile"],
+                                                 value["metric"],
+                                                 value["score"],
+                                                 value["seconds"]))
+
+    c.close()
+
+
+def startJobProcess(job, execOptions, stdout=None,
+                    stderr=subprocess.STDOUT):
+    """
+    Runs in the worker thread. Start one process of a job, unless the job
+    has been aborted. Output goes into the logfile by default.
+    Returns the process or None.
+    """
+
+    with job["processLock"]:
+        if job["aborted"]:
+            return(None)
+        try:
+            countProfile("process_spawns")
+            process = subprocess.Popen(job["priorityCommand"] + execOptions,
+                                       stdout=stdout or job["log"],
+                                       stderr=stderr)
+        except OSError as e:
+            job["log"].write("Error starting {}: {}\n"
+                             .format(execOptions[0], e))
+            return(None)
+        if job["paused"]:
+            process.send_signal(signal.SIGSTOP)
+        job["processes"].append(process)
+
+    return(process)
+
+
+def splitSegments(job):
+    """
+    Runs in the worker thread. Cut the video stream of the input at
+    keyframes into segments of about segment_seconds without encoding.
+    Returns the list of segments or None on error.
+    """
+
+    segmentFolder = job["segmentFolder"]
+    listFile = os.path.join(segmentFolder, "segments.csv")
+
+    shutil.rmtree(segmentFolder, ignore_errors=True)
+    try:
+        os.makedirs(segmentFolder)
+    except OSError as e:
+        job["log"].write("Cannot create {}: {}\n".format(segmentFolder, e))
+        return(None)
+
+    # The other streams are taken from the source when the segments are
+    # put together
+    process = startJobProcess(job, [
+        job["options"][min(job["options"])], "-i", job["inpfile"],
+        "-map", "0:V:0", "-c", "copy", "-f", "segment",
+        "-segment_time", str(getIntOption(job["applicationOption"],
+                                          "segment_seconds", 300)),
+        "-segment_format", "matroska", "-reset_timestamps", "1",
+        "-segment_list", listFile, "-segment_list_type", "csv",
+        os.path.join(segmentFolder, "source%05d.mkv")])
+    if not process or process.wait():
+        return(None)
+
+    segments = []
+    try:
+        with open(listFile, newline="") as f:
+            for number, (segmentFile, start, end) in enumerate(
+                    csv.reader(f)):
+                segments.append({
+                    "number": number, "file": segmentFile,
+                    "start": float(start), "end": float(end),
+                    "size": os.path.getsize(os.path.join(segmentFolder,
+                                                         segmentFile)),
+                    "encodedSize": None, "runtime": None, "status": 0})
+    except (OSError, ValueError) as e:
+        job["log"].write("Cannot read segments of {}: {}\n"
+                         .format(job["inpfile"], e))
+        return(None)
+
+    job["events"].append(("split", segments))
+
+    return(segments)
+
+
+def encodedSegmentFile(segment):
+    """
+    Name of the encoded file of a segment
+    """
+
+    return("encoded{:05d}.mkv".format(segment["number"]))
+
+
+def segmentMuxOptions(job):
+    """
+    Stream options of the final pass of a segmented encode: the encoded
+    video out of the concatenated segments (second input), the other
+    streams out of the source, copied or as the stream rules say. Further
+    video streams of the source, e.g. cover pictures, are left out.
+    """
+
+    disabledTypes = set(stream_type_disable_options[value]
+                        for value in job["options"].values()
+                        if value in stream_type_disable_options)
+    streams = job["probe"]["streams"] if job.get("probe") else []
+
+    if not streams:
+        muxOptions = ["-map", "1:0", "-map", "0", "-map", "-0:v"]
+        for streamType in sorted(disabledTypes - {"video"}):
+            muxOptions.extend(["-map", "-0:" + streamType[0]])
+        return(muxOptions + ["-c", "copy"])
+
+    mapOptions = ["-map", "1:0"]
+    codecOptions = ["-c", "copy"]
+    for position, stream in enumerate(streams):
+        if stream["codec_type"] in disabledTypes | {"video"}:
+            continue
+        action = next((rule["action"] for rule in job["streamRules"] or []
+                       if streamMatches(rule, stream)), None)
+        if action and action[0] == "drop":
+            continue
+        outputIndex = len(mapOptions) // 2
+        mapOptions.extend(["-map", "0:{}".format(position)])
+        if action:
+            codecOptions.extend(["-c:{}".format(outputIndex), action[0]])
+            if len(action) > 1:
+                codecOptions.extend(["-b:{}".format(outputIndex),
+                                     action[1]])
+
+    return(mapOptions + codecOptions)
+
+
+def clearEncodedSegments(job, segments):
+    """
+    Runs in the worker thread. Segments encoded by an earlier run with
+    other options are encoded again, the options of the encoded segments
+    are kept in the segment folder.
+    """
+
+    optionsFile = os.path.join(job["segmentFolder"], "options.txt")
+
+    try:
+        with open(optionsFile) as f:
+            if f.read() == job["encodeOptions"]:
+                return
+    except OSError:
+        pass
+
+    for segment in segments:
+        segment["status"] = 0
+        try:
+            os.remove(os.path.join(job["segmentFolder"],
+                                   encodedSegmentFile(segment)))
+        except OSError:
+            pass
+
+    with open(optionsFile, "w") as f:
+        f.write(job["encodeOptions"])
+
+
+def encodeSegments(job):
+    """
+    Runs in the worker thread instead of waiting for a single encoder.
+    Split the video of the input (unless done by an earlier run), encode
+    the missing segments segment_parallel_jobs at a time and put them
+    together with the other streams of the source into the temporary
+    output file. Finished segments are reported to the main thread
+    through job["events"].
+    Returns the return code like an encoder.
+    """
+
+    segmentFolder = job["segmentFolder"]
+    segments = job["segments"]
+
+    if not segments or not all(os.path.isfile(os.path.join(
+            segmentFolder, segment["file"])) for segment in segments):
+        segments = splitSegments(job)
+        if not segments:
+            return(1)
+
+    try:
+        clearEncodedSegments(job, segments)
+    except OSError as e:
+        job["log"].write("Cannot clear segments of {}: {}\n"
+                         .format(job["inpfile"], e))
+        return(1)
+
+    parallelJobs = max(1, getIntOption(job["applicationOption"],
+                                       "segment_parallel_jobs", 1))
+    threadCount = job["threadCount"]
+    if threadCount > 0:
+        threadCount = max(1, threadCount // parallelJobs)
+
+    pending = [segment for segment in segments if segment["status"] != 1 or
+               not os.path.isfile(os.path.join(segmentFolder,
+                                               encodedSegmentFile(segment)))]
+    doneSeconds = sum(segment["end"] - segment["start"]
+                      for segment in segments if segment not in pending)
+    encodedSize = sum(segment["encodedSize"] or 0
+                      for segment in segments if segment not in pending)
+    runSeconds = 0.0
+    start = time.time()
+
+    running = {}
+    returnCode = 0
+    while running or (pending and not returnCode):
+        while pending and not returnCode and len(running) < parallelJobs:
+            segment = pending.pop(0)
+            encodedFile = os.path.join(segmentFolder,
+                                       encodedSegmentFile(segment))
+            # Left over by an interrupted run, ffmpeg would ask to overwrite
+            if os.path.isfile(encodedFile + ".tmp.mkv"):
+                os.remove(encodedFile + ".tmp.mkv")
+            process = startJobProcess(job, buildExecOptions(
+                job["options"], os.path.join(segmentFolder, segment["file"]),
+                encodedFile + ".tmp.mkv", threadCount, progress=False))
+            if not process:
+                returnCode = 1
+                break
+            running[process] = (segment, encodedFile, time.time())
+
+        time.sleep(0.5)
+
+        for process, (segment, encodedFile, segmentStart) in list(
+                running.items()):
+            if process.poll() is None:
+                continue
+            del running[process]
+            if process.returncode:
+                # Stop the other segments, the file has failed
+                returnCode = process.returncode
+                for otherProcess in running:
+                    otherProcess.terminate()
+                continue
+            os.replace(encodedFile + ".tmp.mkv", encodedFile)
+            segment.update({"status": 1,
+                            "encodedSize": os.path.getsize(encodedFile),
+                            "runtime": time.time() - segmentStart})
+            job["events"].append(("done", segment))
+            doneSeconds += segment["end"] - segment["start"]
+            runSeconds += segment["end"] - segment["start"]
+            encodedSize += segment["encodedSize"]
+            # Same keys as ffmpeg -progress for the running_job update
+            job["progress"] = {
+                "out_time_us": str(int(doneSeconds * 1000000)),
+                "total_size": str(encodedSize),
+                "speed": "{:.3f}x".format(runSeconds /
+                                          max(time.time() - start, 0.001)),
+                "progress": "continue"}
+
+    if returnCode:
+        return(returnCode)
+
+    concatFile = os.path.join(segmentFolder, "concat.txt")
+    with open(concatFile, "w") as f:
+        for segment in segments:
+            f.write("file '{}'\n".format(encodedSegmentFile(segment)))
+
+    process = startJobProcess(job, [
+        job["options"][min(job["options"])], "-i", job["inpfile"],
+        "-f", "concat", "-safe", "0", "-i", concatFile] +
+        segmentMuxOptions(job) + [job["outfile"]])
+    if not process:
+        return(1)
+
+    return(process.wait())
+
+
+def startEncodeProcess(job):
+    """
+    Runs in the worker thread. Start the encoder of a job, which had to
+    wait for its quality search. Returns the process or None.
+    """
+
+    execOptions = buildExecOptions(job["options"], job["inpfile"],
+                                   job["outfile"], job["threadCount"],
+                                   renditions=job["renditions"],
+                                   streamOptions=job["streamOptions"])
+
+    # Progress goes through a pipe, everything else into the logfile
+    if execOptions[1:3] == ["-progress", "pipe:1"]:
+        job["process"] = startJobProcess(job, execOptions,
+                                         stdout=subprocess.PIPE,
+                                         stderr=job["log"])
+    else:
+        job["process"] = startJobProcess(job, execOptions)
+
+    return(job["process"])
+
+
+def extractSampleClips(job, sampleFolder):
+    """
+    Runs in the worker thread. Copy quality_sample_count clips of
+    quality_sample_seconds of the video stream, spread evenly over the
+    input, without encoding.
+    Returns the list of sample files or None on error.
+    """
+
+    applicationOption = job["applicationOption"]
+    sampleCount = max(1, getIntOption(applicationOption,
+                                      "quality_sample_count", 3))
+    sampleSeconds = max(1, getIntOption(applicationOption,
+                                        "quality_sample_seconds", 10))
+    duration = job["probe"]["duration_seconds"]
+    sampleCount = min(sampleCount, max(1, int(duration // sampleSeconds)))
+
+    samples = []
+    for number in range(sampleCount):
+        position = max(0.0, duration * (number + 1) / (sampleCount + 1) -
+                       sampleSeconds / 2)
+        sampleFile = os.path.join(sampleFolder,
+                                  "sample{:02d}.mkv".format(number))
+        process = startJobProcess(job, [
+            job["options"][min(job["options"])], "-ss",
+            "{:.3f}".format(position), "-i", job["inpfile"], "-t",
+            str(sampleSeconds), "-map", "0:v:0", "-c", "copy", sampleFile])
+        if not process or process.wait():
+            return(None)
+        samples.append(sampleFile)
+
+    return(samples)
+
+
+def encodeSampleClip(job, Options, sampleFile):
+    """
+    Runs in the worker thread. Encode one sample clip with the options,
+    unless it has been encoded with the same options before.
+    Returns the encoded file or None on error.
+    """
+
+    encodedFile = "{}.{}.mkv".format(sampleFile[:-4], hashlib.sha1(
+        encodeOptionsText(Options).encode()).hexdigest()[:12])
+    if os.path.isfile(encodedFile):
+        return(encodedFile)
+
+    process = startJobProcess(job, buildExecOptions(
+        Options, sampleFile, encodedFile + ".tmp.mkv", job["threadCount"],
+        progress=False))
+    if not process or process.wait():
+        return(None)
+    os.replace(encodedFile + ".tmp.mkv", encodedFile)
+
+    return(encodedFile)
+
+
+def measureQuality(job, encodedFile, sampleFile, metric):
+    """
+    Runs in the worker thread. Compare an encoded sample with its source.
+    Returns the mean score of the metric or None on error, e.g. if ffmpeg
+    is built without the filter.
+    """
+
+    qualityFilter, scorePattern = quality_metric_filters[metric]
+
+    process = startJobProcess(job, [
+        job["options"][min(job["options"])], "-nostats", "-i", encodedFile,
+        "-i", sampleFile, "-lavfi", "[0:v][1:v]" + qualityFilter,
+        "-f", "null", "-"], stderr=subprocess.PIPE)
+    if not process:
+        return(None)
+
+    output = process.communicate()[1].decode(errors="replace")
+    scores = re.findall(scorePattern, output)
+    if process.returncode or not scores:
+        job["log"].write("Cannot measure {} of {}: {}\n"
+                         .format(metric, encodedFile, output[-500:]))
+        return(None)
+
+    return(float(scores[-1]))
+
+
+def scoreQualityCrf(job, samples, crf, metric):
+    """
+    Runs in the worker thread. Encode the samples with one crf and return
+    their mean score, or None on error
+    """
+
+    Options = dict(job["options"])
+    Options[crfOptionKey(Options)] = str(crf)
+
+    scores = []
+    for sampleFile in samples:
+        encodedFile = encodeSampleClip(job, Options, sampleFile)
+        if not encodedFile:
+            return(None)
+        score = measureQuality(job, encodedFile, sampleFile, metric)
+        if score is None:
+            return(None)
+        scores.append(score)
+
+    return(sum(scores) / len(scores))
+
+
+def searchQualityCrf(job, samples):
+    """
+    Runs in the worker thread before the encode. Keep the highest crf
+    between quality_crf_min and quality_crf_max, whose mean score over the
+    samples reaches quality_target. A binary search needs only a few tries.
+    The choice is reported to the main thread through job["events"]; on
+    error the configured crf is kept.
+    """
+
+    applicationOption = job["applicationOption"]
+    metric = applicationOption["quality_metric"]
+    target = getFloatOption(applicationOption, "quality_target")
+    crfMin = getIntOption(applicationOption, "quality_crf_min", 18)
+    crfMax = max(crfMin, getIntOption(applicationOption, "quality_crf_max",
+                                      30))
+    start = time.time()
+
+    scores = {}
+    low, high = crfMin, crfMax
+    while low <= high:
+        crf = (low + high) // 2
+        scores[crf] = scoreQualityCrf(job, samples, crf, metric)
+        if scores[crf] is None:
+            return
+        job["log"].write("Quality search: crf {} {} {:.4f}\n"
+                         .format(crf, metric, scores[crf]))
+        if scores[crf] >= target:
+            low = crf + 1
+        else:
+            high = crf - 1
+
+    # Even the lowest crf misses the target: best quality of the range
+    crf = max(high, crfMin)
+    applyCrf(job, crf)
+    job["events"].append(("quality", {"crf": crf, "score": scores[crf],
+                                      "metric": metric,
+                                      "options": job["options"],
+                                      "seconds": time.time() - start}))
+
+
+def predictSavings(job, samples):
+    """
+    Runs in the worker thread before the encode. Encode the samples with
+    the final options and extrapolate the size of the optimized file; only
+    the video stream shrinks, the others are copied.
+    The prediction is reported to the main thread through job["events"].
+    Returns the reason to skip the file, if less than savings_min_percent
+    would be saved, or None.
+    """
+
+    sampleSize = 0
+    encodedSize = 0
+    for sampleFile in samples:
+        encodedFile = encodeSampleClip(job, job["options"], sampleFile)
+        if not encodedFile:
+            return(None)
+        sampleSize += os.path.getsize(sampleFile)
+        encodedSize += os.path.getsize(encodedFile)
+    if not sampleSize:
+        return(None)
+
+    originalSize = job["originalSize"]
+    videoSize = originalSize
+    if job["probe"]["video_bitrate"]:
+        videoSize = min(originalSize, job["probe"]["video_bitrate"] *
+                        job["probe"]["duration_seconds"] / 8)
+    predictedSize = int(originalSize - videoSize *
+                        (1 - encodedSize / sampleSize))
+    savingsPercent = 100 * (1 - predictedSize / max(originalSize, 1))
+
+    job["log"].write("Predicted size {} ({:.1f}% saving)\n"
+                     .format(predictedSize, savingsPercent))
+    job["events"].append(("prediction", {"size": predictedSize}))
+
+    if savingsPercent < getFloatOption(job["applicationOption"],
+                                       "savings_min_percent"):
+        return("samples predict {:.1f}% saving".format(savingsPercent))
+
+    return(None)
+
+
+def checkSampleClips(job):
+    """
+    Runs in the worker thread before the encode. Search the crf and
+    predict the savings on sample clips of the input, as far as enabled
+    for the job. Clips encoded by the search are reused by the prediction.
+    Returns the reason to skip the file or None.
+    """
+
+    sampleFolder = os.path.join(job["segmentFolder"], "samples")
+
+    shutil.rmtree(sampleFolder, ignore_errors=True)
+    try:
+        os.makedirs(sampleFolder)
+    except OSError as e:
+        job["log"].write("Cannot create {}: {}\n".format(sampleFolder, e))
+        return(None)
+
+    try:
+        samples = extractSampleClips(job, sampleFolder)
+        if not samples:
+            return(None)
+        if job["qualitySearch"]:
+            searchQualityCrf(job, samples)
+        if job["predictSavings"]:
+            return(predictSavings(job, samples))
+    finally:
+        shutil.rmtree(sampleFolder, ignore_errors=True)
+        # Only left, if the file is encoded in segments
+        try:
+            os.rmdir(job["segmentFolder"])
+        except OSError:
+            pass
+
+    return(None)
+
+
+def moveRenditions(job):
+    """
+    Runs in an I/O thread. Move the renditions of a job off the scratch
+    folder next to the source.
+    Returns 1 if one of them could not be moved, otherwise 0.
+    """
+
+    for rendition in job["renditions"]:
+        if rendition["outfile"] == rendition["localOutfile"]:
+            continue
+        try:
+            shutil.move(rendition["outfile"], rendition["localOutfile"])
+        except (OSError, shutil.Error) as e:
+            job["messages"].append("Cannot move {} to {}: {}"
+                                   .format(rendition["outfile"],
+                                           rendition["localOutfile"], e))
+            return(1)
+        rendition["outfile"] = rendition["localOutfile"]
+
+    return(0)
+
+
+def renameRenditions(job):
+    """
+    Runs in an I/O thread. Give the renditions of a successful job their
+    final name; they don't replace anything, so before the original is
+    removed. The size of a renamed rendition is kept in the rendition.
+    """
+
+    for rendition in job["renditions"]:
+        try:
+            os.rename(rendition["outfile"], rendition["tgtfile"])
+            rendition["size"] = os.path.getsize(rendition["tgtfile"])
+        except OSError as e:
+            job["messages"].append("Cannot rename file {} to {}: {}"
+                                   .format(rendition["outfile"],
+                                           rendition["tgtfile"], e))
+
+
+def recordRenditions(conn, job, status):
+    """
+    Record the renditions of a finished job, the successful ones only if
+    they got their final name
+    """
+
+    c = conn.cursor()
+
+    for rendition in job["renditions"]:
+        renditionSize = rendition.get("size")
+        if status == 1 and renditionSize is None:
+            continue
+        c.execute("INSERT OR REPLACE INTO file_rendition (real_folder_id, "
+                  "file_name, rendition_name, rendition_file_name, "
+                  "rendition_extension, encode_options, rendition_size, "
+                  "rendition_status, finished_at) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                  [job["realFolderId"], job["fileName"], rendition["name"],
+                   rendition["fileName"], rendition["extension"],
+                   " ".join(rendition["options"]), renditionSize, status,
+                   datetime.now()])
+        if status == 1:
+            writeActivityLog(conn, "Finished rendition {}"
+                             .format(rendition["tgtfile"]))
+
+    c.close()
+
+
+def finishProcessFile(conn, jobPool, job, returnCode):
+    """
+    The encoder of one job has finished. Release its worker and hand the
+    file system work over to the I/O pool (finalizeProcessFile), the
+    result is recorded once that is done (recordProcessFile).
+    """
+
+    c = conn.cursor()
+
+    thisRealFolderId = job["realFolderId"]
+    thisFileName = job["fileName"]
+
+    c.execute("DELETE FROM running_job "
+              "WHERE real_folder_id = ? AND file_name = ?",
+              [thisRealFolderId, thisFileName])
+
+    # Without heartbeat for too long, another node may have taken over
+    c.execute("SELECT lease_node FROM folder_optimize_file "
+              "WHERE real_folder_id = ? AND file_name = ? "
+              "AND file_status = 2", [thisRealFolderId, thisFileName])
+    row = c.fetchone()
+    job["leaseLost"] = not row or row[0] != nodeName
+    if job["leaseLost"]:
+        writeActivityLog(conn, "Lease of file {} was lost to node {}, drop "
+                         "result".format(job["inpfile"],
+                                         row[0] if row else None))
+    elif job["segments"] is not None:
+        # Segments are only kept to continue an interrupted file
+        c.execute("DELETE FROM file_segment "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [thisRealFolderId, thisFileName])
+
+    # A waiting or claimed file of the same size may be a copy of this one,
+    # hash the whole source before it is removed, so its result can be
+    # reused
+    c.execute("SELECT 1 FROM file_fingerprint AS ff "
+              "WHERE ff.real_folder_id = ? AND ff.file_name = ? "
+              "AND ff.full_hash IS NULL "
+              "AND EXISTS (SELECT 1 FROM folder_optimize_file AS other "
+              "WHERE other.original_size = ff.file_size "
+              "AND other.file_status IN (0, 2) "
+              "AND (other.real_folder_id <> ff.real_folder_id "
+              "OR other.file_name <> ff.file_name))",
+              [thisRealFolderId, thisFileName])
+    job["hashSource"] = (not job["leaseLost"] and
+                         c.fetchone() is not None)
+
+    conn.commit()
+    c.close()
+
+    jobPool["finalizing"][jobPool["ioExecutor"].submit(
+        finalizeProcessFile, job, returnCode)] = job
+
+
+def finalizeProcessFile(job, returnCode):
+    """
+    Runs in an I/O thread after the encoder of a job, while the worker
+    encodes the next file: move the results off the scratch folder,
+    replace the original file with the optimized one and remove the
+    logfile. Don't touch the repository here, messages for the activity
+    log are collected in job["messages"].
+    Returns the return code, 1 if a result could not be moved.
+    """
+
+    inpfile = job["inpfile"]
+    outfile = job["outfile"]
+    logfile = job["logfile"]
+    renditionFiles = [rendition["outfile"] for rendition in job["renditions"]]
+
+    if job["leaseLost"]:
+        for thisFile in [outfile, logfile] + renditionFiles:
+            try:
+                os.remove(thisFile)
+            except OSError:
+                pass
+        return(returnCode)
+
+    if job["segments"] is not None:
+        shutil.rmtree(job["segmentFolder"], ignore_errors=True)
+
+    # Move the result off the scratch folder next to the source first, the
+    # original is only removed once it is complete there
+    if not job["skipReason"] and not returnCode and (
+            outfile != job["localOutfile"]):
+        try:
+            shutil.move(outfile, job["localOutfile"])
+        except (OSError, shutil.Error) as e:
+            job["messages"].append("Cannot move {} to {}: {}"
+                                   .format(outfile, job["localOutfile"], e))
+            for thisFile in (outfile, job["localOutfile"]):
+                try:
+                    os.remove(thisFile)
+                except OSError:
+                    pass
+            returnCode = 1
+        else:
+            outfile = job["localOutfile"]
+            job["outfile"] = outfile
+    if not job["skipReason"] and not returnCode:
+        returnCode = moveRenditions(job)
+    if not job["skipReason"] and not returnCode:
+        try:
+            job["fileSize"] = os.path.getsize(outfile)
+            job["fileDate"] = datetime.fromtimestamp(
+                os.path.getmtime(outfile)).strftime("%Y-%m-%d %H:%M:%S")
+        except OSError as e:
+            # Only this job failed, the original is kept
+            job["messages"].append("Cannot read result {}: {}"
+                                   .format(outfile, e))
+            returnCode = 1
+
+    # Outputs of a failed encode are useless
+    if job["skipReason"] or returnCode:
+        for rendition in job["renditions"]:
+            for thisFile in (rendition["outfile"], rendition["localOutfile"]):
+                try:
+                    os.remove(thisFile)
+                except OSError:
+                    pass
+
+    if job["skipReason"]:
+        for thisFile in (outfile, logfile):
+            try:
+                os.remove(thisFile)
+            except OSError:
+                pass
+        return(returnCode)
+
+    if returnCode:
+        return(returnCode)
+
+    renameRenditions(job)
+
+    if job.get("hashSource"):
+        job["fullHash"] = hashFile(inpfile, 0, True)
+
+    try:
+        os.remove(inpfile)
+    except:
+        job["messages"].append("Error, cannot remove ori file {}!"
+                               .format(inpfile))
+    else:
+        try:
+            os.rename(outfile, job["tgtfile"])
+        except:
+            job["messages"].append("Cannot rename file {} to {}"
+                                   .format(outfile, job["tgtfile"]))
+        else:
+            try:
+                os.remove(logfile)
+            except:
+                job["messages"].append("Error, cannot remove logfile {}!"
+                                       .format(logfile))
+
+    return(returnCode)
+
+
+def reuseResult(job, future):
+    """
+    Outcome of reuseIdenticalFile in the I/O pool, an unexpected error lets
+    the file be encoded
+    """
+
+    try:
+        return(future.result())
+    except OSError as e:
+        return({"outcome": "error", "identicalFile": None, "candidate": None,
+                "fullHashes": [], "messages": [
+                    "Error reusing a result for file {}: {}"
+                    .format(job["inpfile"], e)]})
+
+
+def finalizeResult(job, future):
+    """
+    Return code of a finalized job; an unexpected file system error fails
+    only this job, not the whole pool
+    """
+
+    try:
+        return(future.result())
+    except OSError as e:
+        job["messages"].append("Error finalizing file {}: {}"
+                               .format(job["inpfile"], e))
+        return(1)
+
+
+def recordProcessFile(conn, job, returnCode):
+    """
+    The file system work of one job has finished. Record the result.
+    """
+
+    writeActivityLogs(conn, job["messages"])
+    if job["leaseLost"]:
+        return
+
+    c = conn.cursor()
+
+    thisRealFolderId = job["realFolderId"]
+    thisFileName = job["fileName"]
+    inpfile = job["inpfile"]
+
+    if job["skipReason"]:
+        c.execute("UPDATE folder_optimize_file "
+                  "SET file_status = ?, skip_reason = ?, "
+                  "    runtime_seconds = ?, "
+                  "    lease_node = NULL, lease_expires_at = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [3, job["skipReason"], job["runtime"], thisRealFolderId,
+                   thisFileName])
+        writeActivityLog(conn, "Skipped file {}: {}"
+                         .format(inpfile, job["skipReason"]))
+    elif returnCode:
+        recordEncodeHistory(conn, job, returnCode, None)
+        writeActivityLog(conn, "Error processing file {}".format(inpfile))
+        c.execute("UPDATE folder_optimize_file "
+                  "SET file_status = ?, runtime_seconds = ?, "
+                  "    lease_node = NULL, lease_expires_at = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [99, job["runtime"], thisRealFolderId, thisFileName])
+        recordRenditions(conn, job, 99)
+    else:
+        recordRenditions(conn, job, 1)
+        if job.get("fullHash"):
+            c.execute("UPDATE file_fingerprint SET full_hash = ? "
+                      "WHERE real_folder_id = ? AND file_name = ?",
+                      [job["fullHash"], thisRealFolderId, thisFileName])
+        c.execute("UPDATE folder_optimize_file "
+                  "SET file_status = ?, runtime_seconds = ?, "
+                  "    optimized_size = ?, optimized_file_date = ?, "
+                  "    lease_node = NULL, lease_expires_at = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [1, job["runtime"], job["fileSize"], job["fileDate"],
+                   thisRealFolderId, thisFileName])
+        recordEncodeHistory(conn, job, returnCode, job["fileSize"])
+        writeActivityLog(conn, "Finished processing file {}"
+                         .format(inpfile))
+
+    conn.commit()
+    c.close()
+
+
+def folderHasRoom(job, folderRunning):
+    """
+    Check if the watch folder of a job has not yet reached its own limit
+    of parallel jobs
+    """
+
+    folderLimit = getIntOption(job["applicationOption"], "max_parallel_jobs")
+
+    return(folderLimit <= 0 or
+           folderRunning.get(job["watchFolderId"], 0) < folderLimit)
+
+
+def nextStartableJob(jobs, folderRunning, preparing):
+    """
+    Take the next job out of the list, whose watch folder has room and
+    which has been prepared by the I/O pool and isn't being prepared again
+    """
+
+    for index, job in enumerate(jobs):
+        if (folderHasRoom(job, folderRunning) and preparedFresh(job) and
+                (job["realFolderId"], job["fileName"]) not in preparing):
+            return(jobs.pop(index))
+
+    return(None)
+
+
+def createJobPool(workerCount, applicationOption):
+    """
+    Create the state of a pool of workerCount encoder workers and a small
+    pool for the file system work before and after the encodes
+    """
+
+    return({"executor": concurrent.futures.ThreadPoolExecutor(
+                max_workers=workerCount),
+            "ioExecutor": concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, getIntOption(applicationOption,
+                                                "io_parallel_jobs", 2))),
+            "workerCount": workerCount,
+            "applicationOption": applicationOption,
+            "throttled": None,
+            "freeSlots": list(range(workerCount, 0, -1)),
+            "running": {},
+            "finalizing": {},
+            "preparing": {},
+            "reusing": {},
+            "requeued": [],
+            "folderRunning": {},
+            "progressUpdatedAt": time.time()})
+
+
+def pauseJobs(jobPool, paused):
+    """
+    Stop (SIGSTOP) or continue (SIGCONT) the processes of all running jobs.
+    Processes started by a worker while paused are stopped right away.
+    """
+
+    for job in jobPool["running"].values():
+        with job["processLock"]:
+            job["paused"] = paused
+            for process in job["processes"]:
+                if process.poll() is None:
+                    process.send_signal(signal.SIGSTOP if paused
+                                        else signal.SIGCONT)
+
+
+def throttleJobs(conn, jobPool):
+    """
+    Pause the running jobs while the system is busy or outside of
+    encode_hours and continue them afterwards
+    """
+
+    reason = throttleReason(jobPool["applicationOption"],
+                            jobPool["throttled"])
+
+    if reason and not jobPool["throttled"]:
+        pauseJobs(jobPool, True)
+        writeActivityLog(conn, "Pause encodes: {}".format(reason))
+    elif not reason and jobPool["throttled"]:
+        pauseJobs(jobPool, False)
+        writeActivityLog(conn, "Continue encodes")
+
+    jobPool["throttled"] = reason
+
+
+def startJobs(conn, jobPool, jobs):
+    """
+    Start jobs out of the list as long as there are free workers and
+    encodes are not throttled
+    """
+
+    folderRunning = jobPool["folderRunning"]
+
+    collectPreparedJobs(conn, jobPool)
+
+    # Files left to encode after looking for an identical one go first
+    jobs[:0] = jobPool["requeued"]
+    del jobPool["requeued"][:]
+
+    if jobs and jobPool["freeSlots"]:
+        throttleJobs(conn, jobPool)
+        if jobPool["throttled"]:
+            return
+
+    while jobPool["freeSlots"]:
+        job = nextStartableJob(jobs, folderRunning, jobPool["preparing"])
+        if not job:
+            break
+        workerSlot = jobPool["freeSlots"].pop()
+        if not startProcessFile(conn, job, workerSlot,
+                                jobPool["workerCount"]):
+            jobPool["freeSlots"].append(workerSlot)
+            continue
+        if job.get("candidateFiles"):
+            jobPool["freeSlots"].append(workerSlot)
+            jobPool["reusing"][jobPool["ioExecutor"].submit(
+                reuseIdenticalFile, job)] = job
+            continue
+        folderRunning[job["watchFolderId"]] = folderRunning.get(
+            job["watchFolderId"], 0) + 1
+        jobPool["running"][jobPool["executor"].submit(waitProcessFile,
+                                                      job)] = job
+
+    prepareJobs(jobPool, jobs)
+
+
+def prepareJobs(jobPool, jobs):
+    """
+    Prepare the next startable jobs of the queue, one per worker, in the
+    I/O pool, so they are ready to start when a worker gets free
+    """
+
+    preparing = jobPool["preparing"]
+    folderRunning = jobPool["folderRunning"]
+
+    nextJobs = [job for job in jobs if folderHasRoom(job, folderRunning)]
+    for job in nextJobs[:jobPool["workerCount"]]:
+        key = (job["realFolderId"], job["fileName"])
+        prepared = job.get("prepared")
+        if key in preparing or (prepared and time.time() -
+                                prepared["checkedAt"] <
+                                progress_update_seconds):
+            continue
+        preparing[key] = (jobPool["ioExecutor"].submit(prepareJob, job), job)
+
+
+def collectPreparedJobs(conn, jobPool):
+    """
+    Hand the results of the I/O pool over to their jobs and keep new probes
+    in the repository. A missing probe program is reported once per run,
+    its files stay unprobed.
+    Returns the number of jobs prepared.
+    """
+
+    global probeProgramMissing
+
+    preparing = jobPool["preparing"]
+    collected = 0
+
+    for key, (future, job) in list(preparing.items()):
+        if not future.done():
+            continue
+        del preparing[key]
+        collected += 1
+        try:
+            prepared = future.result()
+        except OSError as e:
+            prepared = {"checkedAt": time.time(), "messages": [],
+                        "error": "Error preparing file {}: {}"
+                        .format(job["fileName"], e)}
+        if prepared.get("probe"):
+            saveFileProbe(conn, job, prepared["probe"])
+            conn.commit()
+            job["probe"] = prepared["probe"]
+            job["options"] = prepared["options"]
+        if prepared.get("sampleHash"):
+            saveFileFingerprint(conn, job, prepared["sampleHash"])
+            conn.commit()
+            job["sampleHash"] = prepared["sampleHash"]
+        if prepared.get("probeMissing") and not probeProgramMissing:
+            probeProgramMissing = True
+            writeActivityLog(conn, "Error, {} not found, files are not "
+                             "probed".format(prepared["probeMissing"]))
+        job["prepared"] = prepared
+
+    return(collected)
+
+
+def finishJobs(conn, jobPool, timeout=None):
+    """
+    Wait up to timeout seconds (None = until at least one job is done) for
+    the running, finalizing, preparing and reusing jobs. Encodes done are
+    handed over to the I/O pool and free their worker, finalized jobs are
+    recorded, prepared ones are ready to start. Jobs without a result to
+    reuse are queued again. Returns the list of finished jobs.
+    """
+
+    running = jobPool["running"]
+    finalizing = jobPool["finalizing"]
+    preparing = jobPool["preparing"]
+    reusing = jobPool["reusing"]
+    finished = []
+
+    # A job just prepared can start right away
+    if collectPreparedJobs(conn, jobPool) and jobPool["freeSlots"]:
+        return(finished)
+    if not running and not finalizing and not preparing and not reusing:
+        return(finished)
+
+    # Jobs run for hours, don't keep their log entries in memory
+    flushActivityLog(conn)
+
+    # Wake up regularly to publish the progress of the running jobs
+    progressDue = (jobPool["progressUpdatedAt"] + progress_update_seconds -
+                   time.time())
+    if timeout is None or timeout > progressDue:
+        waitTimeout = max(0, progressDue)
+    else:
+        waitTimeout = timeout
+
+    while True:
+        done, notDone = concurrent.futures.wait(
+            list(running) + list(finalizing) + list(reusing) +
+            [future for future, job in preparing.values()],
+            timeout=waitTimeout,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        if (time.time() >= jobPool["progressUpdatedAt"] +
+                progress_update_seconds):
+            throttleJobs(conn, jobPool)
+            updateJobProgress(conn, jobPool)
+            publishMetrics(conn, jobPool["applicationOption"])
+        if done or timeout is not None:
+            break
+        waitTimeout = progress_update_seconds
+    for future in done:
+        if future in running:
+            job = running.pop(future)
+            saveJobEvents(conn, job)
+            finishProcessFile(conn, jobPool, job, future.result())
+            jobPool["freeSlots"].append(job["workerSlot"])
+            jobPool["folderRunning"][job["watchFolderId"]] -= 1
+        elif future in finalizing:
+            job = finalizing.pop(future)
+            recordProcessFile(conn, job, finalizeResult(job, future))
+            finished.append(job)
+        elif future in reusing:
+            job = reusing.pop(future)
+            if not recordIdenticalFile(conn, job, reuseResult(job, future)):
+                job.update({"candidateFiles": None, "reuseChecked": True})
+                jobPool["requeued"].append(job)
+
+    return(finished)
+
+
+def abortJobs(conn, jobPool):
+    """
+    Stop all running encoders, e.g. when terminated by a signal.
+    The files are set back to be processed again next time. Finalizing
+    jobs and reuses are not interrupted, the original must not get lost in
+    a move.
+    """
+
+    c = conn.cursor()
+
+    for future, job in list(jobPool["finalizing"].items()):
+        recordProcessFile(conn, job, finalizeResult(job, future))
+        del jobPool["finalizing"][future]
+
+    for future, job in list(jobPool["reusing"].items()):
+        recordIdenticalFile(conn, job, reuseResult(job, future))
+        del jobPool["reusing"][future]
+
+    for future, job in list(jobPool["running"].items()):
+        with job["processLock"]:
+            job["aborted"] = True
+            for process in job["processes"]:
+                process.terminate()
+                # A stopped process only ends when it continues
+                if job["paused"]:
+                    process.send_signal(signal.SIGCONT)
+        future.result()
+        # Finished segments are kept for the next run
+        saveJobEvents(conn, job)
+        for thisFile in [job["outfile"], job["logfile"]] + [
+                rendition["outfile"] for rendition in job["renditions"]]:
+            try:
+                os.remove(thisFile)
+            except OSError:
+                pass
+        c.execute("DELETE FROM running_job "
+                  "WHERE real_folder_id = ? AND file_name = ?",
+                  [job["realFolderId"], job["fileName"]])
+        c.execute("UPDATE folder_optimize_file "
+                  "SET file_status = ?, optimization_started_at = NULL, "
+                  "optimized_extension = NULL, encode_options = NULL, "
+                  "lease_node = NULL, lease_expires_at = NULL, "
+                  "encode_node = NULL "
+                  "WHERE real_folder_id = ? AND file_name = ? "
+                  "AND lease_node = ?",
+                  [0, job["realFolderId"], job["fileName"], nodeName])
+        writeActivityLog(conn, "Aborted processing file {}"
+                         .format(job["inpfile"]))
+        del jobPool["running"][future]
+
+    jobPool["executor"].shutdown()
+    jobPool["ioExecutor"].shutdown()
+
+    flushActivityLog(conn)
+    c.close()
+
+
+def runJobPool(conn, jobs, workerCount, applicationOption):
+    """
+    Process all jobs with a pool of workerCount encoders.
+    The workers only wait for their encoder process, file checks and moves
+    run in the I/O pool, every repository update is done here in the main
+    thread and is keyed by real folder and file name, so jobs can finish
+    in any order.
+    """
+
+    jobPool = createJobPool(workerCount, applicationOption)
+
+    try:
+        while True:
+            startJobs(conn, jobPool, jobs)
+            if (not jobPool["running"] and not jobPool["finalizing"] and
+                    not jobPool["preparing"] and not jobPool["reusing"]):
+                # The files left are processed by the next run
+                if jobs and jobPool["throttled"]:
+                    writeActivityLog(conn, "Stopped with {} files left, "
+                                     "encodes are paused: {}"
+                                     .format(len(jobs),
+                                             jobPool["throttled"]))
+                break
+            # Back regularly to check the next jobs ahead
+            finishJobs(conn, jobPool, timeout=progress_update_seconds)
+    finally:
+        abortJobs(conn, jobPool)
+
+
+def folderFileState(folderEntries, thisName):
+    """
+    Size and date of a file out of a folder listing (name => DirEntry),
+    or None if not there. DirEntry caches the stat result.
+    """
+
+    entry = folderEntries.get(thisName)
+    if entry is None:
+        return(None)
+
+    try:
+        countProfile("stat_calls")
+        fileStat = entry.stat()
+    except OSError:
+        return(None)
+
+    return(fileStat.st_size, datetime.fromtimestamp(fileStat.st_mtime).strftime("%Y-%m-%d %H:%M:%S"))
+
+
+def cleanupRealFolder(conn, thisRealFolderId, thisRealFolderName, counters):
+    """
+    Sync all unprocessed, processed and failed files of one real folder
+    with the directory. The folder is listed once, every file is stat'ed at
+    most once, and all changes are applied in one transaction.
+    counters is a dictionary of [cleaned, deleted] per file status.
+    """
+
+    c = conn.cursor()
+
+    try:
+        countProfile("directory_listings")
+        with os.scandir(thisRealFolderName) as entries:
+            folderEntries = dict((entry.name, entry) for entry in entries)
+    except FileNotFoundError:
+        folderEntries = {}
+    except OSError as e:
+        writeActivityLog(conn, "Cleanup cannot read folder {}: {}"
+                         .format(thisRealFolderName, e))
+        c.close()
+        return
+
+    deleteRows = []
+    updateRows = []
+    resetRows = []
+
+    c.execute("SELECT file_name, file_status, original_extension, "
+              "original_file_date, original_size, optimized_extension, "
+              "optimized_size "
+              "FROM folder_optimize_file "
+              "WHERE real_folder_id = ? AND file_status IN (0, 1, 3, 99)",
+              [thisRealFolderId])
+
+    for (thisFileName, thisStatus, thisOriginalExtension,
+            thisOriginalFileDate, thisOriginalSize, thisOptimizedExtension,
+            thisOptimizedSize) in c.fetchall():
+
+        if thisStatus == 0:
+            state = folderFileState(folderEntries, thisFileName + "." +
+                                    thisOriginalExtension)
+            if not state:
+                counters[0][1] += 1
+                if ("." + thisFileName + segment_folder_suffix in
+                        folderEntries):
+                    shutil.rmtree(os.path.join(
+                        thisRealFolderName, "." + thisFileName +
+                        segment_folder_suffix), ignore_errors=True)
+                print("{}|{}|{}".format(os.path.join(
+                    thisRealFolderName, thisFileName + "." +
+                    thisOriginalExtension), thisOriginalSize,
+                    thisOriginalFileDate))
+                deleteRows.append([thisRealFolderId, thisFileName])
+            elif state != (thisOriginalSize, thisOriginalFileDate):
+                counters[0][0] += 1
+                updateRows.append([thisOriginalExtension, state[0], state[1],
+                                   thisRealFolderId, thisFileName])
+
+        elif thisStatus == 3:
+            state = folderFileState(folderEntries, thisFileName + "." +
+                                    thisOriginalExtension)
+            if not state:
+                counters[3][1] += 1
+                deleteRows.append([thisRealFolderId, thisFileName])
+            elif state != (thisOriginalSize, thisOriginalFileDate):
+                # File was replaced, check it again
+                counters[3][0] += 1
+                resetRows.append([thisOriginalExtension, state[0], state[1],
+                                  thisRealFolderId, thisFileName])
+
+        elif thisStatus == 1:
+            state = folderFileState(folderEntries, thisFileName + "." +
+                                    thisOptimizedExtension)
+            if not state:
+                counters[1][1] += 1
+                deleteRows.append([thisRealFolderId, thisFileName])
+            elif (not thisOptimizedSize or abs(thisOptimizedSize - state[0])
+                    * 100 / thisOptimizedSize > 10):
+                # File was replaced, optimize it again
+                counters[1][0] += 1
+                resetRows.append([thisOptimizedExtension, state[0], state[1],
+                                  thisRealFolderId, thisFileName])
+
+        else:
+            state = folderFileState(folderEntries, thisFileName + "." +
+                                    thisOriginalExtension)
+            if not state:
+                counters[99][1] += 1
+                deleteRows.append([thisRealFolderId, thisFileName])
+            elif thisFileName + ".log" not in folderEntries:
+                # Logfile of the failed run was removed, try again
+                counters[99][0] += 1
+                resetRows.append([thisOriginalExtension, state[0], state[1],
+                                  thisRealFolderId, thisFileName])
+
+    c.executemany("DELETE FROM folder_optimize_file "
+                  "WHERE real_folder_id = ? "
+                  "AND file_name = ?", deleteRows)
+    c.executemany("UPDATE folder_optimize_file "
+                  "SET original_extension = ?, original_size = ?, "
+                  "original_file_date = ? "
+                  "WHERE real_folder_id = ? "
+                  "AND file_name = ?", updateRows)
+    c.executemany("UPDATE folder_optimize_file "
+                  "SET original_extension = ?, original_size = ?, "
+                  "original_file_date = ?, file_status = 0, "
+                  "optimized_size = null, optimized_extension = null, "
+                  "encode_options = null, skip_reason = null, "
+                  "optimized_file_date = null, "
+                  "optimization_started_at = null, "
+                  "runtime_seconds = null "
+                  "WHERE real_folder_id = ? "
+                  "AND file_name = ?", resetRows)
+
+    conn.commit()
+    c.close()
+
+
+def Cleanup(databasename):
+    """
+    Clean all real folders
+    """
+
+    conn = openDatabase(databasename)
+    c = conn.cursor()
+    c.execute("PRAGMA FOREIGN_KEYS = ON")
+
+    writeActivityLog(conn, "Started Cleanup")
+
+    conn.commit()
+
+    counters = {0: [0, 0], 1: [0, 0], 3: [0, 0], 99: [0, 0]}
+
+    c.execute("SELECT real_folder_id, real_folder_name "
+              "FROM real_folder AS rf "
+              "WHERE EXISTS (SELECT 1 FROM folder_optimize_file AS fof "
+              "WHERE fof.file_status IN (0, 1, 3, 99) "
+              "AND fof.real_folder_id = rf.real_folder_id)")
+
+    for thisRealFolderId, thisRealFolderName in c.fetchall():
+        cleanupRealFolder(conn, thisRealFolderId, thisRealFolderName,
+                          counters)
+
+    for thisStatus, description in ((0, "unprocessed"),
+                                    (1, "already processed"),
+                                    (3, "skipped"),
+                                    (99, "previously failed")):
+        cleanedStatus, deletedStatus = counters[thisStatus]
+        if cleanedStatus > 0 or deletedStatus > 0:
+            writeActivityLog(conn, "Cleanup updated {} and deleted {} from "
+                             "{} files".format(cleanedStatus, deletedStatus,
+                                               description))
+
+    writeActivityLog(conn, "Finished Cleanup")
+
+    flushActivityLog(conn)
+    conn.close()
+
+
+def compileOptionTemplate(Options):
+    """
+    Compile merged options into a template, which is filled per file by
+    fillOptionTemplate. A value may start with conditions on the source
+    like "[if height>1080,duration<600]" and contain variables like
+    "{height}", both out of option_template_variables.
+    Returns the template and the keys of values with invalid conditions.
+    """
+
+    entries = []
+    invalid = []
+
+    for key in sorted(Options):
+        value = Options[key]
+        conditions = []
+        match = re.match(r"\[if ([^\]]*)\](.*)$", value)
+        if match:
+            value = match.group(2)
+            conditions = [re.match(r"\s*(\w+)\s*(<=|>=|!=|<|>|=)\s*(.+?)\s*$",
+                                   condition)
+                          for condition in match.group(1).split(",")]
+            if not all(condition and condition.group(1) in
+                       option_template_variables for condition in conditions):
+                invalid.append(key)
+                continue
+            conditions = [condition.groups() for condition in conditions]
+        hasVariables = bool(re.search(r"\{(" + "|".join(
+            option_template_variables) + r")\}", value))
+        entries.append((key, conditions, value, hasVariables))
+
+    # Without conditions and variables, all files share the same options
+    dynamic = any(conditions or hasVariables
+                  for key, conditions, value, hasVariables in entries)
+
+    return({"entries": entries, "dynamic": dynamic,
+            "options": None if dynamic else dict(
+                (key, value) for key, conditions, value, hasVariables
+                in entries)}, invalid)
+
+
+def optionTemplateValues(fileProbe, fileSize):
+    """
+    Values of option_template_variables for one source, None if unknown
+    """
+
+    fileProbe = fileProbe or {}
+    bitRate = fileProbe.get("bit_rate")
+    videoBitrate = fileProbe.get("video_bitrate")
+    duration = fileProbe.get("duration_seconds")
+
+    return({"width": fileProbe.get("width"),
+            "height": fileProbe.get("height"),
+            "duration": int(duration) if duration else None,
+            "kbps": bitRate // 1000 if bitRate else None,
+            "video_kbps": videoBitrate // 1000 if videoBitrate else None,
+            "size_mb": fileSize // 1024 ** 2 if fileSize is not None
+            else None,
+            "video_codec": fileProbe.get("video_codec")})
+
+
+def conditionHolds(values, condition):
+    """
+    Check one condition (name, operator, value) of an option template,
+    false if the property of the source is unknown
+    """
+
+    name, operator, expected = condition
+    actual = values[name]
+    if actual is None:
+        return(False)
+
+    if isinstance(actual, str):
+        return(operator in ("=", "!=") and
+               (actual in expected.split("|")) == (operator == "="))
+
+    try:
+        return(stream_rule_comparisons[operator](actual, float(expected)))
+    except ValueError:
+        return(False)
+
+
+def fillOptionTemplate(template, fileProbe, fileSize):
+    """
+    The options of one source out of a compiled template: values whose
+    conditions fail are left out, variables are replaced. A value with an
+    unknown variable is left out as well.
+    """
+
+    if not template["dynamic"]:
+        return(template["options"])
 
-    c.execute("SELECT default_option, default_option_id "
-              "FROM default_option")
-    for thisOption, id in c.fetchall():
-        if thisOption:
-            defaultOption[id] = thisOption
+    values = optionTemplateValues(fileProbe, fileSize)
 
-    c.close()
+    Options = {}
+    for key, conditions, value, hasVariables in template["entries"]:
+        if not all(conditionHolds(values, condition)
+                   for condition in conditions):
+            continue
+        if hasVariables:
+            names = re.findall(r"\{(" + "|".join(
+                option_template_variables) + r")\}", value)
+            if any(values[name] is None for name in names):
+                continue
+            value = re.sub(r"\{(" + "|".join(option_template_variables) +
+                           r")\}", lambda match: str(values[match.group(1)]),
+                           value)
+        Options[key] = value
 
-    return(defaultOption)
+    return(Options)
 
 
-def loadFolderOption(conn, thisWatchFolderId):
+def loadWatchFolderOption(conn, thisWatchFolderId, applicationOption):
     """
-    Load folder specific folder option to (probably) overwrite defaults
+    Merge default options with the options of one watch folder and compile
+    them into a template, and merge the application options with the ones
+    of the watch folder
     """
 
-    c = conn.cursor()
+    # load default options
+    Options = loadDefaultOption(conn)
 
-    folderOption = {}
+    # need to merge default options with folder Options
+    for key, value in loadFolderOption(conn, thisWatchFolderId).items():
+        if value:
+            Options[key] = value
+        elif key in Options:
+            del Options[key]
 
-    c.execute("SELECT folder_option, folder_option_id FROM folder_option "
-              "WHERE watch_folder_id = ?", [thisWatchFolderId])
+    folderApplicationOption = loadFolderApplicationOption(
+        conn, thisWatchFolderId, applicationOption)
 
-    for thisOption, id in c.fetchall():
-        folderOption[id] = thisOption
+    optionTemplate, invalid = compileOptionTemplate(Options)
+    for key in invalid:
+        writeActivityLog(conn, "Error, invalid condition in option {} "
+                         "\"{}\" of watch folder {}, left out"
+                         .format(key, Options[key], thisWatchFolderId))
 
-    c.close()
+    return(optionTemplate, folderApplicationOption)
 
-    return(folderOption)
 
+def makeJob(thisWatchFolderId, thisRealFolderId, thisRealFolderName,
+            thisFileName, thisOriginalExtension, thisOriginalSize,
+            thisFirstSeenAt, optionTemplate, applicationOption,
+            fileProbe=None):
+    """
+    A job is one file to process together with its options, filled in out
+    of the option template of its watch folder, and its cached probe
+    """
 
-def writeActivityLog(conn, message):
-    "Write activity log"
+    return({"watchFolderId": thisWatchFolderId,
+            "realFolderId": thisRealFolderId,
+            "realFolderName": thisRealFolderName,
+            "fileName": thisFileName,
+            "originalExtension": thisOriginalExtension,
+            "originalSize": thisOriginalSize,
+            "firstSeenAt": str(thisFirstSeenAt),
+            "optionTemplate": optionTemplate,
+            "options": fillOptionTemplate(optionTemplate, fileProbe,
+                                          thisOriginalSize),
+            "applicationOption": applicationOption,
+            "probe": fileProbe})
+
+
+def loadSavingsEstimate(conn):
+    """
+    Estimate savings ratio and encode seconds per byte out of the already
+    optimized files, per source extension. Key None holds the estimate over
+    all extensions.
+    """
 
     c = conn.cursor()
 
-    c.execute("INSERT into activity_log (log_ts, activity_text) values (?, ?)",
-              [datetime.now(), message])
+    savingsEstimate = {}
+    totals = [0, 0, 0, 0]
+
+    c.execute("SELECT original_extension, SUM(original_size), "
+              "SUM(optimized_size), SUM(timed_size), SUM(runtime_seconds) "
+              "FROM file_statistics "
+              "WHERE file_status = 1 AND encode_options <> '' "
+              "GROUP BY original_extension")
+    for row in c.fetchall():
+        savingsEstimate[row[0]] = row[1:]
+        totals = [total + value for total, value in zip(totals, row[1:])]
 
-    conn.commit()
     c.close()
 
+    savingsEstimate[None] = totals
+
+    for key, (originalSize, optimizedSize, timedSize,
+              runtime) in savingsEstimate.items():
+        # Without history assume half the size at one second per MB
+        savingsRatio = 0.5
+        secondsPerByte = 1 / 1024 ** 2
+        if originalSize:
+            savingsRatio = max(0.01, 1 - optimizedSize / originalSize)
+        if timedSize and runtime:
+            secondsPerByte = runtime / timedSize
+        savingsEstimate[key] = (savingsRatio, secondsPerByte)
+
+    return(savingsEstimate)
+
 
-def ProcessFile(conn, thisRealFolderId, thisRealFolderName, thisFileName,
-                thisOriginalExtension, Options, applicationOption):
+def loadEncodeSpeed(conn):
     """
-    Execute one file here
+    Average encode speed (seconds of media per second of encoding) of the
+    successful encodes in the history, per option set
     """
 
     c = conn.cursor()
 
-    execOptions = []
+    c.execute("SELECT encode_options, SUM(media_seconds) / "
+              "SUM(runtime_seconds) "
+              "FROM encode_history "
+              "WHERE return_code = 0 AND media_seconds > 0 "
+              "AND runtime_seconds > 0 "
+              "GROUP BY encode_options")
+    encodeSpeed = dict(c.fetchall())
 
-    logfile = os.path.join(thisRealFolderName, thisFileName + ".log")
-    inpfile = os.path.join(thisRealFolderName, thisFileName + "." +
-                           thisOriginalExtension)
-    tgtfile = os.path.join(thisRealFolderName, thisFileName + "." +
-                           applicationOption["target_extension"])
-    outfile = os.path.join(thisRealFolderName, "." + thisFileName + ".tmp." +
-                           applicationOption["target_extension"])
+    c.close()
 
-    if os.path.isfile(logfile):
-        writeActivityLog(conn, "Logfile {} already exists!".format(logfile))
-        return
-    if os.path.isfile(outfile):
-        writeActivityLog(conn, "Temporary file {} already exists!"
-                         .format(outfile))
-        return
-    if os.path.isfile(tgtfile) and inpfile != tgtfile:
-        writeActivityLog(conn, "Target file {} already exists!"
-                         .format(tgtfile))
-        return
+    return(encodeSpeed)
 
-    if os.path.isfile(inpfile):
-        for key in sorted(Options):
-            if Options[key] == "INPUTFILE":
-                execOptions.append(inpfile)
-            elif Options[key] == "OUTPUTFILE":
-                execOptions.append(outfile)
-            else:
-                execOptions.append(Options[key])
 
-        c.execute("UPDATE folder_optimize_file "
-                  "SET optimization_started_at = ?, "
-                  "    optimized_extension = ?, "
-                  "    file_status = ? "
-                  "WHERE real_folder_id = ? AND file_name = ?",
-                  [datetime.now(), applicationOption["target_extension"], 2,
-                  thisRealFolderId, thisFileName])
-        writeActivityLog(conn, "Start processing file {} in folder {}"
-                         .format(thisFileName, thisRealFolderName))
+def orderJobQueue(conn, jobs):
+    """
+    Order all jobs as one global queue.
+    Watch folders with higher queue_priority go first. Within a folder,
+    jobs with the most bytes saved per second of encoding go first, boosted
+    by their age (queue_age_days doubles the score). Between folders of the
+    same priority, the expected encode time is shared by queue_weight, so a
+    huge folder can't starve the others.
+    """
+
+    savingsEstimate = loadSavingsEstimate(conn)
+    encodeSpeed = loadEncodeSpeed(conn)
+    now = datetime.now()
 
-        start = time.time()
+    folderJobs = {}
 
+    for job in jobs:
+        savingsRatio, secondsPerByte = savingsEstimate.get(
+            job["originalExtension"], savingsEstimate[None])
         try:
-            log = open(logfile, 'w')
-        except IOError:
-            writeActivityLog(conn, "Error, cannot create logfile {}"
-                             .format(logfile))
-        else:
-            if subprocess.call(execOptions, stdout=log,
-                               stderr=subprocess.STDOUT):
-                runtime = time.time() - start
-                log.close()
-                writeActivityLog(conn, "Error processing file {}"
-                                 .format(inpfile))
-                c.execute("UPDATE folder_optimize_file "
-                          "SET file_status = ?, runtime_seconds = ? "
-                          "WHERE real_folder_id = ? AND file_name = ?",
-                          [99, runtime, thisRealFolderId, thisFileName])
-            else:
-                runtime = time.time() - start
-                log.close()
-                fileSize = os.path.getsize(outfile)
-                fileDate = datetime.fromtimestamp(os.path.getmtime(outfile)).strftime("%Y-%m-%d %H:%M:%S")
-                c.execute("UPDATE folder_optimize_file "
-                          "SET file_status = ?, runtime_seconds = ?, "
-                          "    optimized_size = ?, optimized_file_date = ? "
-                          "WHERE real_folder_id = ? AND file_name = ?",
-                          [1, runtime, fileSize, fileDate, thisRealFolderId,
-                             thisFileName])
-                writeActivityLog(conn, "Finished processing file {}"
-                                 .format(inpfile))
+            ageDays = (now - datetime.fromisoformat(
+                job["firstSeenAt"])).total_seconds() / 86400
+        except ValueError:
+            ageDays = 0
+        ageLimit = max(1, getIntOption(job["applicationOption"],
+                                       "queue_age_days", 7))
+        # Video already in an efficient codec won't get much smaller
+        if (job.get("probe") and job["probe"]["video_codec"] in
+                efficient_video_codecs):
+            savingsRatio *= 0.2
+        job["expectedSaving"] = job["originalSize"] * savingsRatio
+        job["expectedRuntime"] = job["originalSize"] * secondsPerByte
+        # Known duration and speed of the option set beat the size estimate
+        speed = encodeSpeed.get(encodeOptionsText(job["options"]))
+        if speed and job.get("probe") and job["probe"]["duration_seconds"]:
+            job["expectedRuntime"] = job["probe"]["duration_seconds"] / speed
+        job["queueScore"] = (job["expectedSaving"] /
+                             max(job["expectedRuntime"], 0.001) *
+                             (1 + max(0, ageDays) / ageLimit))
+        folderJobs.setdefault(job["watchFolderId"], []).append(job)
+
+    queue = []
+    for thisWatchFolderId, thisJobs in folderJobs.items():
+        thisJobs.sort(key=lambda job: (-job["queueScore"],
+                                       job["firstSeenAt"], job["fileName"]))
+        thisJobs.reverse()
+        priority = getIntOption(thisJobs[0]["applicationOption"],
+                                "queue_priority", 0)
+        queue.append((-priority, 0.0, thisWatchFolderId))
+
+    # Weighted fair queuing: next job from the folder which got the least
+    # encode time relative to its weight
+    heapq.heapify(queue)
+    del jobs[:]
+    while queue:
+        negPriority, virtualTime, thisWatchFolderId = heapq.heappop(queue)
+        job = folderJobs[thisWatchFolderId].pop()
+        jobs.append(job)
+        if folderJobs[thisWatchFolderId]:
+            weight = getFloatOption(job["applicationOption"], "queue_weight",
+                                    1.0)
+            if weight <= 0:
+                weight = 1.0
+            heapq.heappush(queue, (negPriority, virtualTime +
+                                   max(job["expectedRuntime"], 1) / weight,
+                                   thisWatchFolderId))
+
+    return(jobs)
+
+
+def collectPendingJobs(conn, applicationOption):
+    """
+    Collect all files waiting to be processed into one global queue
+    """
 
-                try:
-                    os.remove(inpfile)
-                except:
-                    writeActivityLog(conn, "Error, cannot remove ori file "
-                                     "{}!".format(inpfile))
-                else:
-                    try:
-                        os.rename(outfile, tgtfile)
-                    except:
-                        writeActivityLog(conn, "Cannot rename file {} in "
-                                         "folder {}"
-                                         .format(File, thisRealFolderName))
-                    else:
-                        try:
-                            os.remove(logfile)
-                        except:
-                            writeActivityLog(conn, "Error, cannot remove "
-                                             "logfile {}!"
-                                             .format(logfile))
+    c = conn.cursor()
 
-            conn.commit()
+    # Files of nodes which stopped renewing their lease are free again
+    recoverRunningJobs(conn, getIntOption(applicationOption,
+                                          "lease_seconds", 300))
+    conn.commit()
 
-    else:
-        writeActivityLog(conn, "File not found: {}.{}!"
-                         .format(os.path.join(thisRealFolderName,
-                         thisFileName), thisOriginalExtension))
+    jobs = []
+    watchFolderOption = {}
+
+    c.execute("SELECT rf.watch_folder_id, fof.real_folder_id, "
+              "rf.real_folder_name, fof.file_name, fof.original_extension, "
+              "fof.original_size, fof.original_first_seen_at, "
+              "ff.sample_hash, fp.file_name, " +
+              ", ".join("fp." + column for column in file_probe_columns) +
+              " FROM folder_optimize_file AS fof "
+              "JOIN real_folder AS rf "
+              "ON rf.real_folder_id = fof.real_folder_id "
+              "LEFT JOIN file_probe AS fp "
+              "ON fp.real_folder_id = fof.real_folder_id "
+              "AND fp.file_name = fof.file_name "
+              "AND fp.file_size = fof.original_size "
+              "AND fp.file_date = fof.original_file_date "
+              "LEFT JOIN file_fingerprint AS ff "
+              "ON ff.real_folder_id = fof.real_folder_id "
+              "AND ff.file_name = fof.file_name "
+              "AND ff.file_size = fof.original_size "
+              "AND ff.file_date = fof.original_file_date "
+              "WHERE fof.file_status = 0")
+    for row in c.fetchall():
+        if row[0] not in watchFolderOption:
+            watchFolderOption[row[0]] = loadWatchFolderOption(
+                conn, row[0], applicationOption)
+        fileProbe = None
+        if row[8] is not None:
+            fileProbe = dict(zip(file_probe_columns, row[9:]))
+            fileProbe["streams"] = json.loads(fileProbe["stream_info"] or
+                                              "[]")
+        job = makeJob(*(row[:7] + watchFolderOption[row[0]]),
+                      fileProbe=fileProbe)
+        job["sampleHash"] = row[7]
+        jobs.append(job)
 
     c.close()
 
+    return(orderJobQueue(conn, jobs))
+
+
+def checkApplicationOption(conn, applicationOption):
+    """
+    Check application options required for processing and end if missing
+    """
+
+    if ("target_extension" not in applicationOption and
+            "target_extension" in default_application_options):
+        applicationOption["target_extension"] = default_application_options[
+                          "target_extension"]
+    elif ("target_extension" not in applicationOption and
+            "target_extension" not in default_application_options):
+        writeActivityLog(conn, "Error, cannot go without \"target_extension\""
+                         " option!")
+        sys.exit(1)
+
+
+def Execution(databasename):
+    """
+    Reading configuration database and process data in watch folders
+    """
+
+    conn = openDatabase(databasename)
+
+    # read application options
+    applicationOption = loadApplicationOption(conn)
+
+    workerCount = max(1, getIntOption(applicationOption, "max_parallel_jobs",
+                                      1))
+
+    # check of process is already running and exit there if
+    checkExecution(conn, workerCount)
+
+    checkApplicationOption(conn, applicationOption)
+
+    jobs = collectPendingJobs(conn, applicationOption)
+
+    metricsServer = startMetricsServer(conn, databasename, applicationOption)
+    publishMetrics(conn, applicationOption, force=True)
+
+    try:
+        runJobPool(conn, jobs, workerCount, applicationOption)
+    finally:
+        endExecution(conn)
+        publishMetrics(conn, applicationOption, force=True)
+        if metricsServer:
+            metricsServer.shutdown()
+
+        flushActivityLog(conn)
+        conn.close()
+
+
+def inotifyInit():
+    """
+    Create a non-blocking inotify instance through libc.
+    Returns the file descriptor or None, if inotify is not available.
+    """
+
+    global libc
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        inotifyFd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return(None)
+
+    if inotifyFd < 0:
+        return(None)
+
+    return(inotifyFd)
+
+
+def addFolderWatch(inotifyFd, watches, thisRealFolderId, thisWatchFolderId,
+                   thisRealFolderName, recursiveYN):
+    """
+    Add an inotify watch for one real folder
+    """
+
+    wd = libc.inotify_add_watch(inotifyFd, os.fsencode(thisRealFolderName),
+                                inotify_folder_mask)
+    if wd < 0:
+        return(False)
+
+    watches[wd] = (thisRealFolderId, thisWatchFolderId, thisRealFolderName,
+                   recursiveYN)
+
+    return(True)
+
+
+def readInotifyEvents(inotifyFd):
+    """
+    Read all pending events and return them as list of (wd, mask, name)
+    """
+
+    events = []
+
+    try:
+        buffer = os.read(inotifyFd, 65536)
+    except BlockingIOError:
+        return(events)
+
+    offset = 0
+    while offset + 16 <= len(buffer):
+        wd, mask, cookie, length = struct.unpack_from("iIII", buffer, offset)
+        name = buffer[offset + 16:offset + 16 + length].rstrip(b"\0")
+        events.append((wd, mask, os.fsdecode(name)))
+        offset += 16 + length
+
+    return(events)
+
+
+def addCandidate(candidates, watch, fileName, folderIgnoreExtensions):
+    """
+    A file has been changed or arrived. Remember it until its size and
+    modification time don't change anymore.
+    """
+
+    thisRealFolderId, thisWatchFolderId, thisRealFolderName, recursiveYN = watch
+
+    # events of the watched folder itself come without name
+    if (not fileName or fileName.startswith(".") or os.path.splitext(fileName)[1][1:] in
+            folderIgnoreExtensions.get(thisWatchFolderId, ())):
+        return
 
-def processRealFolder(conn, thisWatchFolderId, thisRealFolderId,
-                      thisRealFolderName, applicationOption):
+    candidates[os.path.join(thisRealFolderName, fileName)] = {
+        "watch": watch, "fileName": fileName, "fileState": None,
+        "since": time.time()}
+
+
+def watchNewFolderTree(conn, inotifyFd, watches, candidates,
+                       folderIgnoreExtensions, thisWatchFolderId,
+                       thisFolderName):
     """
-    Running within one real folder and process all files
+    A folder was created or moved into a recursive watch folder. Register
+    and watch it with all of its subfolders, files already in there are
+    added as candidates.
     """
 
     c = conn.cursor()
 
-    # load default options
-    Options = loadDefaultOption(conn)
+    stack = [thisFolderName]
+    while stack:
+        thisFolder = stack.pop()
+        InsertNewRealFolder(conn, thisWatchFolderId, thisFolder)
+        c.execute("SELECT real_folder_id FROM real_folder "
+                  "WHERE watch_folder_id = ? AND real_folder_name = ?",
+                  [thisWatchFolderId, thisFolder])
+        row = c.fetchone()
+        if not row:
+            continue
+        watch = (row[0], thisWatchFolderId, thisFolder, 1)
+        # watch first, so nothing gets lost between listing and watching
+        if not addFolderWatch(inotifyFd, watches, *watch):
+            continue
+        try:
+            countProfile("directory_listings")
+            with os.scandir(thisFolder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not isSegmentFolder(entry.name):
+                            stack.append(entry.path)
+                    elif entry.is_file():
+                        addCandidate(candidates, watch, entry.name,
+                                     folderIgnoreExtensions)
+        except OSError:
+            continue
 
-    # need to merge default options with folder Options
-    for key, value in loadFolderOption(conn, thisWatchFolderId).items():
-        if value:
-            Options[key] = value
-        elif key in Options:
-            del Options[key]
+    c.close()
 
-    c.execute("SELECT file_name, original_extension "
-              "FROM folder_optimize_file "
-              "WHERE real_folder_id = ? AND file_status = ? "
-              "ORDER BY file_name", [thisRealFolderId, 0])
 
-    for thisFileName, thisOriginalExtension in c.fetchall():
-        ProcessFile(conn, thisRealFolderId, thisRealFolderName, thisFileName,
-                    thisOriginalExtension, Options, applicationOption)
+def registerSettledFiles(conn, candidates, settleSeconds, applicationOption,
+                         watchFolderOption):
+    """
+    Add all candidates, whose size and modification time haven't changed for
+    settleSeconds, to the repository and return them as new jobs.
+    watchFolderOption keeps the compiled options per watch folder.
+    """
+
+    c = conn.cursor()
+
+    jobs = []
+    now = time.time()
+
+    for path, candidate in list(candidates.items()):
+        try:
+            countProfile("stat_calls")
+            fileStat = os.stat(path)
+        except OSError:
+            fileStat = None
+        if not fileStat or not stat.S_ISREG(fileStat.st_mode):
+            del candidates[path]
+            continue
+
+        fileState = (fileStat.st_size, fileStat.st_mtime_ns)
+        if fileState != candidate["fileState"]:
+            candidate["fileState"] = fileState
+            candidate["since"] = now
+            continue
+        if now - candidate["since"] < settleSeconds:
+            continue
+
+        del candidates[path]
+
+        thisRealFolderId, thisWatchFolderId, thisRealFolderName, \
+            recursiveYN = candidate["watch"]
+        thisFileName, thisExtension = os.path.splitext(candidate["fileName"])
+
+        c.execute("SELECT 1 FROM folder_optimize_file "
+                  "WHERE real_folder_id = ? AND file_name = ? "
+                  "UNION ALL SELECT 1 FROM file_rendition "
+                  "WHERE real_folder_id = ? AND rendition_file_name = ?",
+                  [thisRealFolderId, thisFileName, thisRealFolderId,
+                   thisFileName])
+        if c.fetchone():
+            continue
+
+        fileDate = datetime.fromtimestamp(fileStat.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            c.execute("INSERT INTO folder_optimize_file ("
+                      "real_folder_id, file_name, "
+                      "original_extension, "
+                      "original_first_seen_at, original_size, "
+                      "original_file_date, file_status) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      [thisRealFolderId, thisFileName, thisExtension[1:],
+                       datetime.now(), fileStat.st_size, fileDate, 0])
+        except sqlite3.IntegrityError:
+            writeActivityLog(conn, "Ho, foreign key to real folder {} "
+                             "violated! Deleted in the meantime?"
+                             .format(thisRealFolderName))
+            continue
+
+        writeActivityLog(conn, "Added file {} to optimize list".format(path))
+
+        if thisWatchFolderId not in watchFolderOption:
+            watchFolderOption[thisWatchFolderId] = loadWatchFolderOption(
+                conn, thisWatchFolderId, applicationOption)
+        jobs.append(makeJob(thisWatchFolderId, thisRealFolderId,
+                            thisRealFolderName, thisFileName,
+                            thisExtension[1:], fileStat.st_size,
+                            datetime.now(),
+                            *watchFolderOption[thisWatchFolderId]))
 
     conn.commit()
     c.close()
 
+    return(jobs)
 
-def Cleanup(databasename):
+
+def Watch(databasename):
     """
-    Clean all real folders
+    Keep running and watch all real folders with inotify. New files are
+    added to the repository as soon as they are complete and handed over
+    to the encoders right away, without scanning the folders again.
     """
 
+    # Catch up with everything which happened while we were not running
+    Cleanup(databasename)
+    IdentifyNewFiles(databasename)
+
     conn = openDatabase(databasename)
+
+    applicationOption = loadApplicationOption(conn)
+
+    workerCount = max(1, getIntOption(applicationOption, "max_parallel_jobs",
+                                      1))
+    settleSeconds = getIntOption(applicationOption, "watch_settle_seconds",
+                                 15)
+    # Files freed by nodes which stopped renewing their lease are picked up
+    # every renewal interval
+    recoverSeconds = max(1, getIntOption(applicationOption, "lease_seconds",
+                                         300) / 3)
+
+    # check of process is already running and exit there if
+    checkExecution(conn, workerCount)
+
     c = conn.cursor()
-    c.execute("PRAGMA FOREIGN_KEYS = ON")
 
-    writeActivityLog(conn, "Started Cleanup")
+    checkApplicationOption(conn, applicationOption)
 
-    conn.commit()
+    inotifyFd = inotifyInit()
+    if inotifyFd is None:
+        print("Error, inotify is not available on this system")
+        endExecution(conn)
+        sys.exit(1)
 
-    cleanedStatus = 0
-    deletedStatus = 0
+    watches = {}
+    candidates = {}
+    folderIgnoreExtensions = loadFolderIgnoreExtensions(conn)
+
+    c.execute("SELECT rf.real_folder_id, rf.watch_folder_id, "
+              "rf.real_folder_name, wf.recursive_yn "
+              "FROM real_folder AS rf "
+              "JOIN watch_folder AS wf "
+              "ON wf.watch_folder_id = rf.watch_folder_id")
+    for row in c.fetchall():
+        addFolderWatch(inotifyFd, watches, *row)
+
+    writeActivityLog(conn, "Started watching {} folders".format(len(watches)))
+
+    jobs = collectPendingJobs(conn, applicationOption)
+    recoveredAt = time.time()
+    jobPool = createJobPool(workerCount, applicationOption)
+    watchFolderOption = {}
+    metricsServer = startMetricsServer(conn, databasename, applicationOption)
+
+    try:
+        while True:
+            rescan = False
+
+            if select.select([inotifyFd], [], [], 1)[0]:
+                for wd, mask, name in readInotifyEvents(inotifyFd):
+                    if mask & inotify_q_overflow:
+                        rescan = True
+                    elif wd not in watches:
+                        continue
+                    elif mask & inotify_ignored:
+                        del watches[wd]
+                    elif mask & inotify_isdir:
+                        if (mask & (inotify_create | inotify_moved_to)
+                                and watches[wd][3] == 1
+                                and not isSegmentFolder(name)):
+                            watchNewFolderTree(
+                                conn, inotifyFd, watches, candidates,
+                                folderIgnoreExtensions, watches[wd][1],
+                                os.path.join(watches[wd][2], name))
+                    elif mask & inotify_file_mask:
+                        addCandidate(candidates, watches[wd], name,
+                                     folderIgnoreExtensions)
+
+            if rescan:
+                # Events got lost, fall back to a scan of all folders
+                writeActivityLog(conn, "Inotify queue overflow, rescanning")
+                watchFolderOption = {}
+                flushActivityLog(conn)
+                IdentifyNewFiles(databasename)
+                folderIgnoreExtensions = loadFolderIgnoreExtensions(conn)
+                c.execute("SELECT rf.real_folder_id, rf.watch_folder_id, "
+                          "rf.real_folder_name, wf.recursive_yn "
+                          "FROM real_folder AS rf "
+                          "JOIN watch_folder AS wf "
+                          "ON wf.watch_folder_id = rf.watch_folder_id")
+                watchedFolders = set(watch[0] for watch in watches.values())
+                for row in c.fetchall():
+                    if row[0] not in watchedFolders:
+                        addFolderWatch(inotifyFd, watches, *row)
+
+            if rescan or time.time() - recoveredAt >= recoverSeconds:
+                known = set((job["realFolderId"], job["fileName"])
+                            for job in (jobs + jobPool["requeued"] +
+                                        list(jobPool["running"].values())))
+                for job in collectPendingJobs(conn, applicationOption):
+                    if (job["realFolderId"], job["fileName"]) not in known:
+                        jobs.append(job)
+                orderJobQueue(conn, jobs)
+                recoveredAt = time.time()
+
+            newJobs = registerSettledFiles(conn, candidates, settleSeconds,
+                                           applicationOption,
+                                           watchFolderOption)
+            if newJobs:
+                jobs.extend(newJobs)
+                orderJobQueue(conn, jobs)
+
+            startJobs(conn, jobPool, jobs)
+            finishJobs(conn, jobPool, timeout=0)
+            publishMetrics(conn, applicationOption)
+    finally:
+        abortJobs(conn, jobPool)
+        os.close(inotifyFd)
+        endExecution(conn)
+        publishMetrics(conn, applicationOption, force=True)
+        if metricsServer:
+            metricsServer.shutdown()
+        writeActivityLog(conn, "Stopped watching")
+        flushActivityLog(conn)
+        conn.close()
+
+
+def metricLabels(labels):
+    """
+    Labels of a metric sample in Prometheus text format
+    """
 
-    c.execute("SELECT fof.real_folder_id, rf.real_folder_name, fof.file_name, "
-              "fof.original_extension, "
-              "fof.original_file_date, fof.original_size "
-              "FROM folder_optimize_file as fof "
-              "JOIN real_folder as rf "
-              "ON rf.real_folder_id = fof.real_folder_id "
-              "WHERE fof.file_status = 0")
+    if not labels:
+        return("")
 
-    for (thisRealFolderId, thisRealFolderName, thisFileName,
-        thisOriginalExtension, thisOriginalFileDate,
-        thisOriginalSize) in c.fetchall():
+    return("{" + ",".join('{}="{}"'.format(
+        key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\n")) for key, value in labels) + "}")
 
-        check_file = os.path.join(thisRealFolderName, thisFileName + "." +
-                     thisOriginalExtension)
 
-        if not os.path.exists(check_file):
-            deletedStatus += 1
-            print("{}|{}|{}".format(check_file, thisOriginalSize, thisOriginalFileDate))
-            c.execute("DELETE FROM folder_optimize_file "
-                      "WHERE real_folder_id = ? "
-                      "AND file_name = ?", [thisRealFolderId, thisFileName])
-        else:
-            fileSize = os.path.getsize(check_file)
-            fileDate = datetime.fromtimestamp(os.path.getmtime(check_file)).strftime("%Y-%m-%d %H:%M:%S")
-            if (fileSize != thisOriginalSize or
-                fileDate != thisOriginalFileDate):
-                cleanedStatus += 1
-                print("{}|{}|{}|{}|{}".format(check_file, fileSize, thisOriginalSize, fileDate, thisOriginalFileDate))
-                c.execute("UPDATE folder_optimize_file "
-                          "SET original_extension = ?, original_size = ?, "
-                          "original_file_date = ? "
-                          "WHERE real_folder_id = ? "
-                          "AND file_name = ?", [thisOriginalExtension,
-                          fileSize, fileDate, thisRealFolderId,
-                          thisFileName])
-
-    if cleanedStatus > 0 or deletedStatus > 0:
-        writeActivityLog(conn, "Cleanup updated {} and deleted {} from "
-                         "unprocessed files"
-                         .format(cleanedStatus, deletedStatus))
+def appendMetric(lines, name, metricType, helpText, samples):
+    """
+    Append one metric with its samples (list of labels, value) to lines
+    """
 
-    conn.commit()
+    lines.append("# HELP optimize_mkv_{} {}".format(name, helpText))
+    lines.append("# TYPE optimize_mkv_{} {}".format(name, metricType))
+    for labels, value in samples:
+        if value is not None:
+            lines.append("optimize_mkv_{}{} {}".format(name,
+                                                       metricLabels(labels),
+                                                       value))
 
-    cleanedStatus = 0
-    deletedStatus = 0
 
-    c.execute("SELECT fof.real_folder_id, rf.real_folder_name, fof.file_name, "
-              "fof.original_extension, fof.optimized_extension, "
-              "fof.optimized_file_date, fof.optimized_size "
-              "FROM folder_optimize_file as fof "
-              "JOIN real_folder as rf "
-              "ON rf.real_folder_id = fof.real_folder_id "
-              "WHERE fof.file_status = 1")
+def renderMetrics(conn):
+    """
+    Metrics of the repository, the running jobs of all nodes and the last
+    scan of this process in Prometheus text format
+    """
 
-    for (thisRealFolderId, thisRealFolderName, thisFileName,
-        thisOriginalExtension, thisOptimizedExtension, thisOptimizedFileDate,
-        thisOptimizedSize) in c.fetchall():
+    c = conn.cursor()
 
-        check_file = os.path.join(thisRealFolderName, thisFileName + "." +
-                     thisOptimizedExtension)
+    lines = []
+
+    c.execute("SELECT wf.watch_folder_name, fs.file_status, "
+              "SUM(fs.file_count), SUM(fs.original_size), "
+              "SUM(fs.optimized_size) "
+              "FROM file_statistics AS fs "
+              "JOIN real_folder AS rf "
+              "ON rf.real_folder_id = fs.real_folder_id "
+              "JOIN watch_folder AS wf "
+              "ON wf.watch_folder_id = rf.watch_folder_id "
+              "GROUP BY wf.watch_folder_id, fs.file_status")
+    rows = c.fetchall()
+    appendMetric(lines, "files", "gauge", "Files per watch folder and status",
+                 [((("watch_folder", row[0]), ("status", file_status_names.get(
+                     row[1], row[1]))), row[2]) for row in rows])
+    appendMetric(lines, "original_bytes", "gauge",
+                 "Size of the original files per watch folder and status",
+                 [((("watch_folder", row[0]), ("status", file_status_names.get(
+                     row[1], row[1]))), row[3]) for row in rows])
+    appendMetric(lines, "saved_bytes", "gauge",
+                 "Bytes saved by optimized files per watch folder",
+                 [((("watch_folder", row[0]),), row[3] - row[4])
+                  for row in rows if row[1] == 1])
+
+    c.execute("SELECT wf.watch_folder_name, rj.node_name, rj.worker_slot, "
+              "rj.fps, rj.speed, rj.eta_seconds "
+              "FROM running_job AS rj "
+              "JOIN real_folder AS rf "
+              "ON rf.real_folder_id = rj.real_folder_id "
+              "JOIN watch_folder AS wf "
+              "ON wf.watch_folder_id = rf.watch_folder_id")
+    rows = c.fetchall()
+    runningJobs = {}
+    for row in rows:
+        runningJobs[row[0]] = runningJobs.get(row[0], 0) + 1
+    appendMetric(lines, "running_jobs", "gauge",
+                 "Running encodes per watch folder",
+                 [((("watch_folder", thisFolder),), count)
+                  for thisFolder, count in sorted(runningJobs.items())])
+    appendMetric(lines, "job_fps", "gauge", "Frames per second of a running "
+                 "encode", [((("node", row[1]), ("worker", row[2])), row[3])
+                            for row in rows])
+    appendMetric(lines, "job_speed", "gauge", "Speed (media seconds per "
+                 "second) of a running encode",
+                 [((("node", row[1]), ("worker", row[2])), row[4])
+                  for row in rows])
+    appendMetric(lines, "job_eta_seconds", "gauge", "Expected remaining time "
+                 "of a running encode",
+                 [((("node", row[1]), ("worker", row[2])), row[5])
+                  for row in rows])
+
+    c.execute("SELECT node_name, worker_count, heartbeat_at "
+              "FROM current_running")
+    rows = c.fetchall()
+    appendMetric(lines, "node_workers", "gauge", "Workers of a running node",
+                 [((("node", row[0]),), row[1]) for row in rows])
+    appendMetric(lines, "node_heartbeat_timestamp_seconds", "gauge",
+                 "Last heartbeat of a running node",
+                 [((("node", row[0]),), row[2]) for row in rows])
+
+    c.execute("SELECT node_name, SUM(return_code = 0), "
+              "SUM(return_code <> 0), SUM(runtime_seconds), "
+              "SUM(media_seconds), SUM(original_size) "
+              "FROM encode_history GROUP BY node_name")
+    rows = c.fetchall()
+    appendMetric(lines, "encodes_total", "counter", "Finished encodes per "
+                 "node and result",
+                 [((("node", row[0]), ("result", "ok")), row[1])
+                  for row in rows] +
+                 [((("node", row[0]), ("result", "failed")), row[2])
+                  for row in rows])
+    appendMetric(lines, "encode_runtime_seconds_total", "counter",
+                 "Time spent encoding per node",
+                 [((("node", row[0]),), row[3]) for row in rows])
+    appendMetric(lines, "encoded_media_seconds_total", "counter",
+                 "Media time encoded per node",
+                 [((("node", row[0]),), row[4]) for row in rows])
+    appendMetric(lines, "encoded_bytes_total", "counter",
+                 "Size of the original files encoded per node",
+                 [((("node", row[0]),), row[5]) for row in rows])
+
+    if lastScanInfo:
+        labels = (("node", nodeName),)
+        appendMetric(lines, "scan_duration_seconds", "gauge",
+                     "Duration of the last scan for new files",
+                     [(labels, round(lastScanInfo["seconds"], 3))])
+        appendMetric(lines, "scan_timestamp_seconds", "gauge",
+                     "End of the last scan for new files",
+                     [(labels, round(lastScanInfo["finishedAt"], 3))])
+        appendMetric(lines, "scan_folders", "gauge",
+                     "Real folders of the last scan",
+                     [(labels, lastScanInfo["folders"])])
+        appendMetric(lines, "scan_skipped_folders", "gauge",
+                     "Unchanged real folders skipped by the last scan",
+                     [(labels, lastScanInfo["skippedFolders"])])
 
-        if not os.path.exists(check_file):
-            deletedStatus += 1
-            c.execute("DELETE FROM folder_optimize_file "
-                      "WHERE real_folder_id = ? "
-                      "AND file_name = ?", [thisRealFolderId, thisFileName])
-        else:
-            fileSize = os.path.getsize(check_file)
-            fileDate = datetime.fromtimestamp(os.path.getmtime(check_file)).strftime("%Y-%m-%d %H:%M:%S")
-            if (abs(thisOptimizedSize - fileSize) * 100 / thisOptimizedSize > 10):
-                cleanedStatus += 1
-                c.execute("UPDATE folder_optimize_file "
-                          "SET original_extension = ?, original_size = ?, "
-                          "original_file_date = ?, file_status = ?, "
-                          "optimized_size = null, optimized_extension = null, "
-                          "optimized_file_date = null, "
-                          "optimization_started_at = null, "
-                          "runtime_seconds = null "
-                          "WHERE real_folder_id = ? "
-                          "AND file_name = ?", [thisOptimizedExtension,
-                          fileSize, fileDate, 0, thisRealFolderId,
-                          thisFileName])
-
-    if cleanedStatus > 0 or deletedStatus > 0:
-        writeActivityLog(conn, "Cleanup updated {} and deleted {} from already "
-                         "processed files"
-                         .format(cleanedStatus, deletedStatus))
+    c.close()
 
-    conn.commit()
+    return("\n".join(lines) + "\n")
 
-    cleanedStatus = 0
-    deletedStatus = 0
 
-    c.execute("SELECT fof.real_folder_id, rf.real_folder_name, fof.file_name, "
-              "fof.original_extension "
-              "FROM folder_optimize_file as fof "
-              "JOIN real_folder as rf "
-              "ON rf.real_folder_id = fof.real_folder_id "
-              "WHERE file_status = 99")
+def publishMetrics(conn, applicationOption, force=False):
+    """
+    Write the metrics to metrics_textfile for the textfile collector of
+    node exporter, at most every progress_update_seconds unless forced.
+    Replaced at once, so the collector never reads half a file.
+    """
 
-    for (thisRealFolderId, thisRealFolderName, thisFileName,
-        thisOriginalExtension) in c.fetchall():
+    global metricsWrittenAt
 
-        check_file1 = os.path.join(thisRealFolderName, thisFileName) + ".log"
-        check_file2 = os.path.join(thisRealFolderName, thisFileName + "." +
-                      thisOriginalExtension)
+    metricsFile = applicationOption.get("metrics_textfile")
+    if not metricsFile or (not force and time.time() < metricsWrittenAt +
+                           progress_update_seconds):
+        return
 
-        if not os.path.exists(check_file1):
-            cleanedStatus += 1
-            c.execute("UPDATE folder_optimize_file "
-                      "SET original_extension = ?, original_size = ?, "
-                      "original_file_date = ?, file_status = ?, "
-                      "optimized_size = null, optimized_extension = null, "
-                      "optimized_file_date = null, "
-                      "optimization_started_at = null, "
-                      "runtime_seconds = null "
-                      "WHERE real_folder_id = ? "
-                      "AND file_name = ?", [thisOriginalExtension,
-                      fileSize, fileDate, 0, thisRealFolderId,
-                      thisFileName])
-        elif not os.path.exists(check_file2):
-            deletedStatus += 1
-            c.execute("DELETE FROM folder_optimize_file "
-                      "WHERE real_folder_id = ? "
-                      "AND file_name = ?", [thisRealFolderId, thisFileName])
+    metricsWrittenAt = time.time()
+    try:
+        with open(metricsFile + ".tmp", "w") as f:
+            f.write(renderMetrics(conn))
+        os.replace(metricsFile + ".tmp", metricsFile)
+    except OSError as e:
+        writeActivityLog(conn, "Error writing metrics to {}: {}"
+                         .format(metricsFile, e))
 
-    if cleanedStatus > 0 or deletedStatus > 0:
-        writeActivityLog(conn, "Cleanup updated {} and deleted {} from "
-                         "previously failed files"
-                         .format(cleanedStatus, deletedStatus))
 
-    conn.commit()
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the metrics on /metrics, with an own repository connection for
+    every request
+    """
 
-    writeActivityLog(conn, "Finished Cleanup")
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
 
-    conn.commit()
-    conn.close()
+        conn = openDatabase(self.server.databasename)
+        try:
+            body = renderMetrics(conn).encode()
+        finally:
+            conn.close()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        # Scrapes every few seconds don't belong on stderr
+        pass
 
 
-def processWatchFolder(conn, thisWatchFolderId, applicationOption):
+def startMetricsServer(conn, databasename, applicationOption):
     """
-    Now processing one watch folder. Read in folder specific options.
-    Here, we can have several real folders for one watch folder.
+    Serve the metrics on metrics_listen ("host:port") in a background
+    thread. Returns the server or None.
     """
 
-    c = conn.cursor()
+    listen = applicationOption.get("metrics_listen")
+    if not listen:
+        return(None)
 
-    c.execute("SELECT real_folder_id, real_folder_name "
-              "FROM real_folder "
-              "WHERE watch_folder_id = ? "
-              "ORDER BY real_folder_name",
-              [thisWatchFolderId])
+    host, separator, port = listen.rpartition(":")
+    try:
+        server = http.server.ThreadingHTTPServer((host or "127.0.0.1",
+                                                  int(port)),
+                                                 MetricsRequestHandler)
+    except (OSError, ValueError) as e:
+        writeActivityLog(conn, "Error serving metrics on {}: {}"
+                         .format(listen, e))
+        return(None)
 
-    for thisRealFolderId, thisRealFolderName in c.fetchall():
-        processRealFolder(conn, thisWatchFolderId, thisRealFolderId,
-                          thisRealFolderName, applicationOption)
+    server.daemon_threads = True
+    server.databasename = databasename
+    threading.Thread(target=server.serve_forever, daemon=True).start()
 
-    c.close()
+    return(server)
 
 
-def Execution(databasename):
+def formatSize(size):
     """
-    Reading configuration database and process data in watch folders
+    Human readable size in bytes
     """
 
-    conn = openDatabase(databasename)
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(size) < 1024 or unit == "TB":
+            break
+        size /= 1024
 
-    # check of process is already running and exit there if
-    checkExecution(conn)
+    return("{:.1f} {}".format(size, unit))
 
-    # read application options
-    applicationOption = loadApplicationOption(conn)
 
+def printStatistics(title, rows):
+    """
+    Print one block of statistics. Every row is (name, file count,
+    original size, optimized size, timed size, runtime) of optimized files.
+    """
+
+    print(title)
+    print("{:<40} {:>7} {:>10} {:>10} {:>10} {:>6} {:>7} {:>7}"
+          .format("", "files", "original", "optimized", "saved", "ratio",
+                  "MB/s", "s/GB"))
+
+    for (name, fileCount, originalSize, optimizedSize, timedSize,
+            runtime) in rows:
+        if len(name) > 40:
+            name = "..." + name[-37:]
+        ratio = "-"
+        if originalSize:
+            ratio = "{:.2f}".format(optimizedSize / originalSize)
+        throughput = "-"
+        secondsPerGB = "-"
+        if timedSize and runtime:
+            throughput = "{:.1f}".format(timedSize / 1024 ** 2 / runtime)
+            secondsPerGB = "{:.0f}".format(runtime / (timedSize / 1024 ** 3))
+        print("{:<40} {:>7} {:>10} {:>10} {:>10} {:>6} {:>7} {:>7}"
+              .format(name, fileCount, formatSize(originalSize),
+                      formatSize(optimizedSize),
+                      formatSize(originalSize - optimizedSize), ratio,
+                      throughput, secondsPerGB))
+
+    print("")
+
+
+def Statistics(databasename):
+    """
+    Show statistics of the repository. Everything is read from the
+    summary table file_statistics, no files or folders are scanned.
+    """
+
+    conn = openDatabase(databasename)
     c = conn.cursor()
 
-    if ("target_extension" not in applicationOption and
-            "target_extension" in default_application_options):
-        applicationOption["target_extension"] = default_application_options[
-                          "target_extension"]
-    elif ("target_extension" not in applicationOption and
-            "target_extension" not in default_application_options):
-        writeActivityLog(conn, "Error, cannot go without \"target_extension\""
-                         " option!")
-        sys.exit(1)
+    optimizedColumns = ("SUM(fs.file_count), SUM(fs.original_size), "
+                        "SUM(fs.optimized_size), SUM(fs.timed_size), "
+                        "SUM(fs.runtime_seconds) "
+                        "FROM file_statistics AS fs "
+                        "JOIN real_folder AS rf "
+                        "ON rf.real_folder_id = fs.real_folder_id "
+                        "JOIN watch_folder AS wf "
+                        "ON wf.watch_folder_id = rf.watch_folder_id "
+                        "WHERE fs.file_status = 1 AND fs.file_count > 0 ")
+
+    print("Files by status")
+    c.execute("SELECT fs.file_status, SUM(fs.file_count), "
+              "SUM(fs.original_size) "
+              "FROM file_statistics AS fs "
+              "JOIN real_folder AS rf "
+              "ON rf.real_folder_id = fs.real_folder_id "
+              "GROUP BY fs.file_status HAVING SUM(fs.file_count) > 0 "
+              "ORDER BY fs.file_status")
+    for thisStatus, fileCount, originalSize in c.fetchall():
+        print("{:<40} {:>7} {:>10}"
+              .format("{} ({})".format(file_status_names.get(thisStatus,
+                                                             "unknown"),
+                                       thisStatus),
+                      fileCount, formatSize(originalSize)))
+    print("")
 
-    c.execute("SELECT watch_folder_id FROM watch_folder "
-              "ORDER BY watch_folder_name")
-    for thisWatchFolderId in c.fetchall():
-        if thisWatchFolderId[0]:
-            processWatchFolder(conn, thisWatchFolderId[0], applicationOption)
+    c.execute("SELECT 'total', " + optimizedColumns)
+    printStatistics("Optimized files", [row for row in c.fetchall()
+                                        if row[1]])
+
+    c.execute("SELECT wf.watch_folder_name, " + optimizedColumns +
+              "GROUP BY wf.watch_folder_id ORDER BY wf.watch_folder_name")
+    printStatistics("By watch folder", c.fetchall())
+
+    c.execute("SELECT rf.real_folder_name, " + optimizedColumns +
+              "GROUP BY rf.real_folder_id ORDER BY rf.real_folder_name")
+    printStatistics("By real folder", c.fetchall())
+
+    c.execute("SELECT fs.original_extension, " + optimizedColumns +
+              "GROUP BY fs.original_extension "
+              "ORDER BY fs.original_extension")
+    printStatistics("By source extension", c.fetchall())
+
+    c.execute("SELECT CASE fs.encode_options WHEN '' THEN '(marked as done)' "
+              "ELSE fs.encode_options END, " + optimizedColumns +
+              "GROUP BY fs.encode_options ORDER BY fs.encode_options")
+    printStatistics("By encoder options", c.fetchall())
+
+    print("Encode speed by encoder options")
+    print("{:<40} {:>7} {:>7} {:>7}".format("", "encodes", "fps", "speed"))
+    c.execute("SELECT encode_options, COUNT(*), "
+              "SUM(frame_count) / SUM(runtime_seconds), "
+              "SUM(media_seconds) / SUM(runtime_seconds) "
+              "FROM encode_history "
+              "WHERE return_code = 0 AND runtime_seconds > 0 "
+              "GROUP BY encode_options ORDER BY encode_options")
+    for encodeOptions, encodeCount, fps, speed in c.fetchall():
+        if len(encodeOptions) > 40:
+            encodeOptions = "..." + encodeOptions[-37:]
+        print("{:<40} {:>7} {:>7} {:>7}"
+              .format(encodeOptions, encodeCount,
+                      "{:.1f}".format(fps) if fps is not None else "-",
+                      "{:.2f}x".format(speed) if speed is not None else "-"))
+    print("")
 
-    c.execute("DELETE FROM current_running")
+    print("Quality search by metric")
+    print("{:<40} {:>7} {:>7} {:>7} {:>7}".format("", "files", "crf",
+                                                  "score", "s/file"))
+    c.execute("SELECT quality_metric, COUNT(*), AVG(CAST(crf AS REAL)), "
+              "AVG(quality_score), AVG(search_seconds) "
+              "FROM file_quality GROUP BY quality_metric "
+              "ORDER BY quality_metric")
+    for metric, fileCount, crf, score, searchSeconds in c.fetchall():
+        print("{:<40} {:>7} {:>7.1f} {:>7.4f} {:>7.0f}"
+              .format(metric, fileCount, crf, score or 0,
+                      searchSeconds or 0))
+    print("")
 
-    conn.commit()
+    print("Renditions")
+    print("{:<40} {:>7} {:>10} {:>7}".format("", "files", "size", "failed"))
+    c.execute("SELECT rendition_name, SUM(rendition_status = 1), "
+              "SUM(rendition_size), SUM(rendition_status <> 1) "
+              "FROM file_rendition GROUP BY rendition_name "
+              "ORDER BY rendition_name")
+    for renditionName, fileCount, renditionSize, failedCount in c.fetchall():
+        print("{:<40} {:>7} {:>10} {:>7}"
+              .format(renditionName[-40:], fileCount,
+                      formatSize(renditionSize or 0), failedCount))
+    print("")
+
+    print("Last profiled runs")
+    c.execute("SELECT started_at, node_name, command, wall_seconds, "
+              "cpu_seconds, child_cpu_seconds, phase_info "
+              "FROM run_history ORDER BY started_at DESC LIMIT 5")
+    for (startedAt, thisNodeName, command, wallSeconds, cpuSeconds,
+            childCpuSeconds, phaseInfo) in c.fetchall():
+        print("{} {} {}: wall {:.1f}s cpu {:.1f}s encoders {:.1f}s"
+              .format(startedAt[:19], thisNodeName, command, wallSeconds,
+                      cpuSeconds, childCpuSeconds))
+        for phase, counters in json.loads(phaseInfo).items():
+            print("   {:<14} wall {:.1f}s cpu {:.1f}s sql {} commits {} "
+                  "stat {} listings {} processes {}"
+                  .format(phase, counters.get("wall_seconds", 0),
+                          counters.get("cpu_seconds", 0),
+                          *(counters[name]
+                            for name in profile_counter_names)))
+    print("")
+
+    print("Nodes")
+    c.execute("SELECT node_name, pid, worker_count, started_at, "
+              "heartbeat_at FROM current_running ORDER BY node_name")
+    for (thisNodeName, pid, workerCount, startedAt,
+            heartbeatAt) in c.fetchall():
+        print("{:<20} pid {} workers {} started {} last heartbeat {}"
+              .format(thisNodeName, pid, workerCount, startedAt[:19],
+                      "{:.0f}s ago".format(time.time() - heartbeatAt)
+                      if heartbeatAt else "-"))
+    print("")
+
+    print("Running jobs")
+    c.execute("SELECT rj.node_name, rj.worker_slot, rf.real_folder_name, "
+              "rj.file_name, rj.frame, rj.fps, rj.speed, rj.output_size, "
+              "rj.eta_seconds "
+              "FROM running_job AS rj "
+              "JOIN real_folder AS rf "
+              "ON rf.real_folder_id = rj.real_folder_id "
+              "ORDER BY rj.node_name, rj.worker_slot")
+    for (thisNodeName, workerSlot, thisRealFolderName, thisFileName, frame,
+            fps, speed, outputSize, etaSeconds) in c.fetchall():
+        print("{}/{:>2} {}".format(thisNodeName, workerSlot,
+                                   os.path.join(thisRealFolderName,
+                                                thisFileName)))
+        print("   frame {} fps {} speed {} size {} eta {}"
+              .format(frame if frame is not None else "-",
+                      fps if fps is not None else "-",
+                      "{}x".format(speed) if speed is not None else "-",
+                      formatSize(outputSize) if outputSize else "-",
+                      "{:.0f}s".format(etaSeconds) if etaSeconds is not None
+                      else "-"))
+    print("")
+
+    c.close()
     conn.close()
 
 
 if __name__ == '__main__':
+    atexit.register(flushActivityLogAtExit)
+    signal.signal(signal.SIGTERM, terminateHandler)
+    signal.signal(signal.SIGHUP, terminateHandler)
+
     if not os.path.exists(databasename):
         InitializeDatabase(databasename)
 
-    if args.command in ("execute", "exec", "e", "run", "r"):
-        Cleanup(databasename)
-        IdentifyNewFiles(databasename)
-        Execution(databasename)
-    elif args.command in ("configure", "config", "conf", "c"):
-        Configuration(databasename)
-        IdentifyNewFiles(databasename)
-    elif args.command in ("statistics", "stats", "stat", "s"):
-        IdentifyNewFiles(databasename)
-    elif args.command in ("cleanup", "clean", "u"):
-        Cleanup(databasename)
-        IdentifyNewFiles(databasename)
-    else:
-        IdentifyNewFiles(databasename)
+    startedAt = datetime.now()
+    if profileRequested(databasename):
+        enableProfiling()
+
+    try:
+        if args.command in ("execute", "exec", "e", "run", "r"):
+            runPhase("cleanup", Cleanup, databasename)
+            runPhase("identify", IdentifyNewFiles, databasename)
+            runPhase("execution", Execution, databasename)
+        elif args.command in ("configure", "config", "conf", "c"):
+            runPhase("configuration", Configuration, databasename)
+            runPhase("identify", IdentifyNewFiles, databasename)
+        elif args.command in ("statistics", "stats", "stat", "s"):
+            runPhase("statistics", Statistics, databasename)
+        elif args.command in ("cleanup", "clean", "u"):
+            runPhase("cleanup", Cleanup, databasename)
+            runPhase("identify", IdentifyNewFiles, databasename)
+        elif args.command in ("watch", "daemon", "d"):
+            runPhase("watch", Watch, databasename)
+        else:
+            runPhase("identify", IdentifyNewFiles, databasename)
+    finally:
+        if profileCounters is not None:
+            saveRunHistory(databasename, args.command, startedAt)
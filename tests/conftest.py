@@ -0,0 +1,75 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+
+script_file = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "optimize_mkv.py")
+
+
+@pytest.fixture
+def optimizeMkv(tmp_path, monkeypatch):
+    """
+    A fresh import of optimize_mkv.py for every test, its repository in a
+    temporary home folder and this node named "node-a"
+    """
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(sys, "argv", ["optimize_mkv.py", "--node", "node-a",
+                                      "stats"])
+
+    spec = importlib.util.spec_from_file_location("optimize_mkv",
+                                                  script_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return(module)
+
+
+@pytest.fixture
+def repository(optimizeMkv):
+    """
+    A new repository with one watch folder and its real folder
+    """
+
+    optimizeMkv.InitializeDatabase(optimizeMkv.databasename)
+    conn = optimizeMkv.openDatabase(optimizeMkv.databasename)
+
+    folder = os.path.join(os.environ["HOME"], "media")
+    os.makedirs(folder)
+    conn.execute("INSERT INTO watch_folder (watch_folder_id, "
+                 "watch_folder_name, recursive_yn) VALUES (1, ?, 0)",
+                 [folder])
+    conn.execute("INSERT INTO real_folder (real_folder_id, watch_folder_id, "
+                 "real_folder_name) VALUES (1, 1, ?)", [folder])
+    conn.commit()
+
+    yield(conn, folder)
+
+    conn.close()
+
+
+@pytest.fixture
+def addFile(repository):
+    """
+    Add files of the real folder 1 to folder_optimize_file
+    """
+
+    conn, folder = repository
+
+    def addRow(fileName, extension, size, status=0, **columns):
+        columns.update({"real_folder_id": 1, "file_name": fileName,
+                        "original_extension": extension,
+                        "original_size": size,
+                        "original_file_date": "2020-01-01 00:00:00",
+                        "original_first_seen_at": "2020-01-01 00:00:00",
+                        "file_status": status})
+        conn.execute("INSERT INTO folder_optimize_file ({}) VALUES ({})"
+                     .format(", ".join(columns),
+                             ", ".join("?" * len(columns))),
+                     list(columns.values()))
+        conn.commit()
+
+    return(addRow)
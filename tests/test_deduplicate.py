@@ -0,0 +1,154 @@
+import os
+
+import pytest
+
+
+options = {0: "ffmpeg", 1: "-i", 2: "INPUTFILE", 3: "-crf", 4: "24",
+           5: "OUTPUTFILE"}
+
+
+def sourceData(optimizeMkv, size):
+    """
+    Two sources of equal size and equal sampled blocks, which only differ
+    in a byte between the blocks
+    """
+
+    blockSize = optimizeMkv.fingerprint_block_size
+    blockCount = optimizeMkv.fingerprint_sample_blocks
+    lastOffset = size - blockSize
+    sampled = set()
+    for number in range(blockCount):
+        start = lastOffset * number // (blockCount - 1)
+        sampled.update(range(start, start + blockSize))
+    position = next(offset for offset in range(size)
+                    if offset not in sampled)
+
+    original = bytearray(os.urandom(size))
+    copy = bytearray(original)
+    copy[position] ^= 0xff
+
+    return(bytes(original), bytes(copy))
+
+
+@pytest.fixture
+def sources(optimizeMkv, repository, addFile):
+    """
+    Source "a" is optimized already, its result a.mkv is in place. Source
+    "b" is waiting and has the same samples as "a", returns the job of "b"
+    """
+
+    conn, folder = repository
+    size = optimizeMkv.fingerprint_block_size * \
+        optimizeMkv.fingerprint_sample_blocks * 2
+    original, copy = sourceData(optimizeMkv, size)
+
+    with open(os.path.join(folder, "a.mkv"), "wb") as f:
+        f.write(b"encoded")
+    with open(os.path.join(folder, "b.avi"), "wb") as f:
+        f.write(copy)
+    with open(os.path.join(folder, "original"), "wb") as f:
+        f.write(original)
+
+    addFile("a", "avi", size, status=1, optimized_extension="mkv",
+            optimized_size=7, optimized_file_date="2020-01-02 00:00:00",
+            encode_options=optimizeMkv.encodeOptionsText(options))
+    addFile("b", "avi", size)
+
+    job = {"realFolderId": 1, "realFolderName": folder, "fileName": "b",
+           "originalExtension": "avi", "originalSize": size,
+           "options": options,
+           "applicationOption": {"target_extension": "mkv",
+                                 "deduplicate": "link"}}
+
+    return(job)
+
+
+def addFingerprint(optimizeMkv, conn, folder, fullHash):
+    """
+    Fingerprint of source "a" out of the kept copy of its original
+    """
+
+    originalFile = os.path.join(folder, "original")
+    size = os.path.getsize(originalFile)
+    conn.execute("INSERT INTO file_fingerprint VALUES (1, 'a', ?, ?, ?, ?)",
+                 [size, "2020-01-01 00:00:00",
+                  optimizeMkv.hashFile(originalFile, size), fullHash])
+    conn.commit()
+
+
+def reuse(optimizeMkv, job):
+    """
+    Sample the source of the job, claim it and reuse a result as the job
+    pool does, the main thread part on its own connection
+    """
+
+    conn = optimizeMkv.openDatabase(optimizeMkv.databasename)
+    logfile, inpfile, tgtfile, outfile = optimizeMkv.jobFiles(job)
+    optimizeMkv.saveFileFingerprint(conn, job, optimizeMkv.hashFile(
+        inpfile, job["originalSize"]))
+    conn.commit()
+
+    if not optimizeMkv.claimIdenticalFile(conn, job):
+        return(False)
+    assert fileStatus(conn) == {"a": 1, "b": 2}
+
+    return(optimizeMkv.recordIdenticalFile(
+        conn, job, optimizeMkv.reuseIdenticalFile(job)))
+
+
+def fileStatus(conn):
+    return(dict(conn.execute("SELECT file_name, file_status "
+                             "FROM folder_optimize_file")))
+
+
+def test_equal_samples_are_not_identical(optimizeMkv, repository, sources):
+    conn, folder = repository
+    addFingerprint(optimizeMkv, conn, folder, None)
+
+    assert not reuse(optimizeMkv, sources)
+
+    assert sorted(os.listdir(folder)) == ["a.mkv", "b.avi", "original"]
+    assert fileStatus(conn) == {"a": 1, "b": 0}
+    # The full hash of "b" is kept for later candidates
+    assert conn.execute("SELECT full_hash FROM file_fingerprint "
+                        "WHERE file_name = 'b'").fetchone()[0] is not None
+
+
+def test_different_full_hash_is_not_identical(optimizeMkv, repository,
+                                              sources):
+    conn, folder = repository
+    addFingerprint(optimizeMkv, conn, folder, optimizeMkv.hashFile(
+        os.path.join(folder, "original"), 0, True))
+
+    assert not reuse(optimizeMkv, sources)
+
+    assert sorted(os.listdir(folder)) == ["a.mkv", "b.avi", "original"]
+    assert fileStatus(conn) == {"a": 1, "b": 0}
+
+
+def test_equal_full_hash_reuses_result(optimizeMkv, repository, sources):
+    conn, folder = repository
+    addFingerprint(optimizeMkv, conn, folder, optimizeMkv.hashFile(
+        os.path.join(folder, "b.avi"), 0, True))
+
+    assert reuse(optimizeMkv, sources)
+
+    assert sorted(os.listdir(folder)) == ["a.mkv", "b.mkv", "original"]
+    with open(os.path.join(folder, "b.mkv"), "rb") as f:
+        assert f.read() == b"encoded"
+    assert fileStatus(conn) == {"a": 1, "b": 1}
+
+
+def test_failed_rename_keeps_original(optimizeMkv, repository, sources):
+    conn, folder = repository
+    addFingerprint(optimizeMkv, conn, folder, optimizeMkv.hashFile(
+        os.path.join(folder, "b.avi"), 0, True))
+    # A folder in place of the target can't be replaced by the result
+    os.mkdir(os.path.join(folder, "b.mkv"))
+    open(os.path.join(folder, "b.mkv", "keep"), "w").close()
+
+    assert not reuse(optimizeMkv, sources)
+
+    assert sorted(os.listdir(folder)) == ["a.mkv", "b.avi", "b.mkv",
+                                          "original"]
+    assert fileStatus(conn) == {"a": 1, "b": 0}
@@ -0,0 +1,86 @@
+import os
+
+
+def finishedJob(folder):
+    """
+    A job whose encoder has finished, as finalizeProcessFile gets it
+    """
+
+    return({"inpfile": os.path.join(folder, "a.avi"),
+            "outfile": os.path.join(folder, ".a.tmp.mkv"),
+            "localOutfile": os.path.join(folder, ".a.tmp.mkv"),
+            "tgtfile": os.path.join(folder, "a.mkv"),
+            "logfile": os.path.join(folder, "a.log"),
+            "renditions": [], "segments": None, "leaseLost": False,
+            "skipReason": None, "messages": []})
+
+
+def test_finalize_replaces_original(optimizeMkv, tmp_path):
+    job = finishedJob(str(tmp_path))
+    for thisFile in (job["inpfile"], job["outfile"], job["logfile"]):
+        with open(thisFile, "w") as f:
+            f.write("data")
+
+    assert optimizeMkv.finalizeProcessFile(job, 0) == 0
+
+    assert os.listdir(str(tmp_path)) == ["a.mkv"]
+    assert job["fileSize"] == 4
+
+
+def test_finalize_without_result_fails_only_this_job(optimizeMkv, tmp_path):
+    job = finishedJob(str(tmp_path))
+    open(job["inpfile"], "w").close()
+
+    assert optimizeMkv.finalizeProcessFile(job, 0) == 1
+
+    assert os.listdir(str(tmp_path)) == ["a.avi"]
+    assert len(job["messages"]) == 1
+
+
+def queuedJob(folder, **applicationOption):
+    """
+    A job of the queue as collectPendingJobs returns it
+    """
+
+    applicationOption.update({"target_extension": "mkv",
+                              "min_free_mb": "0"})
+
+    return({"realFolderId": 1, "realFolderName": folder, "fileName": "a",
+            "originalExtension": "avi", "originalSize": 4,
+            "options": {0: "ffmpeg", 1: "-i", 2: "INPUTFILE",
+                        3: "OUTPUTFILE"},
+            "applicationOption": applicationOption, "probe": None})
+
+
+def test_prepare_without_source_fails(optimizeMkv, tmp_path):
+    prepared = optimizeMkv.prepareJob(queuedJob(str(tmp_path)))
+
+    assert prepared["error"].startswith("File not found")
+
+
+def test_prepare_removes_scratch_leftover(optimizeMkv, tmp_path):
+    folder = tmp_path / "media"
+    scratch = tmp_path / "scratch"
+    folder.mkdir()
+    scratch.mkdir()
+    (folder / "a.avi").write_text("data")
+    (scratch / "1-a.tmp.mkv").write_text("left")
+
+    prepared = optimizeMkv.prepareJob(queuedJob(
+        str(folder), scratch_folder=str(scratch)))
+
+    assert prepared["error"] is None
+    assert prepared["outfile"] == str(scratch / "1-a.tmp.mkv")
+    assert os.listdir(str(scratch)) == []
+
+
+def test_prepare_without_probe_program(optimizeMkv, tmp_path):
+    (tmp_path / "a.avi").write_text("data")
+    job = queuedJob(str(tmp_path), probe_program=str(tmp_path / "missing"))
+    job["optionTemplate"] = optimizeMkv.compileOptionTemplate(job["options"])
+
+    prepared = optimizeMkv.prepareJob(job)
+
+    assert prepared["error"] is None
+    assert prepared["probeMissing"] == str(tmp_path / "missing")
+    assert "probe" not in prepared
@@ -0,0 +1,70 @@
+import os
+import time
+
+
+lease_seconds = 300
+
+
+def fileStatus(conn):
+    return(dict(conn.execute("SELECT file_name, file_status "
+                             "FROM folder_optimize_file")))
+
+
+def addClaimedFile(addFile, folder, fileName, node, expiresIn):
+    """
+    A file being encoded by node, with the leftovers of its encode
+    """
+
+    addFile(fileName, "avi", 1000, status=2, optimized_extension="mkv",
+            lease_node=node, lease_expires_at=time.time() + expiresIn)
+    for leftover in (fileName + ".log", "." + fileName + ".tmp.mkv"):
+        open(os.path.join(folder, leftover), "w").close()
+
+
+def leftovers(folder, fileName):
+    return(sorted(name for name in os.listdir(folder)
+                  if fileName in name))
+
+
+def test_own_files_recovered_on_restart(optimizeMkv, repository, addFile):
+    conn, folder = repository
+    addClaimedFile(addFile, folder, "own", "node-a", lease_seconds)
+
+    optimizeMkv.recoverRunningJobs(conn, lease_seconds)
+    assert fileStatus(conn) == {"own": 2}
+
+    optimizeMkv.recoverRunningJobs(conn, lease_seconds, ownJobs=True)
+    conn.commit()
+    assert fileStatus(conn) == {"own": 0}
+    assert leftovers(folder, "own") == []
+
+
+def test_foreign_files_wait_for_grace_period(optimizeMkv, repository,
+                                             addFile):
+    conn, folder = repository
+    renewal = lease_seconds / 3
+    addClaimedFile(addFile, folder, "running", "node-b", lease_seconds)
+    addClaimedFile(addFile, folder, "late", "node-b", -renewal)
+    addClaimedFile(addFile, folder, "dead", "node-b",
+                   -renewal * (optimizeMkv.lease_grace_renewals + 1))
+
+    optimizeMkv.recoverRunningJobs(conn, lease_seconds, ownJobs=True)
+    conn.commit()
+
+    assert fileStatus(conn) == {"running": 2, "late": 2, "dead": 0}
+    # The files of another node are never removed
+    for fileName in ("running", "late", "dead"):
+        assert leftovers(folder, fileName) == ["." + fileName + ".tmp.mkv",
+                                               fileName + ".log"]
+    assert conn.execute("SELECT lease_node FROM folder_optimize_file "
+                        "WHERE file_name = 'dead'").fetchone() == (None, )
+
+
+def test_claims_without_lease_recovered(optimizeMkv, repository, addFile):
+    conn, folder = repository
+    addFile("legacy", "avi", 1000, status=2, optimized_extension="mkv")
+
+    optimizeMkv.recoverRunningJobs(conn, lease_seconds)
+    conn.commit()
+
+    assert fileStatus(conn) == {"legacy": 0}
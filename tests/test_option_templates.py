@@ -0,0 +1,43 @@
+def test_static_option_template(optimizeMkv):
+    Options = {0: "ffmpeg", 1: "-i", 2: "INPUTFILE", 3: "-crf", 4: "24",
+               5: "OUTPUTFILE"}
+
+    template, invalid = optimizeMkv.compileOptionTemplate(Options)
+
+    assert invalid == []
+    assert not template["dynamic"]
+    assert optimizeMkv.fillOptionTemplate(template, None, 1000) == Options
+
+
+def test_fill_option_template(optimizeMkv):
+    template, invalid = optimizeMkv.compileOptionTemplate({
+        0: "ffmpeg", 3: "[if height>1080]-vf",
+        4: "[if height>1080]scale=-2:1080", 5: "-b:v",
+        6: "{video_kbps}k", 7: "[if video_codec=mpeg2video|h264]-tune",
+        8: "[if video_codec=mpeg2video|h264, size_mb>=1]film"})
+    uhd = {"height": 2160, "video_bitrate": 40000000, "video_codec": "h264"}
+    hd = {"height": 1080, "video_bitrate": 8000000, "video_codec": "hevc"}
+
+    assert invalid == []
+    assert template["dynamic"]
+    assert optimizeMkv.fillOptionTemplate(template, uhd, 2 * 1024 ** 2) == {
+        0: "ffmpeg", 3: "-vf", 4: "scale=-2:1080", 5: "-b:v", 6: "40000k",
+        7: "-tune", 8: "film"}
+    assert optimizeMkv.fillOptionTemplate(template, hd, 1000) == {
+        0: "ffmpeg", 5: "-b:v", 6: "8000k"}
+    # Unknown properties fail every condition and leave variables out
+    assert optimizeMkv.fillOptionTemplate(template, None, 1000) == {
+        0: "ffmpeg", 5: "-b:v"}
+
+
+def test_option_template_malformed(optimizeMkv):
+    template, invalid = optimizeMkv.compileOptionTemplate({
+        0: "ffmpeg", 1: "[if colour>1]-x", 2: "[if height]-y",
+        3: "[if height>1080,]-z", 4: "[if height>1080", 5: "[if height>hd]-w",
+        6: "{unknown}"})
+
+    assert invalid == [1, 2, 3]
+    # Without a closing bracket or with unknown names, values are literal
+    assert optimizeMkv.fillOptionTemplate(template, {"height": 2160},
+                                          1000) == {
+        0: "ffmpeg", 4: "[if height>1080", 6: "{unknown}"}
@@ -0,0 +1,151 @@
+import sqlite3
+
+
+# Repository of the first published version (3), as InitializeDatabase
+# created it
+baseline_schema = [
+    "CREATE TABLE repository_version ("
+    "version_number UNSIGNED INTEGER NOT NULL PRIMARY KEY)",
+    "CREATE TRIGGER NMR_repository_version BEFORE INSERT "
+    "ON repository_version WHEN (SELECT COUNT(*) "
+    "FROM repository_version) >= 1 BEGIN "
+    "SELECT RAISE(FAIL, 'Only one row allowed!'); END",
+    "CREATE TABLE watch_folder ("
+    "watch_folder_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "
+    "watch_folder_name TEXT NOT NULL, "
+    "recursive_yn UNSIGNED TINYINT NOT NULL DEFAULT 0 "
+    "CHECK(recursive_yn in (0, 1)))",
+    "CREATE TABLE real_folder ("
+    "real_folder_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "
+    "watch_folder_id INTEGER NOT NULL REFERENCES watch_folder "
+    "(watch_folder_id) ON DELETE CASCADE ON UPDATE CASCADE, "
+    "real_folder_name TEXT NOT NULL UNIQUE)",
+    "CREATE TABLE folder_ignore_extension ("
+    "watch_folder_id INTEGER NOT NULL REFERENCES watch_folder "
+    "(watch_folder_id) ON DELETE CASCADE ON UPDATE CASCADE, "
+    "ignore_extension TEXT NOT NULL, "
+    "PRIMARY KEY (watch_folder_id, ignore_extension))",
+    "CREATE TABLE folder_optimize_file ("
+    "real_folder_id INTEGER NOT NULL REFERENCES real_folder "
+    "(real_folder_id) ON DELETE CASCADE ON UPDATE CASCADE, "
+    "file_name TEXT NOT NULL, original_extension TEXT NOT NULL, "
+    "original_size UNSIGNED BIGINT NOT NULL, "
+    "original_file_date TEXT NOT NULL, "
+    "original_first_seen_at TEXT NOT NULL, "
+    "optimization_started_at TEXT, optimized_extension TEXT, "
+    "optimized_size UNSIGNED BIGINT, optimized_file_date TEXT, "
+    "runtime_seconds INTEGER, file_status TINYINT NOT NULL, "
+    "PRIMARY KEY (real_folder_id, file_name))",
+    "CREATE TABLE folder_option ("
+    "watch_folder_id INTEGER NOT NULL REFERENCES watch_folder "
+    "(watch_folder_id) ON DELETE CASCADE ON UPDATE CASCADE, "
+    "folder_option_id INTEGER NOT NULL, "
+    "folder_option TEXT, "
+    "PRIMARY KEY (watch_folder_id, folder_option_id))",
+    "CREATE TABLE default_option ("
+    "default_option_id INTEGER NOT NULL PRIMARY KEY, "
+    "default_option TEXT NOT NULL)",
+    "CREATE TABLE current_running ("
+    "started_at TEXT NOT NULL PRIMARY KEY, "
+    "pid UNSIGNED INTEGER NOT NULL)",
+    "CREATE TABLE activity_log ("
+    "log_ts TEXT NOT NULL, "
+    "activity_text TEXT NOT NULL)",
+    "CREATE TABLE message (message_text TEXT NOT NULL PRIMARY KEY)",
+    "CREATE TRIGGER NMR_message BEFORE INSERT ON message "
+    "WHEN (SELECT COUNT(*) FROM message) >= 1 BEGIN "
+    "SELECT RAISE(FAIL, 'Only one row allowed!'); END",
+    "CREATE TABLE application_option ("
+    "option_key TEXT NOT NULL PRIMARY KEY, "
+    "option_value TEXT NOT NULL)",
+    "INSERT INTO repository_version (version_number) VALUES (3)",
+    "INSERT INTO application_option VALUES ('target_extension', 'mkv')",
+    "INSERT INTO default_option VALUES (0, 'ffmpeg')",
+    "INSERT INTO watch_folder VALUES (1, '/media', 0)",
+    "INSERT INTO real_folder VALUES (1, 1, '/media')",
+    "INSERT INTO folder_optimize_file VALUES (1, 'done', 'avi', 2000, "
+    "'2016-01-01 00:00:00', '2016-01-01 00:00:00', '2016-01-02 00:00:00', "
+    "'mkv', 1000, '2016-01-02 00:00:00', 60, 1)",
+    "INSERT INTO folder_optimize_file VALUES (1, 'pending', 'mkv', 3000, "
+    "'2016-01-01 00:00:00', '2016-01-01 00:00:00', NULL, NULL, NULL, "
+    "NULL, NULL, 0)",
+    "INSERT INTO current_running VALUES ('2016-01-02 00:00:00', 1)"]
+
+
+def tableColumns(conn):
+    """
+    Names of all tables with the names of their columns
+    """
+
+    return(dict((table, set(row[1] for row in conn.execute(
+        "PRAGMA table_info({})".format(table))))
+        for table, in conn.execute("SELECT name FROM sqlite_master "
+                                   "WHERE type = 'table' "
+                                   "AND name NOT LIKE 'sqlite_%'")))
+
+
+def test_migrate_baseline_repository(optimizeMkv, tmp_path):
+    baselineFile = str(tmp_path / "baseline.db")
+    conn = sqlite3.connect(baselineFile)
+    for statement in baseline_schema:
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+
+    conn = optimizeMkv.openDatabase(baselineFile)
+
+    assert conn.execute("SELECT version_number "
+                        "FROM repository_version").fetchall() == [
+        (optimizeMkv.current_repository_version, )]
+    assert optimizeMkv.current_repository_version == 16
+    assert conn.execute("SELECT file_name, original_size, optimized_size, "
+                        "file_status FROM folder_optimize_file "
+                        "ORDER BY file_name").fetchall() == [
+        ("done", 2000, 1000, 1), ("pending", 3000, None, 0)]
+    assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+
+    # A migrated repository has the tables and columns of a new one
+    optimizeMkv.InitializeDatabase(optimizeMkv.databasename)
+    newConn = optimizeMkv.openDatabase(optimizeMkv.databasename)
+    assert tableColumns(conn) == tableColumns(newConn)
+
+    newConn.close()
+    conn.close()
+
+
+def test_open_current_repository_keeps_version(optimizeMkv):
+    optimizeMkv.InitializeDatabase(optimizeMkv.databasename)
+
+    for attempt in range(2):
+        conn = optimizeMkv.openDatabase(optimizeMkv.databasename)
+        assert conn.execute("SELECT version_number "
+                            "FROM repository_version").fetchone()[0] == 16
+        conn.close()
+
+
+def journalMode(optimizeMkv):
+    conn = optimizeMkv.openDatabase(optimizeMkv.databasename)
+    mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.close()
+
+    return(mode)
+
+
+def test_journal_mode_follows_option(optimizeMkv):
+    optimizeMkv.InitializeDatabase(optimizeMkv.databasename)
+    assert journalMode(optimizeMkv) == "delete"
+
+    conn = optimizeMkv.openDatabase(optimizeMkv.databasename)
+    conn.execute("INSERT OR REPLACE INTO application_option VALUES "
+                 "('journal_mode', 'wal')")
+    conn.commit()
+    conn.close()
+    assert journalMode(optimizeMkv) == "wal"
+
+    # Repositories switched to WAL by an older version go back by default
+    conn = optimizeMkv.openDatabase(optimizeMkv.databasename)
+    conn.execute("DELETE FROM application_option "
+                 "WHERE option_key = 'journal_mode'")
+    conn.commit()
+    conn.close()
+    assert journalMode(optimizeMkv) == "delete"
@@ -0,0 +1,66 @@
+import os
+
+
+options = {0: "ffmpeg", 1: "-i", 2: "INPUTFILE", 3: "-map", 4: "0",
+           5: "-c", 6: "copy", 7: "-c:v", 8: "libx265", 9: "-dn",
+           10: "OUTPUTFILE"}
+
+streams = [{"codec_type": "video", "codec_name": "h264"},
+           {"codec_type": "audio", "codec_name": "truehd"},
+           {"codec_type": "audio", "codec_name": "aac"},
+           {"codec_type": "subtitle", "codec_name": "subrip"},
+           {"codec_type": "data", "codec_name": "bin_data"}]
+
+
+def segmentedJob(folder, encodeOptions="-crf 20"):
+    return({"segmentFolder": folder, "encodeOptions": encodeOptions,
+            "options": options, "streamRules": None,
+            "probe": {"streams": streams}})
+
+
+def test_mux_takes_streams_but_video_from_source(optimizeMkv, tmp_path):
+    job = segmentedJob(str(tmp_path))
+
+    assert optimizeMkv.segmentMuxOptions(job) == [
+        "-map", "1:0", "-map", "0:1", "-map", "0:2", "-map", "0:3",
+        "-c", "copy"]
+
+
+def test_mux_applies_stream_rules(optimizeMkv, tmp_path):
+    job = segmentedJob(str(tmp_path))
+    job["streamRules"], invalid = optimizeMkv.parseStreamRules(
+        "video:copy; audio codec=truehd:libopus 256k; subtitle:drop")
+
+    assert optimizeMkv.segmentMuxOptions(job) == [
+        "-map", "1:0", "-map", "0:1", "-map", "0:2", "-c", "copy",
+        "-c:1", "libopus", "-b:1", "256k"]
+
+
+def test_mux_without_probe(optimizeMkv, tmp_path):
+    job = segmentedJob(str(tmp_path))
+    job["probe"] = None
+
+    assert optimizeMkv.segmentMuxOptions(job) == [
+        "-map", "1:0", "-map", "0", "-map", "-0:v", "-map", "-0:d",
+        "-c", "copy"]
+
+
+def test_segments_of_other_options_encoded_again(optimizeMkv, tmp_path):
+    segments = [{"number": 0, "status": 1}, {"number": 1, "status": 1}]
+    for segment in segments:
+        (tmp_path / optimizeMkv.encodedSegmentFile(segment)).write_text("x")
+
+    optimizeMkv.clearEncodedSegments(segmentedJob(str(tmp_path)), segments)
+    assert [segment["status"] for segment in segments] == [0, 0]
+    assert os.listdir(str(tmp_path)) == ["options.txt"]
+
+    # Segments encoded with the same options are kept
+    for segment in segments:
+        segment["status"] = 1
+        (tmp_path / optimizeMkv.encodedSegmentFile(segment)).write_text("x")
+    optimizeMkv.clearEncodedSegments(segmentedJob(str(tmp_path)), segments)
+    assert [segment["status"] for segment in segments] == [1, 1]
+
+    optimizeMkv.clearEncodedSegments(
+        segmentedJob(str(tmp_path), "-crf 24"), segments)
+    assert [segment["status"] for segment in segments] == [0, 0]
@@ -0,0 +1,89 @@
+def stream(codecType, codecName, **properties):
+    """
+    A stream as probeResult returns it
+    """
+
+    values = {"codec_type": codecType, "codec_name": codecName,
+              "language": None, "title": None, "comment": 0, "default": 0,
+              "bit_rate": None, "channels": None, "width": None,
+              "height": None}
+    values.update(properties)
+
+    return(values)
+
+
+def test_parse_stream_rules(optimizeMkv):
+    rules, invalid = optimizeMkv.parseStreamRules(
+        " audio codec=dts,truehd kbps>=640:libopus 256k; "
+        "subtitle lang!=eng,ger:drop;;video:copy ")
+
+    assert invalid == []
+    assert rules == [
+        {"type": "audio", "conditions": [("codec", "=", "dts,truehd"),
+                                         ("kbps", ">=", "640")],
+         "action": ["libopus", "256k"]},
+        {"type": "subtitle", "conditions": [("lang", "!=", "eng,ger")],
+         "action": ["drop"]},
+        {"type": "video", "conditions": [], "action": ["copy"]}]
+
+
+def test_parse_stream_rules_malformed(optimizeMkv):
+    malformed = ["audio", "audio:", "movie:copy", ":copy",
+                 "audio kbps<>640:copy", "audio kbps>=fast:copy",
+                 "audio lang:copy", "audio:copy now",
+                 "audio:libopus 256k 2", "audio:drop all"]
+
+    rules, invalid = optimizeMkv.parseStreamRules(
+        ";".join(malformed + ["any default:copy"]))
+
+    assert invalid == malformed
+    assert rules == [{"type": "any", "conditions": [("default", "", "")],
+                      "action": ["copy"]}]
+
+
+def test_stream_conditions(optimizeMkv):
+    rules, invalid = optimizeMkv.parseStreamRules(
+        "audio kbps<=8000 channels>2:copy; subtitle title~sdh:drop; "
+        "audio lang=eng:copy")
+    surround = stream("audio", "dts", bit_rate=1509000, channels=6)
+    unknownRate = stream("audio", "dts", channels=6)
+    captions = stream("subtitle", "subrip", title="English SDH")
+    english = stream("audio", "aac", language="eng")
+
+    assert optimizeMkv.streamMatches(rules[0], surround)
+    assert not optimizeMkv.streamMatches(rules[0], unknownRate)
+    assert not optimizeMkv.streamMatches(rules[0], captions)
+    assert optimizeMkv.streamMatches(rules[1], captions)
+    assert optimizeMkv.streamMatches(rules[2], english)
+    assert not optimizeMkv.streamMatches(rules[2], surround)
+
+
+def test_resolve_stream_rules(optimizeMkv):
+    rules, invalid = optimizeMkv.parseStreamRules(
+        "audio codec=dts,truehd:libopus 256k; subtitle lang!=eng,ger:drop; "
+        "video:copy")
+    streams = [stream("video", "h264"),
+               stream("audio", "dts", language="eng"),
+               stream("audio", "aac", language="ger"),
+               stream("subtitle", "subrip", language="fre"),
+               stream("data", "bin_data")]
+    Options = {0: "ffmpeg", 1: "-i", 2: "INPUTFILE", 3: "-dn",
+               4: "OUTPUTFILE"}
+
+    streamOptions, actions = optimizeMkv.resolveStreamRules(rules, streams,
+                                                            Options)
+
+    assert streamOptions == ["-map", "0:0", "-map", "0:1", "-map", "0:2",
+                             "-c:0", "copy", "-c:1", "libopus",
+                             "-b:1", "256k"]
+    assert actions == ["copy", "libopus 256k", None, "drop", "disabled"]
+
+
+def test_resolve_without_rules_keeps_streams(optimizeMkv):
+    streams = [stream("video", "h264"), stream("audio", "aac")]
+
+    streamOptions, actions = optimizeMkv.resolveStreamRules(
+        [], streams, {0: "ffmpeg"})
+
+    assert streamOptions == ["-map", "0:0", "-map", "0:1"]
+    assert actions == [None, None]